@@ -0,0 +1,381 @@
+"""
+Benchmark a local cluster with YCSB style workloads.
+
+Starts a coordinator and --servers servers on localhost, either in this
+process or as subprocesses, loads --records keys and then runs --clients
+concurrent clients for --duration seconds. Each client runs transactions
+of --ops-per-txn operations back to back, every operation is a read with
+probability --read-ratio and a write otherwise, on keys picked uniformly or
+from a Zipfian distribution.
+
+Prints one json object with the configuration and the results: committed
+transactions per second, p50/p99/p999 latency of committed transactions in
+milliseconds, and the abort rate.
+
+    python3 bench.py --servers 3 --clients 16 --distribution zipfian
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from client import (ClientNetwork, TransactionAborted, TransactionClient,
+                    TransactionError)
+from coordinator import CoordinatorNetwork
+from server import ServerNetwork
+
+
+class Zipfian:
+    """
+    Ranks 0..n-1, rank i drawn with probability proportional to
+    1 / (i + 1) ** theta. YCSB uses theta 0.99
+    """
+
+    def __init__(self, n, theta=0.99):
+        self.cdf = list(itertools.accumulate(
+            1.0 / (i + 1) ** theta for i in range(n)))
+        self.total = self.cdf[-1]
+
+    def next(self, rng):
+        return bisect.bisect_left(self.cdf, rng.random() * self.total)
+
+
+class Uniform:
+    def __init__(self, n):
+        self.n = n
+
+    def next(self, rng):
+        return rng.randrange(self.n)
+
+
+class Cluster:
+    """
+    Coordinator and servers on localhost, ports counting up from base_port
+    """
+    NAMES = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+    def __init__(self, servers, base_port, data_dir, subprocesses=False):
+        self.base_port = base_port
+        self.data_dir = data_dir
+        self.subprocesses = subprocesses
+        self.names = Cluster.NAMES[:servers]
+
+        self._nodes = []
+        self._procs = []
+
+    def coordinator(self):
+        return 'localhost', self.base_port
+
+    def servers(self):
+        return [('localhost', name, self.base_port + 1 + i)
+                for i, name in enumerate(self.names)]
+
+    async def start(self):
+        if self.subprocesses:
+            self._spawn('coordinator', self.base_port)
+            for _, name, port in self.servers():
+                self._spawn(name, port)
+            for port in range(self.base_port,
+                              self.base_port + 1 + len(self.names)):
+                await wait_for_port(port)
+            return
+
+        coordinator = CoordinatorNetwork(
+            self.base_port, os.path.join(self.data_dir, 'coordinator.json'),
+            self.servers(), os.path.join(self.data_dir, 'coordinator.txn_id'),
+            os.path.join(self.data_dir, 'coordinator.ring'))
+        await coordinator.create_coordinator()
+        self._nodes.append(coordinator)
+        for _, name, port in self.servers():
+            server = start_server(name, port, self.data_dir)
+            await server.create_server()
+            self._nodes.append(server)
+
+    def _spawn(self, name, port):
+        servers = [f'{name}:{port}' for _, name, port in self.servers()]
+        self._procs.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'node', name,
+             str(port), self.data_dir] + servers))
+
+    def stop(self):
+        for node in self._nodes:
+            node.close()
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            proc.wait()
+
+
+def start_server(name, port, data_dir):
+    def path(ext):
+        return os.path.join(data_dir, f'{name}.{ext}')
+    return ServerNetwork(port, path('wal'), path('ckpt'), path('json'),
+                         path('ring'))
+
+
+async def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('localhost', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+def run_node(name, port, data_dir, *servers):
+    """
+    Serve one node of a subprocess cluster until terminated, servers are
+    the name:port of every server
+    """
+    evloop = asyncio.get_event_loop()
+    if name == 'coordinator':
+        servers = [('localhost', server.split(':')[0],
+                    int(server.split(':')[1])) for server in servers]
+        node = CoordinatorNetwork(
+            int(port), os.path.join(data_dir, 'coordinator.json'), servers,
+            os.path.join(data_dir, 'coordinator.txn_id'),
+            os.path.join(data_dir, 'coordinator.ring'))
+        evloop.run_until_complete(node.create_coordinator())
+    else:
+        node = start_server(name, int(port), data_dir)
+        evloop.run_until_complete(node.create_server())
+
+    # terminate() sends SIGTERM, turn it into a clean shutdown
+    evloop.add_signal_handler(signal.SIGTERM, evloop.stop)
+    evloop.run_forever()
+    node.close()
+
+
+class Workload:
+    def __init__(self, args):
+        self.args = args
+        if args.distribution == 'zipfian':
+            self.keys = Zipfian(args.records, args.theta)
+        else:
+            self.keys = Uniform(args.records)
+        self.value = 'x' * args.value_size
+
+    @staticmethod
+    def key(index):
+        return f'user{index}'
+
+    def txn(self, rng):
+        """
+        [(is_read, key)] for one transaction
+        """
+        ops = []
+        for _ in range(self.args.ops_per_txn):
+            key = Workload.key(self.keys.next(rng))
+            ops.append((rng.random() < self.args.read_ratio, key))
+        return ops
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.committed = 0
+        self.aborted = 0
+        self.failed = 0
+
+    def summary(self, duration):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(int(q * len(latencies)),
+                                 len(latencies) - 1)] * 1000
+
+        attempts = self.committed + self.aborted
+        return {
+            'duration': duration,
+            'committed': self.committed,
+            'aborted': self.aborted,
+            'failed': self.failed,
+            'throughput': self.committed / duration if duration else 0.0,
+            'abort_rate': self.aborted / attempts if attempts else 0.0,
+            'latency_ms': {
+                'mean': (sum(latencies) / len(latencies) * 1000
+                         if latencies else None),
+                'p50': percentile(0.5),
+                'p99': percentile(0.99),
+                'p999': percentile(0.999),
+            },
+        }
+
+
+def clock_id(args, index):
+    return index if args.clock else None
+
+
+async def load(cluster, workload, batch=100):
+    client = TransactionClient(cluster.servers(), cluster.coordinator(),
+                               clock_id=clock_id(workload.args, 0))
+    await client.connect()
+    for start in range(0, workload.args.records, batch):
+        async with client.transaction() as txn:
+            for index in range(start, min(start + batch,
+                                          workload.args.records)):
+                txn.queue_set(Workload.key(index), workload.value)
+            await txn.flush()
+    client.close()
+
+
+async def run_client(client, workload, results, rng, start, end):
+    args = workload.args
+    while time.monotonic() < end:
+        ops = workload.txn(rng)
+        readonly = args.readonly and all(is_read for is_read, _ in ops)
+
+        began = time.monotonic()
+        try:
+            async with client.transaction(readonly) as txn:
+                if args.batch:
+                    for is_read, key in ops:
+                        if is_read:
+                            txn.queue_get(key)
+                        else:
+                            txn.queue_set(key, workload.value)
+                    await txn.flush()
+                else:
+                    for is_read, key in ops:
+                        if is_read:
+                            await txn.get(key)
+                        else:
+                            await txn.set(key, workload.value)
+        except TransactionAborted:
+            outcome = 'aborted'
+        except TransactionError:
+            outcome = 'failed'
+        else:
+            outcome = 'committed'
+        finished = time.monotonic()
+
+        # transactions that began during warmup are not counted
+        if began < start:
+            continue
+        if outcome == 'committed':
+            results.committed += 1
+            results.latencies.append(finished - began)
+        elif outcome == 'aborted':
+            results.aborted += 1
+        else:
+            results.failed += 1
+
+
+async def bench(args):
+    ClientNetwork.LEASE_TXN_IDS = args.lease
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    cluster = Cluster(args.servers, args.base_port, data_dir,
+                      args.mode == 'subprocess')
+    await cluster.start()
+
+    clients = []
+    try:
+        workload = Workload(args)
+        await load(cluster, workload)
+
+        for i in range(args.clients):
+            client = TransactionClient(cluster.servers(),
+                                       cluster.coordinator(),
+                                       clock_id=clock_id(args, i + 1))
+            await client.connect()
+            clients.append(client)
+
+        results = Results()
+        start = time.monotonic() + args.warmup
+        end = start + args.duration
+        await asyncio.gather(*[
+            run_client(client, workload, results,
+                       random.Random(args.seed + i), start, end)
+            for i, client in enumerate(clients)])
+        duration = time.monotonic() - start
+    finally:
+        for client in clients:
+            client.close()
+        cluster.stop()
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    config = {name: value for name, value in vars(args).items()
+              if name not in ('data_dir', 'output')}
+    return {'config': config, 'results': results.summary(duration)}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark a local cluster with YCSB style workloads')
+    parser.add_argument('--mode', choices=('inprocess', 'subprocess'),
+                        default='subprocess',
+                        help='run the nodes in this process or in their own')
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='seconds to run before measuring')
+    parser.add_argument('--records', type=int, default=10000,
+                        help='number of keys, loaded before the run')
+    parser.add_argument('--ops-per-txn', type=int, default=4)
+    parser.add_argument('--read-ratio', type=float, default=0.5)
+    parser.add_argument('--distribution', choices=('uniform', 'zipfian'),
+                        default='uniform')
+    parser.add_argument('--theta', type=float, default=0.99,
+                        help='skew of the zipfian distribution')
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--batch', action='store_true',
+                        help='send the ops of a txn as one batch per server')
+    parser.add_argument('--readonly', action='store_true',
+                        help='run txns that only read as READONLY txns')
+    parser.add_argument('--clock', action='store_true',
+                        help='take txn ids from hybrid clocks instead of '
+                             'the coordinator')
+    parser.add_argument('--lease', action='store_true',
+                        help='lease blocks of txn ids from the coordinator '
+                             'instead of asking for every txn')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--base-port', type=int, default=14000)
+    parser.add_argument('--data-dir', default=None,
+                        help='where servers keep their files, a temporary '
+                             'directory that is removed afterwards if unset')
+    parser.add_argument('--output', default=None,
+                        help='write the json here instead of to stdout')
+    return parser.parse_args(argv)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'node':
+        logging.basicConfig(level=logging.WARNING)
+        run_node(*sys.argv[2:])
+        return
+
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.WARNING)
+
+    report = asyncio.get_event_loop().run_until_complete(bench(args))
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
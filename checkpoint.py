@@ -0,0 +1,148 @@
+import mmap
+import os
+import struct
+
+from codec import STR, VALUE, CodecError
+
+
+class Checkpoint:
+    """
+    Read-only view of a checkpoint file, memory-mapped and decoded lazily.
+
+    Layout: a header, then one record per key sorted by key, then an
+    index of record offsets in the same order.
+
+        header: magic, version, wal segment, record count, index offset
+        record: key, last_rd_txn, last_wr_txn, commit_txn, value
+        index:  u64 offset of every record
+
+    Opening only maps the file, a lookup binary searches the index and
+    touches O(log n) pages, so restart cost depends on the keys that are
+    actually read rather than on the size of the file.
+    """
+    MAGIC = b'DTCK'
+    VERSION = 1
+    HEADER = struct.Struct('!4sHQQQ')
+    OFFSET = struct.Struct('!Q')
+    STAMPS = struct.Struct('!qqq')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            # mmap cannot map an empty file, but a checkpoint is never empty
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.wal_segment, self.count, self._index = \
+            Checkpoint.HEADER.unpack_from(self._map, 0)
+        if magic != Checkpoint.MAGIC or version != Checkpoint.VERSION:
+            self._map.close()
+            raise CodecError(f'{path} is not a version '
+                             f'{Checkpoint.VERSION} checkpoint')
+
+    def __len__(self):
+        return self.count
+
+    def _offset(self, i):
+        return Checkpoint.OFFSET.unpack_from(
+            self._map, self._index + i * Checkpoint.OFFSET.size)[0]
+
+    def _raw_key(self, offset):
+        size, = struct.unpack_from('!I', self._map, offset)
+        return self._map[offset + 4:offset + 4 + size]
+
+    def _record(self, offset):
+        key, pos = STR.decode(self._map, offset)
+        last_rd_txn, last_wr_txn, commit_txn = \
+            Checkpoint.STAMPS.unpack_from(self._map, pos)
+        value, _ = VALUE.decode(self._map, pos + Checkpoint.STAMPS.size)
+        return key, value, last_rd_txn, last_wr_txn, commit_txn
+
+    def find(self, key):
+        """
+        Index of the first record whose key is >= key
+        """
+        raw = key.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw_key(self._offset(mid)) < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, key):
+        """
+        (key, value, last_rd_txn, last_wr_txn, commit_txn) or None
+        """
+        i = self.find(key)
+        if i == self.count:
+            return None
+        record = self._record(self._offset(i))
+        if record[0] != key:
+            return None
+        return record
+
+    def keys(self, start=0):
+        """
+        Iterate over the keys in order, from index start on, without
+        decoding their records
+        """
+        for i in range(start, self.count):
+            yield self._raw_key(self._offset(i)).decode('utf-8')
+
+    def records(self, start=0):
+        """
+        Iterate over the records in key order, from index start on
+        """
+        for i in range(start, self.count):
+            yield self._record(self._offset(i))
+
+    def close(self):
+        self._map.close()
+
+    @staticmethod
+    def write(path, records, wal_segment):
+        """
+        Write records, already sorted by key, to a new checkpoint at path.
+        The file only replaces path once it is complete and on disk
+        """
+        tmp_path = path + '.tmp'
+        offsets = []
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(Checkpoint.HEADER.size))
+
+            out = bytearray()
+            pos = Checkpoint.HEADER.size
+            for key, value, last_rd_txn, last_wr_txn, commit_txn in records:
+                offsets.append(pos + len(out))
+                STR.encode(key, out)
+                out += Checkpoint.STAMPS.pack(last_rd_txn, last_wr_txn,
+                                              commit_txn)
+                VALUE.encode(value, out)
+                if len(out) >= 1 << 20:
+                    f.write(out)
+                    pos += len(out)
+                    out = bytearray()
+            f.write(out)
+            pos += len(out)
+
+            index_offset = pos
+            index = bytearray()
+            for offset in offsets:
+                index += Checkpoint.OFFSET.pack(offset)
+            f.write(index)
+
+            f.seek(0)
+            f.write(Checkpoint.HEADER.pack(Checkpoint.MAGIC,
+                                           Checkpoint.VERSION, wal_segment,
+                                           len(offsets), index_offset))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+        directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
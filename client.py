@@ -1,47 +1,338 @@
 import asyncio
+import itertools
+import json
 import logging
-import pickle
 import socket
 import sys
+import time
 
+import framing
+from hlc import HybridClock
+import logs
 from messages import *
 import nodeslist
+from partition import HashRing
+from tracker import RequestTracker
 from ui import UI
 
 
+class TxnIDLease:
+    """
+    Block of txn ids leased from the coordinator and handed out locally.
+
+    The size of the next block follows the rate at which this client begins
+    transactions, aiming for roughly one coordinator round trip every
+    TARGET_PERIOD seconds. Unused ids expire after MAX_AGE seconds so that
+    an idle client does not start transactions with very old timestamps,
+    which would only get aborted by the servers.
+
+    Even a fresh block is contiguous, so while it lasts the ids of this
+    client fall further and further behind those other clients take from
+    the coordinator after it. Under contention this aborts a large share
+    of txns, fewer round trips to the coordinator rarely make up for it.
+    """
+    MIN_SIZE = 1
+    MAX_SIZE = 4096
+    TARGET_PERIOD = 0.5
+    MAX_AGE = 2.0
+    # weight of the newest sample in the begin interval average
+    ALPHA = 0.2
+
+    def __init__(self):
+        self._next = 0
+        self._end = 0
+        self._expires = 0.0
+
+        self._last_begin = None
+        self._avg_interval = None
+
+    def record_begin(self):
+        now = time.monotonic()
+        if self._last_begin is not None:
+            interval = now - self._last_begin
+            if self._avg_interval is None:
+                self._avg_interval = interval
+            else:
+                self._avg_interval += \
+                    TxnIDLease.ALPHA * (interval - self._avg_interval)
+        self._last_begin = now
+
+    def next_size(self):
+        if not self._avg_interval:
+            return TxnIDLease.MIN_SIZE
+        size = int(TxnIDLease.TARGET_PERIOD / self._avg_interval)
+        return max(TxnIDLease.MIN_SIZE, min(size, TxnIDLease.MAX_SIZE))
+
+    def take(self):
+        if self._next >= self._end or time.monotonic() > self._expires:
+            return None
+        txn_id = self._next
+        self._next += 1
+        return txn_id
+
+    def extend(self, first_txn_id, count):
+        # the coordinator only ever hands out increasing blocks, so ids
+        # stay monotonic even when we drop what is left of the old block
+        self._next = first_txn_id
+        self._end = first_txn_id + count
+        self._expires = time.monotonic() + TxnIDLease.MAX_AGE
+
+
+def prefix_end(prefix):
+    """
+    Smallest string above every string that starts with prefix, '' if there
+    is none
+    """
+    while prefix and ord(prefix[-1]) == sys.maxunicode:
+        prefix = prefix[:-1]
+    if not prefix:
+        return ''
+    code = ord(prefix[-1]) + 1
+    # surrogates cannot be encoded, skip over them
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+
 class ClientNetwork:
     PORT = 13337
     SELF_ADDR = socket.gethostbyname(socket.gethostname())
-
-    def __init__(self):
+    # lease blocks of txn ids instead of asking for every transaction. Off
+    # by default: the ids of a block fall below those other clients took
+    # meanwhile, so their txns are aborted much more often, see TxnIDLease
+    LEASE_TXN_IDS = False
+    # set to an id unique among all clients, 0 to HybridClock.MAX_NODE, to
+    # issue txn ids from a hybrid clock instead of the coordinator. Every
+    # client of the cluster has to do the same
+    CLOCK_ID = None
+    # connections per peer, and reconnect backoff bounds in seconds
+    POOL_SIZE = 4
+    BACKOFF_MIN = 0.1
+    BACKOFF_MAX = 10.0
+    # least seconds between two ring refreshes after refused operations
+    RING_REFRESH_MIN = 0.5
+    # spread the reads of read-only txns over a server and its backups
+    REPLICA_READS = True
+    # values larger than this, in bytes, are sent as chunks of this size
+    CHUNK_SIZE = 256 * 1024
+    # chunks of one value in flight at a time
+    CHUNK_WINDOW = 4
+    # values longer than this are sent zlib compressed, None to never
+    COMPRESS_THRESHOLD = 4096
+    COMPRESS_LEVEL = 6
+    # msg type -> only log one in every n of these sent or received
+    LOG_SAMPLING = {'GetMsg': 100, 'GetMsgResponse': 100,
+                    'SetMsg': 100, 'SetMsgResponse': 100,
+                    'BatchMsg': 100, 'BatchMsgResponse': 100,
+                    'SetChunkMsg': 100, 'SetChunkMsgResponse': 100,
+                    'GetChunkMsg': 100, 'GetChunkMsgResponse': 100}
+
+    def __init__(self, servers=None, coordinator=None, replicas=None,
+                 clock_id=None):
+        """
+        servers is a list of (host, name) or (host, name, port), replicas
+        of (host, name, primary name) or (host, name, primary name, port)
+        and coordinator a host or (host, port), all default to nodeslist.
+        clock_id defaults to CLOCK_ID
+        """
         self.evloop = asyncio.get_event_loop()
+        self.server_nodes = nodeslist.servers if servers is None else servers
+        self.replica_nodes = nodeslist.replicas if replicas is None \
+            else replicas
+        self.coordinator_node = coordinator or nodeslist.coordinator
+
+        self.txn_ids = TxnIDLease()
+        self._lease_lock = asyncio.Lock()
+        if clock_id is None:
+            clock_id = ClientNetwork.CLOCK_ID
+        self.clock = None if clock_id is None else HybridClock(clock_id)
 
-        # uuid4 -> (asyncio.Event, Response msg)
-        self._events = dict()
+        self.requests = RequestTracker()
 
         # server_name -> ClientNetwork.Peer
         self._servers = dict()
         self.coordinator = None  # type: ClientNetwork.Peer
+        # server_name -> [ClientNetwork.Peer] of its backups
+        self._replicas = dict()
+        self._next_reader = itertools.count()
 
-    def events(self):
-        return self._events
+        # ring bare keys are routed with, as last sent by the coordinator
+        self.ring = None  # type: HashRing
+        self.ring_version = -1
+        self._ring_refreshed = 0.0
+        self._ring_refresh = None  # type: asyncio.Future
+
+    def in_flight(self):
+        return len(self.requests)
 
     def servers(self):
         return self._servers
 
     async def connect_to_peers(self):
-        self.coordinator = ClientNetwork.Peer(nodeslist.coordinator, '',
-                                              self.request_handler)
+        host, port = self.coordinator_node, None
+        if isinstance(host, tuple):
+            host, port = host
+        self.coordinator = ClientNetwork.Peer(host, '', self.request_handler,
+                                              port)
         result = await self.coordinator.connect()
         if result is False:
             UI.log('!!! COORDINATOR NOT FOUND !!!', level=logging.CRITICAL)
 
-        for host, name in nodeslist.servers:
-            server = ClientNetwork.Peer(host, name, self.request_handler)
-            result = await server.connect()
+        # servers that are down are kept too, they get reconnected to
+        # when they are next used
+        for host, name, *port in self.server_nodes:
+            server = ClientNetwork.Peer(host, name, self.request_handler,
+                                        *port)
+            self._servers[name] = server
+
+        for host, name, primary, *port in self.replica_nodes:
+            replica = ClientNetwork.Peer(host, name, self.request_handler,
+                                         *port)
+            self._replicas.setdefault(primary, []).append(replica)
+
+        await asyncio.gather(*[peer.connect() for peer in self.peers()])
+
+        if self.coordinator.connected():
+            await self.refresh_ring()
+        # with a clock we only need the coordinator for the ring, so do
+        # without it: servers refuse keys they no longer own, and we ask
+        # for the ring again then
+        if self.ring is None and self.clock is not None:
+            self.ring = HashRing([name for _, name, *_ in self.server_nodes])
+
+    def add_servers(self, nodes):
+        """
+        Know about every (name, host, port) in nodes, port 0 being the
+        default. New servers are connected to when first used
+        """
+        for name, host, port in nodes:
+            if name not in self._servers:
+                self._servers[name] = ClientNetwork.Peer(
+                    host, name, self.request_handler, port or None)
+
+    def set_ring(self, response):
+        """
+        Route with the ring in a RingMsgResponse, unless we have a newer one
+        """
+        if response.version >= self.ring_version:
+            self.add_servers(response.nodes)
+            self.ring = HashRing([name for name, _, _ in response.nodes],
+                                 response.vnodes)
+            self.ring_version = response.version
+        return self.ring
+
+    async def refresh_ring(self):
+        """
+        Fetch the ring from the coordinator, None if it did not answer
+        """
+        self._ring_refreshed = time.monotonic()
+        response = await self.request(self.coordinator, RingMsg())
+        if response is None:
+            return None
+        return self.set_ring(response)
+
+    def ring_stale(self):
+        """
+        Refresh the ring in the background, an operation was refused and
+        the key might have moved
+        """
+        if self._ring_refresh is not None and not self._ring_refresh.done():
+            return
+        if time.monotonic() - self._ring_refreshed < \
+                ClientNetwork.RING_REFRESH_MIN:
+            return
+        self._ring_refresh = asyncio.ensure_future(self.refresh_ring())
 
-            if result is True:
-                self._servers[name] = server
+    def owner(self, key):
+        """
+        Name of the server key is routed to, None if we have no ring
+        """
+        if self.ring is None:
+            return None
+        return self.ring.owner(key)
+
+    def peers(self):
+        """
+        Every server and backup
+        """
+        peers = list(self._servers.values())
+        for replicas in self._replicas.values():
+            peers.extend(replicas)
+        return peers
+
+    def peer(self, name):
+        """
+        Server or backup called name, None if there is none
+        """
+        for peer in self.peers():
+            if peer.name == name:
+                return peer
+        return None
+
+    def reader(self, server_name):
+        """
+        Peer to send a read-only txn's reads for server_name to, taking
+        turns between the server and its backups. A txn asks once per
+        server and keeps reading there
+        """
+        replicas = self._replicas.get(server_name, None)
+        if not replicas or not ClientNetwork.REPLICA_READS:
+            return self._servers[server_name]
+        index = next(self._next_reader) % (len(replicas) + 1)
+        if index == len(replicas):
+            return self._servers[server_name]
+        return replicas[index]
+
+    def close(self):
+        if self.coordinator is not None:
+            self.coordinator.close()
+        for peer in self.peers():
+            peer.close()
+
+    async def next_txn_id(self):
+        """
+        Get a txn id for a new transaction, None if coordinator timed out
+        """
+        if self.clock is not None:
+            return self.clock.now()
+
+        if not ClientNetwork.LEASE_TXN_IDS:
+            response = await self._request_txn_ids(RequestTxnID())
+            return None if response is None else response.txn_id
+
+        self.txn_ids.record_begin()
+        async with self._lease_lock:
+            txn_id = self.txn_ids.take()
+            if txn_id is None:
+                request = RequestTxnIDBlock(self.txn_ids.next_size())
+                response = await self._request_txn_ids(request)
+                if response is None:
+                    return None
+                self.txn_ids.extend(response.first_txn_id, response.count)
+                txn_id = self.txn_ids.take()
+        return txn_id
+
+    async def _request_txn_ids(self, msg):
+        return await self.request(self.coordinator, msg)
+
+    async def request(self, peer, msg, timeout=3):
+        """
+        Send msg to peer and wait for its response, None on timeout
+        """
+        if not await peer.ready():
+            UI.log(f'{peer.host} is down, not sending {msg.type()}',
+                   level=logging.ERROR)
+            return None
+
+        # uid is assigned by send(), register right after it
+        if not peer.send(msg):
+            return None
+        future = self.requests.track((peer.name, msg.uid), timeout)
+        try:
+            return await future
+        except asyncio.TimeoutError:
+            UI.log(f'Failed to send {msg.type()}!', level=logging.ERROR)
+            return None
 
     def request_handler(self, msg):
         cls = msg.__class__.__name__
@@ -49,82 +340,186 @@ class ClientNetwork:
 
         if handler is None:
             UI.log(f'Dont recognize msg {cls}', level=logging.WARNING)
-        else:
-            UI.log(f'Got {str(msg)}')
-            handler(msg)
+            return
+
+        UI.log('Got %s', msg, sample=msg.type())
+        # stay close to the clocks of the servers, so our txns are not
+        # much older than those of other clients
+        clock = getattr(msg, 'clock', None)
+        if self.clock is not None and clock:
+            self.clock.update(clock)
+        handler(msg)
 
     def handle_NewTxnID(self, msg):
-        orig_uid = msg.orig_uid
-        event, _ = self._events[orig_uid]
-        response = msg
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
 
-        self._events[orig_uid] = event, response
-        event.set()
+    def handle_NewTxnIDBlock(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
 
     def handle_SetMsgResponse(self, msg):
-        orig_uid = msg.orig_uid
-        event, _ = self._events[orig_uid]
-        response = msg
-
-        self._events[orig_uid] = event, response
-        event.set()
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
 
     def handle_GetMsgResponse(self, msg):
-        orig_uid = msg.orig_uid
-        event, _ = self._events[orig_uid]
-        response = msg
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_SetChunkMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
 
-        self._events[orig_uid] = event, response
-        event.set()
+    def handle_GetChunkMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
 
     def handle_TryCommitMsgResponse(self, msg):
-        orig_uid = msg.orig_uid
-        event, _ = self._events[orig_uid]
-        response = msg
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
 
-        self._events[orig_uid] = event, response
-        event.set()
+    def handle_DoCommitMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_BatchMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_CommitOneMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_ScanMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_StatsMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_RingMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_ExportKeysMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_ImportKeysMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
+
+    def handle_DropKeysMsgResponse(self, msg):
+        self.requests.resolve((msg.origin, msg.orig_uid), msg)
 
 
     class Peer:
-        def __init__(self, host, name, req_handler):
+        """
+        Pool of up to POOL_SIZE connections to one node.
+
+        Messages are spread round robin over the connections that are up.
+        Connections that drop are reopened lazily, the next time the peer
+        is used, and failed attempts back off exponentially from
+        BACKOFF_MIN up to BACKOFF_MAX seconds so that a dead node is not
+        hammered with connects.
+        """
+
+        def __init__(self, host, name, req_handler, port=None):
             self.evloop = asyncio.get_event_loop()
             self.host = host
+            self.port = port or ClientNetwork.PORT
             self.name = name
             self.request_handler = req_handler
-            self.transport = None
-            self.protocol = None
-
-        async def connect(self):
+            # uids only need to be unique per peer, responses echo them back
+            # on the connection the request was sent on
+            self._seq = itertools.count(1)
+
+            # ClientNetwork.ClientProtocol of every connection that is up
+            self._conns = []
+            self._next_conn = itertools.count()
+            self._connecting = None  # type: asyncio.Future
+            self._backoff = 0.0
+            self._retry_at = 0.0
+
+        def connected(self):
+            return len(self._conns) > 0
+
+        def connect(self):
+            """
+            Open connections until the pool is full, the returned future is
+            True if at least one connection is up
+            """
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self._fill())
+                self._connecting.add_done_callback(self._connect_done)
+            return asyncio.shield(self._connecting)
+
+        def _connect_done(self, _):
+            self._connecting = None
+
+        async def _fill(self):
             UI.log(f'Trying connect to {self.host}')
-            nodeip = socket.gethostbyname(self.host)
             try:
-                transport, proto = await self.evloop.create_connection(
-                    lambda: ClientNetwork.ClientProtocol(self.request_handler),
-                    host=nodeip, port=ClientNetwork.PORT, family=socket.AF_INET
-                )
-            except ConnectionRefusedError:
-                UI.log(f'Could not connect to {self.host}',
-                       level=logging.WARNING)
-                return False
+                nodeip = socket.gethostbyname(self.host)
+                while len(self._conns) < ClientNetwork.POOL_SIZE:
+                    _, proto = await self.evloop.create_connection(
+                        lambda: ClientNetwork.ClientProtocol(
+                            self.request_handler, self.name, self._lost),
+                        host=nodeip, port=self.port,
+                        family=socket.AF_INET
+                    )
+                    self._conns.append(proto)
+            except OSError as e:
+                self._backoff = min(max(2 * self._backoff,
+                                        ClientNetwork.BACKOFF_MIN),
+                                    ClientNetwork.BACKOFF_MAX)
+                self._retry_at = time.monotonic() + self._backoff
+                UI.log(f'Could not connect to {self.host}: {e}, retrying in '
+                       f'{self._backoff:.1f}s', level=logging.WARNING)
             else:
-                self.transport = transport
-                self.protocol = proto
-                return True
+                self._backoff = 0.0
+            return self.connected()
+
+        def _lost(self, proto):
+            if proto in self._conns:
+                self._conns.remove(proto)
+
+        def _refill(self):
+            # reconnect in the background, unless we are backing off
+            if self._connecting is None and \
+                    time.monotonic() >= self._retry_at:
+                self.connect()
+
+        async def ready(self):
+            """
+            True if the peer can be sent to, reconnecting first if every
+            connection is down and we are not backing off
+            """
+            if len(self._conns) < ClientNetwork.POOL_SIZE:
+                if self.connected():
+                    self._refill()
+                elif time.monotonic() >= self._retry_at:
+                    return await self.connect()
+            return self.connected()
 
         def send(self, msg):
+            """
+            Send msg on the next connection that is up, False if none is
+            """
+            if not self.connected():
+                UI.log(f'No connection to {self.host}, dropping {msg.type()}',
+                       level=logging.ERROR)
+                self._refill()
+                return False
+
+            proto = self._conns[next(self._next_conn) % len(self._conns)]
+            msg.uid = next(self._seq) & 0xFFFFFFFF
             msg.origin = ClientNetwork.SELF_ADDR
-            msg.destination = self.protocol.peer
+            msg.destination = proto.peer
 
-            UI.log(f'Sending {str(msg)}')
-            pickled = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
-            self.transport.write(pickled)
+            UI.log('Sending %s', msg, sample=msg.type())
+            proto.transport.write(framing.pack(CODEC.encode(msg)))
+            return True
+
+        def close(self):
+            for proto in list(self._conns):
+                proto.transport.close()
+            self._conns = []
 
 
     class ClientProtocol(asyncio.Protocol):
-        def __init__(self, req_handler):
+        def __init__(self, req_handler, name, on_lost=None):
             self.evloop = asyncio.get_event_loop()
             self.req_handler = req_handler
+            self.name = name
+            self.on_lost = on_lost
+            self.decoder = framing.FrameDecoder()
             UI.log('Created protocol!')
 
         def connection_made(self, transport):
@@ -134,30 +529,614 @@ class ClientNetwork:
 
         def connection_lost(self, exc):
             UI.log(f'Connection lost with {str(self.peer)}')
+            if self.on_lost is not None:
+                self.on_lost(self)
             super().connection_lost(exc)
 
         def data_received(self, data):
-            UI.log(f'Got data from {self.peer}')
-            unpickled = pickle.loads(data)
-            self.req_handler(unpickled)
+            UI.log('Got data from %s', self.peer, level=logging.DEBUG)
+            try:
+                frames = self.decoder.feed(data)
+            except framing.FrameError as e:
+                UI.log(f'Bad frame from {self.peer}: {e}',
+                       level=logging.ERROR)
+                self.transport.close()
+                return
+
+            for frame in frames:
+                try:
+                    msg = CODEC.decode(frame)
+                except CodecError as e:
+                    UI.log(f'Bad message from {self.peer}: {e}',
+                           level=logging.ERROR)
+                    self.transport.close()
+                    return
+
+                # responses are matched on (peer name, uid)
+                msg.origin = self.name
+                self.req_handler(msg)
 
         def eof_received(self):
             pass
 
 
+def compress(value):
+    """
+    value Compressed if it is longer than COMPRESS_THRESHOLD and
+    compressing makes it smaller, otherwise value itself
+    """
+    threshold = ClientNetwork.COMPRESS_THRESHOLD
+    if threshold is None or len(value) <= threshold or \
+            isinstance(value, Compressed):
+        return value
+    compressed = Compressed.compress(value, ClientNetwork.COMPRESS_LEVEL)
+    return compressed if len(compressed) < len(value) else value
+
+
+def decompress(value):
+    if isinstance(value, Compressed):
+        return value.decompress()
+    return value
+
+
+class TransactionError(Exception):
+    pass
+
+
+class TransactionAborted(TransactionError):
+    pass
+
+
+class Transaction:
+    """
+    A single transaction over a (shared) ClientNetwork.
+
+    Any number of transactions can run concurrently on one network, each
+    has its own txn id and servers keep their writes apart. Use it as an
+    async context manager to begin it, and to commit it on success or
+    abort it if the block raises:
+
+        async with client.transaction() as txn:
+            value = await txn.get('key')
+            await txn.set('other', value)
+
+    Keys go to the server the partition ring assigns them to, unless a
+    server_name is given. A server refusing an operation aborts the txn
+    and raises TransactionAborted, a server not answering raises
+    TransactionError.
+    """
+    # keys asked for per ScanMsg
+    SCAN_PAGE = 1000
+
+    def __init__(self, network, readonly=False):
+        self.network = network
+        self.readonly = readonly
+        self.txn_id = -1
+
+        # names of the servers we wrote to, only they take part in commit,
+        # -> the keys we wrote there
+        self.servers = dict()
+        # names of the servers a writing txn read from, those we did not
+        # write to are released when the txn ends
+        self.read_from = set()
+        # server_name -> peer the reads of a read-only txn go to
+        self.readers = dict()
+
+        # server_name -> [(op, key, value)] waiting for flush()
+        self.queued_ops = dict()
+        # (server_name, index into queued_ops) in the order ops were queued
+        self.queued_order = []
+
+    def active(self):
+        return self.txn_id != -1
+
+    async def __aenter__(self):
+        if not self.active():
+            await self.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.active():
+            if exc_type is None:
+                await self.commit()
+            else:
+                await self.abort()
+        return False
+
+    async def begin(self):
+        """
+        Take a txn id from the clock, or from the lease, calling the
+        coordinator when it runs out
+        """
+        if self.active():
+            raise TransactionError('Ongoing transaction!')
+
+        txn_id = await self.network.next_txn_id()
+        if txn_id is None:
+            raise TransactionError('Could not get a txn id!')
+        self.txn_id = txn_id
+        return self
+
+    async def set(self, key, value, server_name=None):
+        """
+        Call SET on server, deliver value
+        """
+        self._check_writable()
+        server_name = self._route(key, server_name)
+        server = self._server(server_name)
+
+        value = compress(value)
+        kind = VALUE.kind(value)
+        if kind == VALUE.KIND_STR:
+            data = value.encode('utf-8')
+        elif kind == VALUE.KIND_COMPRESSED:
+            data = value.data
+        else:
+            data = value
+        if len(data) > ClientNetwork.CHUNK_SIZE:
+            self.servers.setdefault(server_name, set()).add(key)
+            if not await self._set_chunks(server, key, data, kind):
+                await self._refused(f'SET {server_name}.{key} refused')
+            return
+
+        set_msg = SetMsg(self.txn_id, key, value)
+        response = await self._request(server, set_msg)
+        self.servers.setdefault(server_name, set()).add(key)
+
+        if not response.success:
+            await self._refused(f'SET {server_name}.{key} refused')
+
+    async def _set_chunks(self, server, key, data, kind):
+        """
+        Send a large value as SetChunkMsgs, CHUNK_WINDOW at a time. False
+        if the server refused one
+        """
+        # chunks are views of data, encoded without copying them first
+        view = memoryview(data)
+        offsets = range(0, len(data), ClientNetwork.CHUNK_SIZE)
+        for start in range(0, len(offsets), ClientNetwork.CHUNK_WINDOW):
+            window = offsets[start:start + ClientNetwork.CHUNK_WINDOW]
+            responses = await asyncio.gather(*[
+                self._request(server, SetChunkMsg(
+                    self.txn_id, key, len(data), offset,
+                    view[offset:offset + ClientNetwork.CHUNK_SIZE], kind))
+                for offset in window])
+            if not all(response.success for response in responses):
+                return False
+        return True
+
+    async def get(self, key, server_name=None):
+        """
+        Call GET on server, returns the value or None if key does not exist
+        """
+        self._check_active()
+        server_name = self._route(key, server_name)
+        server = self._server(server_name)
+
+        get_msg = GetMsg(self.txn_id, key, self.readonly)
+        if self.readonly:
+            response = await self._read(server_name, get_msg,
+                                        lambda response: response.success)
+        else:
+            self.read_from.add(server_name)
+            response = await self._request(server, get_msg)
+
+        if not response.success:
+            await self._refused(f'GET {server_name}.{key} refused')
+        if response.size > len(response.value):
+            # the rest comes from whoever sent the first chunk
+            value = await self._get_chunks(response.origin, key,
+                                           response.value, response.size)
+            if value is None:
+                await self._refused(f'GET {server_name}.{key} refused')
+            return decompress(value)
+        return decompress(response.value) if response.value else None
+
+    async def _get_chunks(self, peer_name, key, first, size):
+        """
+        Fetch the rest of a large value of size after its first chunk,
+        CHUNK_WINDOW chunks at a time. first is empty when the reply had
+        no room left for it. None if the server refused one
+        """
+        peer = self.network.peer(peer_name)
+        if not first:
+            response = await self._request(
+                peer, GetChunkMsg(self.txn_id, key, 0, self.readonly))
+            if not response.success or not response.value:
+                return None
+            first = response.value
+        chunk_size = len(first)
+        offsets = range(chunk_size, size, chunk_size)
+        parts = [first]
+        for start in range(0, len(offsets), ClientNetwork.CHUNK_WINDOW):
+            window = offsets[start:start + ClientNetwork.CHUNK_WINDOW]
+            responses = await asyncio.gather(*[
+                self._request(peer, GetChunkMsg(self.txn_id, key, offset,
+                                                self.readonly))
+                for offset in window])
+            if not all(response.success for response in responses):
+                return None
+            parts.extend(response.value for response in responses)
+        if isinstance(parts[0], str):
+            return ''.join(parts)
+        if isinstance(parts[0], Compressed):
+            return Compressed(b''.join(part.data for part in parts))
+        return b''.join(parts)
+
+    async def scan(self, start='', end='', limit=None, prefix=None,
+                   server_name=None):
+        """
+        [(key, value)] of the keys from start on and before end, or to the
+        last key if end is '', or of the keys starting with prefix. In key
+        order and at most limit of them. Every server of the ring is
+        scanned, unless server_name is given.
+
+        The whole range counts as read, keys that do not exist yet
+        included: an older txn can no longer write into it
+        """
+        self._check_active()
+        if prefix is not None:
+            start, end = prefix, prefix_end(prefix)
+        if server_name is not None:
+            server_names = [server_name]
+        elif self.network.ring is not None:
+            server_names = self.network.ring.servers()
+        else:
+            raise TransactionError('No partition ring, name the server!')
+
+        pages = await asyncio.gather(*[
+            self._scan(server_name, start, end, limit)
+            for server_name in server_names])
+        for server_name, records in zip(server_names, pages):
+            if records is None:
+                await self._refused(f'SCAN on {server_name} refused')
+
+        records = sorted(itertools.chain.from_iterable(pages),
+                         key=lambda record: record[0])
+        return records if limit is None else records[:limit]
+
+    async def _scan(self, server_name, start, end, limit):
+        """
+        Page through the range on one server, None if it refused
+        """
+        server = self._server(server_name)
+        records = []
+        while limit is None or len(records) < limit:
+            page = Transaction.SCAN_PAGE
+            if limit is not None:
+                page = min(page, limit - len(records))
+
+            scan_msg = ScanMsg(self.txn_id, start, end, page, self.readonly)
+            if self.readonly:
+                response = await self._read(
+                    server_name, scan_msg, lambda response: response.success)
+            else:
+                self.read_from.add(server_name)
+                response = await self._request(server, scan_msg)
+            if not response.success:
+                return None
+
+            for key, value, size in response.records:
+                if size > len(value):
+                    value = await self._get_chunks(response.origin, key,
+                                                   value, size)
+                    if value is None:
+                        return None
+                records.append((key, decompress(value)))
+            if response.done:
+                break
+            start = response.next_key
+        return records
+
+    def queue_get(self, key, server_name=None):
+        """
+        Queue a GET to be sent by the next flush()
+        """
+        self._queue(self._route(key, server_name), (BatchMsg.OP_GET, key, ''))
+
+    def queue_set(self, key, value, server_name=None):
+        """
+        Queue a SET to be sent by the next flush()
+        """
+        self._queue(self._route(key, server_name),
+                    (BatchMsg.OP_SET, key, compress(value)))
+
+    def _queue(self, server_name, op):
+        ops = self.queued_ops.setdefault(server_name, [])
+        self.queued_order.append((server_name, len(ops)))
+        ops.append(op)
+
+    async def flush(self):
+        """
+        Send all queued ops as one BatchMsg per server, to all servers in
+        parallel. Returns the result of every op in the order they were
+        queued: the value for gets ('' if not found), '' for sets
+        """
+        queued_ops, self.queued_ops = self.queued_ops, dict()
+        queued_order, self.queued_order = self.queued_order, []
+        return await self._batch(queued_ops, queued_order)
+
+    async def get_many(self, keys, server_names=None):
+        """
+        Values of keys, read from all servers involved in parallel, in the
+        same order, None for keys that do not exist. server_names can name
+        the server of each key, None entries are routed by the ring
+        """
+        if server_names is None:
+            server_names = [None] * len(keys)
+
+        ops = dict()
+        order = []
+        for key, server_name in zip(keys, server_names):
+            server_name = self._route(key, server_name)
+            server_ops = ops.setdefault(server_name, [])
+            order.append((server_name, len(server_ops)))
+            server_ops.append((BatchMsg.OP_GET, key, ''))
+
+        values = await self._batch(ops, order)
+        return [value if value else None for value in values]
+
+    async def _batch(self, queued_ops, queued_order):
+        """
+        Run queued_ops, server_name -> [(op, key, value)], and return their
+        results in queued_order, see flush()
+        """
+        self._check_active()
+        has_sets = {server_name: any(op == BatchMsg.OP_SET
+                                     for op, _, _ in ops)
+                    for server_name, ops in queued_ops.items()}
+        if any(has_sets.values()):
+            self._check_writable()
+        servers = [self._server(server_name) for server_name in queued_ops]
+
+        requests = []
+        for server, ops in zip(servers, queued_ops.values()):
+            batch_msg = BatchMsg(self.txn_id, ops, self.readonly)
+            if self.readonly:
+                requests.append(self._read(
+                    server.name, batch_msg,
+                    lambda response: all(success for success, _, _
+                                         in response.results)))
+            else:
+                self.read_from.add(server.name)
+                requests.append(self._request(server, batch_msg))
+            if has_sets[server.name]:
+                self.servers.setdefault(server.name, set()).update(
+                    key for op, key, _ in ops if op == BatchMsg.OP_SET)
+
+        responses = await asyncio.gather(*requests)
+
+        results = dict()
+        for server_name, response in zip(queued_ops.keys(), responses):
+            if not all(success for success, _, _ in response.results):
+                await self._refused(f'Batch on {server_name} refused')
+            values = []
+            for (_, key, _), (_, value, size) in zip(
+                    queued_ops[server_name], response.results):
+                if size > len(value):
+                    value = await self._get_chunks(response.origin, key,
+                                                   value, size)
+                    if value is None:
+                        await self._refused(
+                            f'Batch on {server_name} refused')
+                values.append(decompress(value))
+            results[server_name] = values
+
+        return [results[server_name][index]
+                for server_name, index in queued_order]
+
+    async def commit(self):
+        """
+        Commit on all servers we wrote to, raises TransactionAborted if
+        any of them refused, and TransactionError if a server did not
+        confirm the commit, so that we do not know whether it committed
+        """
+        self._check_active()
+
+        if len(self.servers) == 1:
+            success = await self._commit_one(next(iter(self.servers)))
+        else:
+            success = await self._commit_two_phase()
+
+        self._release()
+        self._reset()
+        if success is None:
+            raise TransactionError('COMMIT timed out, outcome unknown')
+        if not success:
+            self.network.ring_stale()
+            raise TransactionAborted('COMMIT refused')
+
+    async def _commit_one(self, server_name):
+        """
+        Validate and apply in a single round, only one server is involved.
+        None if it did not answer
+        """
+        writes = len(self.servers[server_name])
+        commit_msg = CommitOneMsg(self.txn_id, writes)
+        server = self.network.servers()[server_name]
+        response = await self.network.request(server, commit_msg)
+
+        if response is None:
+            # the server may have committed already, an abort would not
+            # undo that, and it drops the txn itself otherwise
+            return None
+        # on failure the server already dropped the buffer
+        return response.success
+
+    async def _commit_two_phase(self):
+        """
+        Vote, then commit everywhere. None if a server did not confirm
+        """
+        servers = [self.network.servers()[server_name]
+                   for server_name in self.servers]
+
+        # send a TryCommitMsg to all servers involved in current txn
+        responses = await asyncio.gather(*[
+            self.network.request(server, TryCommitMsg(
+                self.txn_id, len(self.servers[server.name])))
+            for server in servers])
+
+        success = all(response is not None and response.success
+                      for response in responses)
+        if not success:
+            for server in servers:
+                server.send(AbortMsg(self.txn_id))
+            return False
+
+        # committed once every server has it in its log, as for CommitOne
+        responses = await asyncio.gather(*[
+            self.network.request(server, DoCommitMsg(self.txn_id))
+            for server in servers])
+        if None in responses:
+            return None
+        return True
+
+    async def abort(self):
+        """
+        Abort on all servers we wrote to
+        """
+        self._check_active()
+
+        # send a AbortMsg to all servers involved in current txn
+        for server_name in self.servers:
+            abort_msg = AbortMsg(self.txn_id)
+            self.network.servers()[server_name].send(abort_msg)
+
+        self._release()
+        self._reset()
+
+    def _release(self):
+        # servers we only read from would keep the txn until its lease ran
+        # out, holding back their GC and closed timestamp
+        for server_name in self.read_from.difference(self.servers):
+            self.network.servers()[server_name].send(
+                ReleaseMsg(self.txn_id))
+
+    async def _refused(self, reason):
+        await self.abort()
+        # keys that moved to another server are refused too
+        self.network.ring_stale()
+        raise TransactionAborted(reason)
+
+    def _reset(self):
+        self.txn_id = -1
+        self.servers = dict()
+        self.read_from = set()
+        self.readers = dict()
+        self.queued_ops = dict()
+        self.queued_order = []
+
+    def _check_active(self):
+        if not self.active():
+            raise TransactionError('Call BEGIN first!')
+
+    def _check_writable(self):
+        self._check_active()
+        if self.readonly:
+            raise TransactionError('Transaction is READONLY!')
+
+    def _route(self, key, server_name):
+        if server_name is not None:
+            return server_name
+        server_name = self.network.owner(key)
+        if server_name is None:
+            raise TransactionError('No partition ring, name the server!')
+        return server_name
+
+    def _server(self, server_name):
+        server = self.network.servers().get(server_name, None)
+        if server is None:
+            raise ValueError(f'"{server_name}" does not exist!')
+        return server
+
+    async def _read(self, server_name, msg, succeeded):
+        """
+        Send a read of a read-only txn to a server or one of its backups,
+        the same for the whole txn. A backup that is behind the snapshot
+        refuses, then the server is asked, from then on only it
+        """
+        server = self.network.servers()[server_name]
+        reader = self.readers.get(server_name, None)
+        if reader is None:
+            reader = self.network.reader(server_name)
+            self.readers[server_name] = reader
+        if reader is not server:
+            response = await self.network.request(reader, msg)
+            if response is not None and succeeded(response):
+                return response
+            self.readers[server_name] = server
+        return await self._request(server, msg)
+
+    async def _request(self, server, msg):
+        response = await self.network.request(server, msg)
+        if response is None:
+            # SHOULD NEVER HAPPEN
+            raise TransactionError(f'{msg.type()} to {server.name} timed out')
+        return response
+
+
+class TransactionClient:
+    """
+    Importable asyncio client, all transactions share its connections
+
+        client = TransactionClient()
+        await client.connect()
+        async with client.transaction() as txn:
+            ...
+    """
+
+    def __init__(self, servers=None, coordinator=None, replicas=None,
+                 clock_id=None):
+        self.network = ClientNetwork(servers, coordinator, replicas, clock_id)
+
+    async def connect(self):
+        await self.network.connect_to_peers()
+
+    def close(self):
+        self.network.close()
+
+    def servers(self):
+        return self.network.servers()
+
+    async def stats(self, server_name=None):
+        """
+        Metrics of a server or backup, or of the coordinator if server_name
+        is None. None if the node did not answer
+        """
+        if server_name is None:
+            peer = self.network.coordinator
+        else:
+            peer = self.network.peer(server_name)
+            if peer is None:
+                raise ValueError(f'"{server_name}" does not exist!')
+
+        response = await self.network.request(peer, StatsMsg())
+        if response is None:
+            return None
+        return json.loads(response.stats)
+
+    def transaction(self, readonly=False):
+        """
+        New transaction, begun on entering it with async with or by
+        calling begin()
+        """
+        return Transaction(self.network, readonly)
+
+
 class Client:
     def __init__(self):
         self.ui = UI()
-        self.network = ClientNetwork()
+        self.client = TransactionClient()
+        self.network = self.client.network
 
-        self.curr_txn = -1
-        self.curr_txn_servers = dict()
+        # the one transaction the REPL works on, None if there is none
+        self.txn = None  # type: Transaction
 
-        for server in self.network.servers().keys():
-            self.curr_txn_servers[server] = False
+    def in_txn(self):
+        return self.txn is not None and self.txn.active()
 
     async def loop(self):
-        await self.network.connect_to_peers()
+        await self.client.connect()
 
         try:
             while True:
@@ -181,29 +1160,24 @@ class Client:
 
     async def cmd_begin(self, data):
         """
-        Call coordinator, receive message id
+        Start a txn. BEGIN READONLY starts a txn that only reads a
+        committed snapshot and needs no commit round
         """
-        if len(data) != 0:
-            self.ui.output(f'Invalid! Usage: BEGIN')
+        readonly = [word.upper() for word in data] == ['READONLY']
+        if len(data) != 0 and not readonly:
+            self.ui.output(f'Invalid! Usage: BEGIN [READONLY]')
             return
-        if self.curr_txn != -1:
+        if self.in_txn():
             self.ui.output('Invalid! Ongoing transaction!')
             return
 
-        txn_id_msg = RequestTxnID()
-        event = asyncio.Event()
-        self.network.events()[txn_id_msg.uid] = event, None
-
-        self.network.coordinator.send(txn_id_msg)
+        txn = self.client.transaction(readonly)
         try:
-            await asyncio.wait_for(event.wait(), 3)
-        except asyncio.TimeoutError:
-            UI.log('Failed to send RequestTxnID!', level=logging.ERROR)
+            await txn.begin()
+        except TransactionError as e:
+            UI.log(f'Failed to BEGIN: {e}', level=logging.ERROR)
             return
-
-        response = self.network.events()[txn_id_msg.uid][1]
-        # del self.network.events()[txn_id_msg.uid]
-        self.curr_txn = response.txn_id
+        self.txn = txn
 
         self.ui.output('OK')
 
@@ -212,86 +1186,148 @@ class Client:
         Call SET on server, deliver value
         """
         if len(data) < 2:
-            self.ui.output(f'Invalid! Usage: SET <server>.<key> <value>')
+            self.ui.output(f'Invalid! Usage: SET [<server>.]<key> <value>')
             return
-        if self.curr_txn == -1:
+        if not self.in_txn():
             self.ui.output(f'Invalid! Call BEGIN first!')
             return
+        if self.txn.readonly:
+            self.ui.output(f'Invalid! Transaction is READONLY!')
+            return
 
-        server_name, key = data[0].split('.')
+        server_name, key = self._locate(data[0])
         value = ' '.join(data[1:])
+        if key is None:
+            return
 
-        set_msg = SetMsg(self.curr_txn, key, value)
+        try:
+            await self.txn.set(key, value, server_name)
+        except TransactionAborted:
+            self.ui.output('ABORT')
+        except TransactionError as e:
+            UI.log(f'Failed to SET: {e}', level=logging.ERROR)
+            self.ui.output('FAILED')
+        else:
+            self.ui.output('OK')
 
-        server = self.network.servers().get(server_name, None)
-        if server is None:
-            self.ui.output(f'Invalid! "{server_name}" does not exist!')
+    async def cmd_get(self, data):
+        """
+        Call GET on server, display value
+        """
+        if len(data) != 1:
+            self.ui.output(f'Invalid! Usage: GET [<server>.]<key>')
+            return
+        if not self.in_txn():
+            self.ui.output(f'Invalid! Call BEGIN first!')
             return
 
-        event = asyncio.Event()
-        self.network.events()[set_msg.uid] = event, None
+        server_name, key = self._locate(data[0])
+        if key is None:
+            return
 
-        server.send(set_msg)
         try:
-            await asyncio.wait_for(event.wait(), 3)
-        except asyncio.TimeoutError:
-            # SHOULD NEVER HAPPEN
-            UI.log('Failed to send SetMsg!', level=logging.ERROR)
+            value = await self.txn.get(key, server_name)
+        except TransactionAborted:
+            self.ui.output('ABORT')
+            return
+        except TransactionError as e:
+            UI.log(f'Failed to GET: {e}', level=logging.ERROR)
             self.ui.output('FAILED')
             return
 
-        self.curr_txn_servers[server_name] = True
-        response = self.network.events()[set_msg.uid][1]
-        # del self.network.events()[set_msg.uid]
-
-        if response.success:
-            self.ui.output('OK')
+        if value is not None:
+            self.ui.output(f'{data[0]} = {value}')
         else:
-            await self.cmd_abort(list())
+            await self.txn.abort()
+            self.ui.output('NOT FOUND')
 
-    async def cmd_get(self, data):
+    async def cmd_mget(self, data):
         """
-        Call GET on server, display value
+        Call GET on every key at once, on all their servers in parallel
         """
-        if len(data) != 1:
-            self.ui.output(f'Invalid! Usage: GET <server>.<key>')
+        if len(data) < 1:
+            self.ui.output(f'Invalid! Usage: MGET [<server>.]<key> ...')
             return
-        if self.curr_txn == -1:
+        if not self.in_txn():
             self.ui.output(f'Invalid! Call BEGIN first!')
             return
 
-        server_name, key = data[0].split('.')
+        located = [self._locate(name) for name in data]
+        if any(key is None for _, key in located):
+            return
 
-        get_msg = GetMsg(self.curr_txn, key)
+        try:
+            values = await self.txn.get_many(
+                [key for _, key in located],
+                [server_name for server_name, _ in located])
+        except TransactionAborted:
+            self.ui.output('ABORT')
+            return
+        except TransactionError as e:
+            UI.log(f'Failed to MGET: {e}', level=logging.ERROR)
+            self.ui.output('FAILED')
+            return
 
-        server = self.network.servers().get(server_name, None)
-        if server is None:
-            self.ui.output(f'Invalid! "{server_name}" does not exist!')
+        if None in values:
+            await self.txn.abort()
+            self.ui.output('NOT FOUND')
             return
+        for name, value in zip(data, values):
+            self.ui.output(f'{name} = {value}')
 
-        event = asyncio.Event()
-        self.network.events()[get_msg.uid] = event, None
+    async def cmd_scan(self, data):
+        """
+        Show every key starting with prefix, on all servers or one
+        """
+        if len(data) > 2 or (len(data) == 2 and not data[1].isdigit()):
+            self.ui.output(f'Invalid! Usage: SCAN [<server>.][<prefix>] '
+                           f'[<limit>]')
+            return
+        if not self.in_txn():
+            self.ui.output(f'Invalid! Call BEGIN first!')
+            return
+
+        server_name, prefix = self._locate(data[0] if data else '')
+        if prefix is None:
+            return
+        limit = int(data[1]) if len(data) == 2 else None
 
-        server.send(get_msg)
         try:
-            await asyncio.wait_for(event.wait(), 3)
-        except asyncio.TimeoutError:
-            # SHOULD NEVER HAPPEN
-            UI.log('Failed to send GetMsg!', level=logging.ERROR)
+            records = await self.txn.scan(prefix=prefix, limit=limit,
+                                          server_name=server_name)
+        except TransactionAborted:
+            self.ui.output('ABORT')
+            return
+        except TransactionError as e:
+            UI.log(f'Failed to SCAN: {e}', level=logging.ERROR)
             self.ui.output('FAILED')
             return
 
-        response = self.network.events()[get_msg.uid][1]
-        # del self.network.events()[get_msg.uid]
-
-        if response.success:
-            if response.value:
-                self.ui.output(f'{data[0]} = {response.value}')
+        if not records:
+            self.ui.output('NOT FOUND')
+        for key, value in records:
+            if server_name is None:
+                self.ui.output(f'{key} = {value}')
             else:
-                await self.cmd_abort(list(), output=False)
-                self.ui.output('NOT FOUND')
-        else:
-            await self.cmd_abort(list())
+                self.ui.output(f'{server_name}.{key} = {value}')
+
+    def _locate(self, name):
+        """
+        Split <server>.<key> or a bare <key>, which the partition ring
+        places. Returns (server_name or None, key), key is None if invalid
+        """
+        if '.' not in name:
+            if self.network.ring is None:
+                self.ui.output(f'Invalid! No partition ring, use '
+                               f'<server>.<key>')
+                return None, None
+            return None, name
+
+        server_name, key = name.split('.', 1)
+        if server_name not in self.network.servers():
+            self.ui.output(f'Invalid! "{server_name}" does not exist!')
+            return None, None
+        return server_name, key
 
     async def cmd_commit(self, data):
         """
@@ -300,88 +1336,59 @@ class Client:
         if len(data) != 0:
             self.ui.output(f'Invalid! Usage: COMMIT')
             return
-        if self.curr_txn == -1:
+        if not self.in_txn():
             self.ui.output(f'Invalid! Call BEGIN first!')
             return
 
-        events = []
-        try_msgs = []
-        # send a TryCommitMsg to all servers involved in current txn
-        for server, involved in self.curr_txn_servers.items():
-            if involved:
-                try_commit_msg = TryCommitMsg(self.curr_txn)
-                event = asyncio.Event()
-
-                try_msgs.append(try_commit_msg)
-                events.append(event.wait())
-
-                self.network.events()[try_commit_msg.uid] = event, None
-                self.network.servers()[server].send(try_commit_msg)
-
-        success = True
-
-        # only do if there was any data to commit
-        if len(events) > 0:
-            done, pending = await asyncio.wait(events, timeout=3)
-
-            for try_msg in try_msgs:
-                if self.network.events()[try_msg.uid][1] is None:
-                    success = False
-                    break
-                if not self.network.events()[try_msg.uid][1].success:
-                    success = False
-                    break
-                # del self.network.events()[try_msg.uid]
-
-            if len(pending) != 0:
-                success = False
-
-        if success:
-            for server, involved in self.curr_txn_servers.items():
-                if involved:
-                    do_commit_msg = DoCommitMsg(self.curr_txn)
-                    self.network.servers()[server].send(do_commit_msg)
-            self.ui.output('COMMIT OK')
+        try:
+            await self.txn.commit()
+        except TransactionAborted:
+            self.ui.output('ABORT')
+        except TransactionError as e:
+            UI.log(f'Failed to COMMIT: {e}', level=logging.ERROR)
+            self.ui.output('FAILED')
         else:
-            await self.cmd_abort(list())
+            self.ui.output('COMMIT OK')
+
+    async def cmd_stats(self, data):
+        """
+        Show the metrics of a server, or of the coordinator if none is given
+        """
+        if len(data) > 1:
+            self.ui.output(f'Invalid! Usage: STATS [<server>]')
+            return
+
+        server_name = data[0] if data else None
+        if server_name is not None and \
+                self.network.peer(server_name) is None:
+            self.ui.output(f'Invalid! "{server_name}" does not exist!')
+            return
 
-        # finally...
-        for server in self.curr_txn_servers.keys():
-            self.curr_txn_servers[server] = False
-        self.curr_txn = -1
+        stats = await self.client.stats(server_name)
+        if stats is None:
+            self.ui.output('FAILED')
+        else:
+            self.ui.output(json.dumps(stats, indent=2, sort_keys=True))
 
-    async def cmd_abort(self, data, output=True):
+    async def cmd_abort(self, data):
         """
         Abort current transaction on all related servers
         """
         if len(data) != 0:
             self.ui.output(f'Invalid! Usage: ABORT')
             return
-        if self.curr_txn == -1:
+        if not self.in_txn():
             self.ui.output(f'Invalid! Call BEGIN first!')
             return
 
-        # send a AbortMsg to all servers involved in current txn
-        for server, involved in self.curr_txn_servers.items():
-            if involved:
-                abort_msg = AbortMsg(self.curr_txn)
-                self.network.servers()[server].send(abort_msg)
+        await self.txn.abort()
+        self.ui.output('ABORT')
 
-        # finally...
-        for server in self.curr_txn_servers.keys():
-            self.curr_txn_servers[server] = False
-        self.curr_txn = -1
-
-        if output:
-            self.ui.output('ABORT')
 
 def main():
     debug = len(sys.argv) > 1 and sys.argv[1] == 'debug'
 
-    if debug:
-        logging.basicConfig(filename='client.log', level=logging.DEBUG)
-    else:
-        logging.basicConfig(filename='client.log', level=logging.INFO)
+    logs.setup('client.log', debug, ClientNetwork.LOG_SAMPLING)
 
     UI.log('===========================================')
     UI.log('==== Distributed Transactions - Client ====')
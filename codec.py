@@ -0,0 +1,263 @@
+import struct
+import zlib
+
+
+class CodecError(Exception):
+    pass
+
+
+class Fixed:
+    """
+    Field stored as a single struct-packed scalar
+    """
+
+    def __init__(self, fmt):
+        self.struct = struct.Struct('!' + fmt)
+
+    def encode(self, value, out):
+        out += self.struct.pack(value)
+
+    def decode(self, buf, pos):
+        return self.struct.unpack_from(buf, pos)[0], pos + self.struct.size
+
+
+U8 = Fixed('B')
+U32 = Fixed('I')
+U64 = Fixed('Q')
+I64 = Fixed('q')
+F64 = Fixed('d')
+BOOL = Fixed('?')
+
+_LENGTH = struct.Struct('!I')
+
+
+class _Bytes:
+    def encode(self, value, out):
+        out += _LENGTH.pack(len(value))
+        out += value
+
+    def decode(self, buf, pos):
+        size, = _LENGTH.unpack_from(buf, pos)
+        pos += _LENGTH.size
+        if pos + size > len(buf):
+            raise CodecError('Truncated field')
+        return bytes(buf[pos:pos + size]), pos + size
+
+
+class _Str(_Bytes):
+    def encode(self, value, out):
+        super().encode(value.encode('utf-8'), out)
+
+    def decode(self, buf, pos):
+        value, pos = super().decode(buf, pos)
+        return value.decode('utf-8'), pos
+
+
+BYTES = _Bytes()
+STR = _Str()
+
+
+class Compressed:
+    """
+    A value compressed by a client. Servers store and send it on as it is,
+    only clients look inside: data is the length of the encoded value
+    followed by the encoded value, zlib compressed
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    @staticmethod
+    def compress(value, level=zlib.Z_DEFAULT_COMPRESSION):
+        raw = bytearray()
+        VALUE.encode(value, raw)
+        return Compressed(_LENGTH.pack(len(raw)) + zlib.compress(raw, level))
+
+    def size(self):
+        """
+        Length of the value before compression, encoded
+        """
+        return _LENGTH.unpack_from(self.data)[0]
+
+    def decompress(self):
+        with memoryview(self.data) as view:
+            raw = zlib.decompress(view[_LENGTH.size:])
+        value, _ = VALUE.decode(raw, 0)
+        return value
+
+
+class _Value:
+    """
+    A stored value, either text, raw bytes or Compressed, tagged with its
+    kind
+    """
+    KIND_STR = 0
+    KIND_BYTES = 1
+    KIND_COMPRESSED = 2
+
+    @staticmethod
+    def kind(value):
+        if isinstance(value, str):
+            return _Value.KIND_STR
+        if isinstance(value, Compressed):
+            return _Value.KIND_COMPRESSED
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return _Value.KIND_BYTES
+        raise CodecError(f'Cannot encode value of type {type(value)}')
+
+    def encode(self, value, out):
+        kind = _Value.kind(value)
+        U8.encode(kind, out)
+        if kind == _Value.KIND_STR:
+            STR.encode(value, out)
+        elif kind == _Value.KIND_COMPRESSED:
+            BYTES.encode(value.data, out)
+        else:
+            BYTES.encode(value, out)
+
+    def decode(self, buf, pos):
+        kind, pos = U8.decode(buf, pos)
+        if kind == _Value.KIND_STR:
+            return STR.decode(buf, pos)
+        if kind == _Value.KIND_BYTES:
+            return BYTES.decode(buf, pos)
+        if kind == _Value.KIND_COMPRESSED:
+            data, pos = BYTES.decode(buf, pos)
+            return Compressed(data), pos
+        raise CodecError(f'Unknown value kind {kind}')
+
+
+VALUE = _Value()
+
+
+class List:
+    def __init__(self, item):
+        self.item = item
+
+    def encode(self, value, out):
+        U32.encode(len(value), out)
+        for item in value:
+            self.item.encode(item, out)
+
+    def decode(self, buf, pos):
+        count, pos = U32.decode(buf, pos)
+        items = []
+        for _ in range(count):
+            item, pos = self.item.decode(buf, pos)
+            items.append(item)
+        return items, pos
+
+
+class Tuple:
+    def __init__(self, *items):
+        self.items = items
+
+    def encode(self, value, out):
+        for item, field in zip(self.items, value):
+            item.encode(field, out)
+
+    def decode(self, buf, pos):
+        fields = []
+        for item in self.items:
+            field, pos = item.decode(buf, pos)
+            fields.append(field)
+        return tuple(fields), pos
+
+
+class _Schema:
+    """
+    Compiled FIELDS of one message class, runs of consecutive fixed-size
+    fields are packed and unpacked with a single struct call
+    """
+
+    def __init__(self, fields):
+        self.steps = []
+        run = []
+        for name, field in fields:
+            if isinstance(field, Fixed):
+                run.append((name, field))
+                continue
+            self._flush_run(run)
+            run = []
+            self.steps.append((False, (name,), field))
+        self._flush_run(run)
+
+    def _flush_run(self, run):
+        if run:
+            fmt = '!' + ''.join(f.struct.format.lstrip('!') for _, f in run)
+            names = tuple(name for name, _ in run)
+            self.steps.append((True, names, struct.Struct(fmt)))
+
+    def encode(self, msg, out):
+        for fixed, names, field in self.steps:
+            if fixed:
+                out += field.pack(*[getattr(msg, name) for name in names])
+            else:
+                field.encode(getattr(msg, names[0]), out)
+
+    def decode(self, msg, buf, pos):
+        for fixed, names, field in self.steps:
+            if fixed:
+                values = field.unpack_from(buf, pos)
+                pos += field.size
+                for name, value in zip(names, values):
+                    setattr(msg, name, value)
+            else:
+                value, pos = field.decode(buf, pos)
+                setattr(msg, names[0], value)
+        return pos
+
+
+class Codec:
+    """
+    Schema-driven binary encoding of message classes.
+
+    Every registered class declares a unique one byte TAG and a FIELDS
+    tuple of (attribute, field type) pairs. An encoded message is the tag,
+    the sender's 32 bit sequence number (uid) and then each field in
+    declaration order. Only registered classes can be decoded, so unlike
+    pickle a peer can never make us construct arbitrary objects.
+    """
+    HEADER = struct.Struct('!BI')
+
+    def __init__(self):
+        # tag(int) -> message class
+        self._classes = dict()
+        # message class -> _Schema
+        self._schemas = dict()
+
+    def register(self, cls):
+        if cls.TAG in self._classes:
+            other = self._classes[cls.TAG].__name__
+            raise CodecError(f'{cls.__name__} reuses tag {cls.TAG} of {other}')
+        self._classes[cls.TAG] = cls
+        self._schemas[cls] = _Schema(cls.FIELDS)
+        return cls
+
+    def encode(self, msg):
+        out = bytearray(Codec.HEADER.pack(msg.TAG, msg.uid))
+        self._schemas[msg.__class__].encode(msg, out)
+        return bytes(out)
+
+    def decode(self, payload):
+        try:
+            tag, uid = Codec.HEADER.unpack_from(payload, 0)
+            cls = self._classes.get(tag, None)
+            if cls is None:
+                raise CodecError(f'Unknown message tag {tag}')
+
+            msg = cls.__new__(cls)
+            msg.uid = uid
+            msg.origin = ''
+            msg.destination = ''
+            pos = self._schemas[cls].decode(msg, payload, Codec.HEADER.size)
+        except (struct.error, UnicodeDecodeError) as e:
+            raise CodecError(f'Malformed message: {e}') from e
+
+        if pos != len(payload):
+            raise CodecError(f'{len(payload) - pos} trailing bytes')
+        return msg
@@ -1,27 +1,84 @@
 import asyncio
+import json
 import logging
-import pickle
+import os
 import socket
 import sys
-
-from messages import NewTxnID
+import time
+
+import framing
+import logs
+from messages import (CODEC, CodecError, NewTxnID, NewTxnIDBlock,
+                      RingMsgResponse, StatsMsgResponse)
+from metrics import Metrics
+import nodeslist
+from partition import HashRing
 from ui import UI
 
 
 class CoordinatorNetwork:
     PORT = 13337
+    # largest block of txn ids a single client may lease at once
+    MAX_LEASE = 4096
     SELF_ADDR = socket.gethostbyname(socket.gethostname())
-
-    def __init__(self):
+    # msg type -> only log one in every n of these sent or received
+    LOG_SAMPLING = {'RequestTxnID': 100, 'NewTxnID': 100}
+    STATS_PATH = 'coordinator.stats.json'
+    # seconds between dumps of the metrics to STATS_PATH
+    STATS_INTERVAL = 10
+    # highest txn id we may have handed out, survives restarts
+    TXN_ID_PATH = 'coordinator.txn_id'
+    # txn ids reserved in TXN_ID_PATH at a time
+    TXN_ID_RESERVE = 1 << 16
+    # the partition ring once it changed, survives restarts
+    RING_PATH = 'coordinator.ring'
+
+    def __init__(self, port=None, stats_path=None, servers=None,
+                 txn_id_path=None, ring_path=None):
+        """
+        servers is the initial partition ring, a list of (host, name) or
+        (host, name, port), nodeslist.servers by default
+        """
         self.evloop = asyncio.get_event_loop()
-        self.last_txn_id = 0
+        self.port = port or CoordinatorNetwork.PORT
+        self.stats_path = stats_path or CoordinatorNetwork.STATS_PATH
+        self.txn_id_path = txn_id_path or CoordinatorNetwork.TXN_ID_PATH
+        self.ring_path = ring_path or CoordinatorNetwork.RING_PATH
+
+        # servers hold versions of every id up to reserved_txn_id, so after
+        # a restart we go on above it, skipping what was left of it
+        self.reserved_txn_id = 0
+        if os.path.exists(self.txn_id_path):
+            with open(self.txn_id_path) as f:
+                self.reserved_txn_id = json.load(f)['reserved']
+        self.last_txn_id = self.reserved_txn_id
+
+        # (name, host, port) of every server in the ring clients route
+        # bare keys with, bumped version on every change
+        servers = nodeslist.servers if servers is None else servers
+        self.ring_nodes = [(name, host, port[0] if port else 0)
+                           for host, name, *port in servers]
+        self.ring_vnodes = HashRing.VNODES
+        self.ring_version = 0
+        # servers keep the ring they were last moved to, so must we
+        if os.path.exists(self.ring_path):
+            with open(self.ring_path) as f:
+                ring = json.load(f)
+            self.ring_nodes = [tuple(node) for node in ring['nodes']]
+            self.ring_vnodes = ring['vnodes']
+            self.ring_version = ring['version']
+        self.metrics = Metrics()
+        self.metrics.gauge('last_txn_id', lambda: self.last_txn_id)
+        self.stats = None  # type: asyncio.Task
 
     async def create_coordinator(self):
         self.coordinator = await self.evloop.create_server(
-            lambda: CoordinatorProtocol(self.request_handler),
-            port=CoordinatorNetwork.PORT, family=socket.AF_INET,
+            lambda: CoordinatorProtocol(self.request_handler, self.metrics),
+            port=self.port, family=socket.AF_INET,
             reuse_address=True, reuse_port=True
         )
+        self.stats = asyncio.ensure_future(self.metrics.dump_loop(
+            self.stats_path, CoordinatorNetwork.STATS_INTERVAL))
         UI.log('Created coordinator...')
 
     def request_handler(self, msg, transport):
@@ -32,45 +89,137 @@ class CoordinatorNetwork:
             UI.log(f'Dont recognize msg {cls}', level=logging.WARNING)
             return
 
-        UI.log(f'Got {str(msg)}')
+        UI.log('Got %s', msg, sample=msg.type())
+        start = time.perf_counter()
         response = handler(msg)
+        self.metrics.time(cls, time.perf_counter() - start)
 
         if response is not None:
             response.origin = CoordinatorNetwork.SELF_ADDR
             response.destination = msg.origin
 
-            UI.log(f'Sending {str(response)}')
-            pickled = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
-            transport.write(pickled)
+            UI.log('Sending %s', response, sample=response.type())
+            transport.write(framing.pack(CODEC.encode(response)))
 
     def handle_RequestTxnID(self, msg):
-        self.last_txn_id += 1
-        response = NewTxnID(msg.uid, self.last_txn_id)
+        txn_id = self._next_txn_ids(1)
+        self.metrics.incr('txn_ids')
+        response = NewTxnID(msg.uid, txn_id)
+        return response
+
+    def handle_RequestTxnIDBlock(self, msg):
+        # ids are still handed out from one counter, so blocks never
+        # overlap and each new block is above every block before it
+        count = max(1, min(msg.count, CoordinatorNetwork.MAX_LEASE))
+        first_txn_id = self._next_txn_ids(count)
+        self.metrics.incr('txn_ids', count)
+        self.metrics.incr('txn_id_blocks')
+        response = NewTxnIDBlock(msg.uid, first_txn_id, count)
+        return response
+
+    def _next_txn_ids(self, count):
+        """
+        First of count new txn ids. Running out of reserved ids reserves
+        more on disk, before any of them is handed out
+        """
+        first_txn_id = self.last_txn_id + 1
+        self.last_txn_id += count
+        if self.last_txn_id > self.reserved_txn_id:
+            reserved = self.last_txn_id + CoordinatorNetwork.TXN_ID_RESERVE
+            save(self.txn_id_path, {'reserved': reserved})
+            self.reserved_txn_id = reserved
+            self.metrics.incr('txn_id_reservations')
+        return first_txn_id
+
+    def handle_RingMsg(self, msg):
+        response = RingMsgResponse(msg.uid, self.ring_version,
+                                   self.ring_nodes, self.ring_vnodes)
+        return response
+
+    def handle_SetRingMsg(self, msg):
+        self.ring_nodes = [tuple(node) for node in msg.nodes]
+        self.ring_vnodes = msg.vnodes
+        self.ring_version += 1
+        save(self.ring_path, {'nodes': self.ring_nodes,
+                              'vnodes': self.ring_vnodes,
+                              'version': self.ring_version})
+        UI.log(f'Ring is now {self.ring_nodes}, version {self.ring_version}')
+
+        response = RingMsgResponse(msg.uid, self.ring_version,
+                                   self.ring_nodes, self.ring_vnodes)
+        return response
+
+    def handle_StatsMsg(self, msg):
+        stats = json.dumps(self.metrics.snapshot(), sort_keys=True)
+
+        response = StatsMsgResponse(msg.uid, stats)
         return response
 
     def close(self):
         self.coordinator.close()
+        if self.stats is not None:
+            self.stats.cancel()
+
+
+def save(path, state):
+    """
+    Write state to path as json, all of it or nothing even on a crash
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
 
 
 class CoordinatorProtocol(asyncio.Protocol):
-    def __init__(self, req_handler):
+    def __init__(self, req_handler, metrics=None):
         self.evloop = asyncio.get_event_loop()
         self.req_handler = req_handler
+        self.metrics = metrics
+        self.decoder = framing.FrameDecoder()
         UI.log('Created protocol!')
 
     def connection_made(self, transport):
         self.transport = transport
         self.peer = self.transport.get_extra_info('peername')[0]
         UI.log(f'Got connection from {str(self.peer)}')
+        if self.metrics is not None:
+            self.metrics.incr('connections')
+            self.metrics.incr('connections.total')
 
     def connection_lost(self, exc):
         UI.log(f'Connection lost with {str(self.peer)}')
+        if self.metrics is not None:
+            self.metrics.incr('connections', -1)
         super().connection_lost(exc)
 
     def data_received(self, data):
-        UI.log(f'Got data from {self.peer}')
-        unpickled = pickle.loads(data)
-        self.req_handler(unpickled, self.transport)
+        UI.log('Got data from %s', self.peer, level=logging.DEBUG)
+        try:
+            frames = self.decoder.feed(data)
+        except framing.FrameError as e:
+            UI.log(f'Bad frame from {self.peer}: {e}', level=logging.ERROR)
+            self.transport.close()
+            return
+
+        for frame in frames:
+            try:
+                msg = CODEC.decode(frame)
+            except CodecError as e:
+                UI.log(f'Bad message from {self.peer}: {e}',
+                       level=logging.ERROR)
+                self.transport.close()
+                return
+
+            msg.origin = self.peer
+            self.req_handler(msg, self.transport)
 
     def eof_received(self):
         pass
@@ -79,10 +228,7 @@ class CoordinatorProtocol(asyncio.Protocol):
 def main():
     debug = len(sys.argv) > 1 and sys.argv[1] == 'debug'
 
-    if debug:
-        logging.basicConfig(filename='coordinator.log', level=logging.DEBUG)
-    else:
-        logging.basicConfig(filename='coordinator.log', level=logging.INFO)
+    logs.setup('coordinator.log', debug, CoordinatorNetwork.LOG_SAMPLING)
     UI.log('================================================')
     UI.log('==== Distributed Transactions - Coordinator ====')
     UI.log('================================================')
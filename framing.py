@@ -0,0 +1,67 @@
+import struct
+
+# every frame on the wire is a 4 byte big-endian length followed by payload
+HEADER = struct.Struct('!I')
+
+# refuse frames larger than this, a corrupt header would otherwise make us
+# buffer gigabytes waiting for a frame that never completes
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def pack(payload):
+    """
+    Prefix payload with its length so the receiver can find its end
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f'Frame of {len(payload)} bytes is too large')
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for length-prefixed frames.
+
+    TCP is a byte stream, so a single data_received() call can carry part
+    of a frame, exactly one frame or several frames back to back. Feed every
+    chunk into the decoder and it returns whichever frames are now complete,
+    keeping any trailing partial frame buffered for the next call.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def pending(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        self._buffer += data
+
+        frames = []
+        buffer = self._buffer
+        view = memoryview(buffer)
+        pos = 0
+        try:
+            while len(buffer) - pos >= HEADER.size:
+                size, = HEADER.unpack_from(buffer, pos)
+                if size > self.max_frame_size:
+                    raise FrameError(f'Frame of {size} bytes is too large')
+
+                end = pos + HEADER.size + size
+                if end > len(buffer):
+                    break
+
+                frames.append(bytes(view[pos + HEADER.size:end]))
+                pos = end
+        finally:
+            view.release()
+
+        # drop everything we consumed, keep the partial frame (if any)
+        if pos:
+            del buffer[:pos]
+
+        return frames
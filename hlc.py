@@ -0,0 +1,86 @@
+import time
+
+
+class HybridClock:
+    """
+    Hybrid logical clock, issuing unique increasing timestamps without a
+    coordinator.
+
+    A timestamp is one 63 bit integer: milliseconds since EPOCH in the top
+    41 bits, a logical counter in the next 12 and the id of the node that
+    issued it in the low 10. The physical part follows the wall clock, but
+    never goes back and jumps ahead to any newer clock we hear of; the
+    logical counter orders what is issued within one millisecond. Nodes
+    with different ids therefore never issue the same timestamp, and
+    timestamps follow real time as closely as the clocks of the nodes agree.
+    """
+    # 2020-01-01 in ms since the unix epoch, 41 bits last until 2089
+    EPOCH = 1577836800000
+    LOGICAL_BITS = 12
+    NODE_BITS = 10
+    MAX_LOGICAL = (1 << LOGICAL_BITS) - 1
+    MAX_NODE = (1 << NODE_BITS) - 1
+    # ms a clock we hear of may be ahead of our wall clock, anything
+    # further ahead is taken to be broken and ignored
+    MAX_DRIFT = 10000
+
+    def __init__(self, node_id=0):
+        if not 0 <= node_id <= HybridClock.MAX_NODE:
+            raise ValueError(f'Node id {node_id} is not in '
+                             f'0..{HybridClock.MAX_NODE}')
+        self.node_id = node_id
+        self._physical = 0
+        self._logical = 0
+
+    @staticmethod
+    def wall():
+        return int(time.time() * 1000) - HybridClock.EPOCH
+
+    @staticmethod
+    def unpack(timestamp):
+        """
+        (physical ms since EPOCH, logical, node id) of timestamp
+        """
+        node_id = timestamp & HybridClock.MAX_NODE
+        timestamp >>= HybridClock.NODE_BITS
+        logical = timestamp & HybridClock.MAX_LOGICAL
+        return timestamp >> HybridClock.LOGICAL_BITS, logical, node_id
+
+    def _pack(self):
+        return (((self._physical << HybridClock.LOGICAL_BITS) |
+                 self._logical) << HybridClock.NODE_BITS) | self.node_id
+
+    def now(self):
+        """
+        New timestamp, above every timestamp issued or heard of before
+        """
+        wall = HybridClock.wall()
+        if wall > self._physical:
+            self._physical, self._logical = wall, 0
+        elif self._logical < HybridClock.MAX_LOGICAL:
+            self._logical += 1
+        else:
+            # out of logical values for this ms, borrow the next one
+            self._physical, self._logical = self._physical + 1, 0
+        return self._pack()
+
+    def read(self):
+        """
+        Current time of the clock, without issuing a timestamp
+        """
+        wall = HybridClock.wall()
+        if wall > self._physical:
+            self._physical, self._logical = wall, 0
+        return self._pack()
+
+    def update(self, timestamp):
+        """
+        Move up to timestamp of another node, so that what we issue next
+        comes after it. False if it is too far ahead to be believed
+        """
+        physical, logical, _ = HybridClock.unpack(timestamp)
+        if physical - HybridClock.wall() > HybridClock.MAX_DRIFT:
+            return False
+        if (physical, logical) > (self._physical, self._logical):
+            self._physical, self._logical = physical, logical
+        return True
@@ -0,0 +1,66 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+
+class MessageSampler(logging.Filter):
+    """
+    Keep only one in every n records per message type.
+
+    Records are tagged with their message type by UI.log(..., sample=type),
+    untagged records and types without a rate always pass.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        # msg type -> n
+        self.rates = dict(rates)
+        self._counts = dict()
+
+    def filter(self, record):
+        msg_type = getattr(record, 'sample', None)
+        rate = self.rates.get(msg_type, 1)
+        if rate <= 1:
+            return True
+
+        count = self._counts.get(msg_type, 0)
+        self._counts[msg_type] = count + 1
+        return count % rate == 0
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread untouched.
+
+    The stdlib handler formats every record before queueing it, which puts
+    all the formatting back on the event loop. Here the message and its
+    args are only merged by the listener, so the loop pays for creating the
+    record and a queue put and nothing else.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup(filename, debug=False, sample_rates=None):
+    """
+    Log to filename from a background thread, returns the listener
+    """
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    records = queue.Queue()
+    handler = QueueHandler(records)
+    if sample_rates:
+        handler.addFilter(MessageSampler(sample_rates))
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+
+    listener = logging.handlers.QueueListener(records, file_handler)
+    listener.start()
+    # flush whatever is still queued on the way out
+    atexit.register(listener.stop)
+    return listener
@@ -1,9 +1,25 @@
-import uuid
+from codec import (BOOL, BYTES, I64, STR, U8, U32, U64, VALUE, Codec,
+                   CodecError, Compressed, List, Tuple)
+
+
+# every message class with a TAG is registered here on definition
+CODEC = Codec()
 
 
 class BaseMsg:
+    # uid is the sender's per-connection sequence number, filled in on send
+    # origin and destination are never put on the wire, the receiving
+    # protocol fills in origin from the connection the message came from
+    __slots__ = ('uid', 'origin', 'destination')
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'TAG' in cls.__dict__:
+            CODEC.register(cls)
+
     def __init__(self, origin='', destination=''):
-        self.uid = uuid.uuid4()
+        self.uid = 0
         self.origin = origin
         self.destination = destination
 
@@ -11,14 +27,22 @@ class BaseMsg:
         return self.__class__.__name__
 
     def __str__(self):
-        return self.__class__.__name__ + ': ' + str(vars(self))
+        fields = {name: getattr(self, name, None)
+                  for klass in self.__class__.__mro__
+                  for name in getattr(klass, '__slots__', ())}
+        return self.__class__.__name__ + ': ' + str(fields)
 
 
 class RequestTxnID(BaseMsg):
-    pass
+    TAG = 1
+    __slots__ = ()
 
 
 class NewTxnID(BaseMsg):
+    TAG = 2
+    FIELDS = (('orig_uid', U32), ('txn_id', I64))
+    __slots__ = ('orig_uid', 'txn_id')
+
     def __init__(self, orig_uid, txn_id, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.orig_uid = orig_uid
@@ -26,6 +50,10 @@ class NewTxnID(BaseMsg):
 
 
 class SetMsg(BaseMsg):
+    TAG = 3
+    FIELDS = (('txn_id', I64), ('key', STR), ('value', VALUE))
+    __slots__ = ('txn_id', 'key', 'value')
+
     def __init__(self, txn_id, key, value, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.txn_id = txn_id
@@ -34,47 +62,573 @@ class SetMsg(BaseMsg):
 
 
 class SetMsgResponse(BaseMsg):
+    TAG = 4
+    # clock is the hybrid clock of the server, see hlc.py, in every
+    # response to an operation of a txn
+    FIELDS = (('orig_uid', U32), ('success', BOOL), ('clock', I64))
+    __slots__ = ('orig_uid', 'success', 'clock')
+
     def __init__(self, orig_uid, success, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.orig_uid = orig_uid
         self.success = success
+        self.clock = 0
 
 
 class GetMsg(BaseMsg):
-    def __init__(self, txn_id, key, *args, **kwargs):
+    TAG = 5
+    # readonly reads see the snapshot at txn_id, see server._snapshot_get
+    FIELDS = (('txn_id', I64), ('key', STR), ('readonly', BOOL))
+    __slots__ = ('txn_id', 'key', 'readonly')
+
+    def __init__(self, txn_id, key, readonly=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.txn_id = txn_id
         self.key = key
+        self.readonly = readonly
 
 
 class GetMsgResponse(BaseMsg):
+    TAG = 6
+    # value may only be the first chunk of a value of size, fetch the rest
+    # with GetChunkMsg
+    FIELDS = (('orig_uid', U32), ('success', BOOL), ('value', VALUE),
+              ('size', U64), ('clock', I64))
+    __slots__ = ('orig_uid', 'success', 'value', 'size', 'clock')
+
     def __init__(self, orig_uid, success, value='', *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.orig_uid = orig_uid
         self.success = success
         self.value = value
+        self.size = len(value)
+        self.clock = 0
 
 
 class TryCommitMsg(BaseMsg):
-    def __init__(self, txn_id, *args, **kwargs):
+    TAG = 7
+    # writes is the number of keys the txn wrote to the server
+    FIELDS = (('txn_id', I64), ('writes', U32))
+    __slots__ = ('txn_id', 'writes')
+
+    def __init__(self, txn_id, writes, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.txn_id = txn_id
+        self.writes = writes
 
 
 class TryCommitMsgResponse(BaseMsg):
+    TAG = 8
+    FIELDS = (('orig_uid', U32), ('success', BOOL), ('clock', I64))
+    __slots__ = ('orig_uid', 'success', 'clock')
+
     def __init__(self, orig_uid, success, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.orig_uid = orig_uid
         self.success = success
+        self.clock = 0
 
 
 class DoCommitMsg(BaseMsg):
+    TAG = 9
+    FIELDS = (('txn_id', I64),)
+    __slots__ = ('txn_id',)
+
     def __init__(self, txn_id, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.txn_id = txn_id
 
 
+class DoCommitMsgResponse(BaseMsg):
+    """
+    The commit is in the log
+    """
+    TAG = 41
+    FIELDS = (('orig_uid', U32), ('clock', I64))
+    __slots__ = ('orig_uid', 'clock')
+
+    def __init__(self, orig_uid, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.clock = 0
+
+
 class AbortMsg(BaseMsg):
+    TAG = 10
+    FIELDS = (('txn_id', I64),)
+    __slots__ = ('txn_id',)
+
     def __init__(self, txn_id, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.txn_id = txn_id
+
+
+class RequestTxnIDBlock(BaseMsg):
+    TAG = 11
+    FIELDS = (('count', U32),)
+    __slots__ = ('count',)
+
+    def __init__(self, count, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = count
+
+
+class NewTxnIDBlock(BaseMsg):
+    TAG = 12
+    FIELDS = (('orig_uid', U32), ('first_txn_id', I64), ('count', U32))
+    __slots__ = ('orig_uid', 'first_txn_id', 'count')
+
+    def __init__(self, orig_uid, first_txn_id, count, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.first_txn_id = first_txn_id
+        self.count = count
+
+
+class BatchMsg(BaseMsg):
+    """
+    Several gets and sets of one txn on one server, run in order
+    """
+    TAG = 13
+    OP_GET = 0
+    OP_SET = 1
+    # (op, key, value), value is ignored for gets
+    FIELDS = (('txn_id', I64), ('ops', List(Tuple(U8, STR, VALUE))),
+              ('readonly', BOOL))
+    __slots__ = ('txn_id', 'ops', 'readonly')
+
+    def __init__(self, txn_id, ops, readonly=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+        self.ops = ops
+        self.readonly = readonly
+
+
+class BatchMsgResponse(BaseMsg):
+    TAG = 14
+    # (success, value, size) for each op, value is '' for sets. value may
+    # only be the first chunk of a value of size, as in GetMsgResponse
+    FIELDS = (('orig_uid', U32),
+              ('results', List(Tuple(BOOL, VALUE, U64))), ('clock', I64))
+    __slots__ = ('orig_uid', 'results', 'clock')
+
+    def __init__(self, orig_uid, results, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.results = results
+        self.clock = 0
+
+
+class CommitOneMsg(BaseMsg):
+    """
+    TryCommit and DoCommit in one, for txns that touched a single server
+    """
+    TAG = 15
+    # writes as in TryCommitMsg
+    FIELDS = (('txn_id', I64), ('writes', U32))
+    __slots__ = ('txn_id', 'writes')
+
+    def __init__(self, txn_id, writes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+        self.writes = writes
+
+
+class CommitOneMsgResponse(BaseMsg):
+    TAG = 16
+    FIELDS = (('orig_uid', U32), ('success', BOOL), ('clock', I64))
+    __slots__ = ('orig_uid', 'success', 'clock')
+
+    def __init__(self, orig_uid, success, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.success = success
+        self.clock = 0
+
+
+class StatsMsg(BaseMsg):
+    TAG = 17
+    __slots__ = ()
+
+
+class StatsMsgResponse(BaseMsg):
+    TAG = 18
+    # Metrics.snapshot() as json
+    FIELDS = (('orig_uid', U32), ('stats', STR))
+    __slots__ = ('orig_uid', 'stats')
+
+    def __init__(self, orig_uid, stats, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.stats = stats
+
+
+# a ring node is (name, host, port), port 0 meaning the default port
+RING_NODE = Tuple(STR, STR, U32)
+# a moved key is (key, value, last_rd_txn, last_wr_txn, commit_txn)
+KEY_RECORD = Tuple(STR, VALUE, I64, I64, I64)
+
+
+class RingMsg(BaseMsg):
+    """
+    Ask the coordinator for the partition ring
+    """
+    TAG = 19
+    __slots__ = ()
+
+
+class RingMsgResponse(BaseMsg):
+    TAG = 20
+    FIELDS = (('orig_uid', U32), ('version', U32), ('nodes', List(RING_NODE)),
+              ('vnodes', U32))
+    __slots__ = ('orig_uid', 'version', 'nodes', 'vnodes')
+
+    def __init__(self, orig_uid, version, nodes, vnodes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.version = version
+        self.nodes = nodes
+        self.vnodes = vnodes
+
+
+class SetRingMsg(BaseMsg):
+    """
+    Make nodes the partition ring, once their keys have been moved
+    """
+    TAG = 21
+    FIELDS = (('nodes', List(RING_NODE)), ('vnodes', U32))
+    __slots__ = ('nodes', 'vnodes')
+
+    def __init__(self, nodes, vnodes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.nodes = nodes
+        self.vnodes = vnodes
+
+
+class ExportKeysMsg(BaseMsg):
+    """
+    Tell server name about the ring of names, and page through the keys it
+    holds but no longer owns in that ring, from key start on
+    """
+    TAG = 22
+    FIELDS = (('name', STR), ('names', List(STR)), ('vnodes', U32),
+              ('start', STR), ('limit', U32))
+    __slots__ = ('name', 'names', 'vnodes', 'start', 'limit')
+
+    def __init__(self, name, names, vnodes, start, limit, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.names = names
+        self.vnodes = vnodes
+        self.start = start
+        self.limit = limit
+
+
+class ExportKeysMsgResponse(BaseMsg):
+    TAG = 23
+    FIELDS = (('orig_uid', U32), ('records', List(KEY_RECORD)),
+              ('next_key', STR), ('done', BOOL))
+    __slots__ = ('orig_uid', 'records', 'next_key', 'done')
+
+    def __init__(self, orig_uid, records, next_key, done, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.records = records
+        self.next_key = next_key
+        self.done = done
+
+
+class ImportKeysMsg(BaseMsg):
+    TAG = 24
+    FIELDS = (('records', List(KEY_RECORD)),)
+    __slots__ = ('records',)
+
+    def __init__(self, records, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = records
+
+
+class ImportKeysMsgResponse(BaseMsg):
+    TAG = 25
+    FIELDS = (('orig_uid', U32), ('success', BOOL))
+    __slots__ = ('orig_uid', 'success')
+
+    def __init__(self, orig_uid, success, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.success = success
+
+
+class DropKeysMsg(BaseMsg):
+    """
+    Forget the keys server name does not own in the ring of names
+    """
+    TAG = 26
+    FIELDS = (('name', STR), ('names', List(STR)), ('vnodes', U32))
+    __slots__ = ('name', 'names', 'vnodes')
+
+    def __init__(self, name, names, vnodes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.names = names
+        self.vnodes = vnodes
+
+
+class DropKeysMsgResponse(BaseMsg):
+    TAG = 27
+    FIELDS = (('orig_uid', U32), ('count', U32))
+    __slots__ = ('orig_uid', 'count')
+
+    def __init__(self, orig_uid, count, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.count = count
+
+
+class ReplicateMsg(BaseMsg):
+    """
+    Commits shipped from a primary to a backup, see replication.py
+    """
+    TAG = 28
+    # (txn_id, [(key, value)]) like a log record, synced is set once the
+    # backup has been sent everything the primary had when it connected.
+    # The primary commits nothing at or below closed anymore, and sent
+    # every commit up to it. A primary of several workers sends one stream
+    # of these per worker, numbered 0 to streams - 1. catch_up is set on
+    # the newest versions sent while catching up, the backup may have
+    # missed the versions before them
+    FIELDS = (('records', List(Tuple(I64, List(Tuple(STR, VALUE))))),
+              ('synced', BOOL), ('closed', I64), ('stream', U32),
+              ('streams', U32), ('catch_up', BOOL))
+    __slots__ = ('records', 'synced', 'closed', 'stream', 'streams',
+                 'catch_up')
+
+    def __init__(self, records, synced, closed=-1, stream=0, streams=1,
+                 catch_up=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = records
+        self.synced = synced
+        self.closed = closed
+        self.stream = stream
+        self.streams = streams
+        self.catch_up = catch_up
+
+
+class WorkerVoteMsg(BaseMsg):
+    """
+    Ask a worker process of the same server to validate its part of a txn,
+    see workers.py
+    """
+    TAG = 29
+    FIELDS = (('txn_id', I64),)
+    __slots__ = ('txn_id',)
+
+    def __init__(self, txn_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+
+
+class WorkerVoteMsgResponse(BaseMsg):
+    TAG = 30
+    # the worker never heard of the txn, so it has nothing to commit
+    VOTE_UNKNOWN = 0
+    VOTE_YES = 1
+    VOTE_NO = 2
+    # writes is the number of keys the txn wrote to the worker
+    FIELDS = (('orig_uid', U32), ('vote', U8), ('writes', U32))
+    __slots__ = ('orig_uid', 'vote', 'writes')
+
+    def __init__(self, orig_uid, vote, writes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.vote = vote
+        self.writes = writes
+
+
+class WorkerCommitMsg(BaseMsg):
+    """
+    Apply the writes of a txn a worker voted yes on, answered once they are
+    in its log
+    """
+    TAG = 31
+    FIELDS = (('txn_id', I64),)
+    __slots__ = ('txn_id',)
+
+    def __init__(self, txn_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+
+
+class WorkerCommitMsgResponse(BaseMsg):
+    TAG = 32
+    FIELDS = (('orig_uid', U32),)
+    __slots__ = ('orig_uid',)
+
+    def __init__(self, orig_uid, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+
+
+class ScanMsg(BaseMsg):
+    """
+    Read up to limit keys of a txn from start on and before end, or to the
+    last key if end is '', in key order
+    """
+    TAG = 33
+    FIELDS = (('txn_id', I64), ('start', STR), ('end', STR), ('limit', U32),
+              ('readonly', BOOL))
+    __slots__ = ('txn_id', 'start', 'end', 'limit', 'readonly')
+
+    def __init__(self, txn_id, start, end, limit, readonly=False, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+        self.start = start
+        self.end = end
+        self.limit = limit
+        self.readonly = readonly
+
+
+class ScanMsgResponse(BaseMsg):
+    TAG = 34
+    # (key, value, size) of the keys that exist, value as in
+    # BatchMsgResponse. The next page starts at next_key unless done
+    FIELDS = (('orig_uid', U32), ('success', BOOL),
+              ('records', List(Tuple(STR, VALUE, U64))), ('next_key', STR),
+              ('done', BOOL), ('clock', I64))
+    __slots__ = ('orig_uid', 'success', 'records', 'next_key', 'done',
+                 'clock')
+
+    def __init__(self, orig_uid, success, records, next_key, done, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.success = success
+        self.records = records
+        self.next_key = next_key
+        self.done = done
+        self.clock = 0
+
+
+class SetChunkMsg(BaseMsg):
+    """
+    One chunk of a value too large for a single SetMsg. The value is set
+    once all chunks of its size arrived, in any order
+    """
+    TAG = 35
+    # kind is the VALUE kind of the value, text values are sent utf-8
+    # encoded and size and offset count bytes
+    FIELDS = (('txn_id', I64), ('key', STR), ('size', U64), ('offset', U64),
+              ('data', BYTES), ('kind', U8))
+    __slots__ = ('txn_id', 'key', 'size', 'offset', 'data', 'kind')
+
+    def __init__(self, txn_id, key, size, offset, data, kind, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+        self.key = key
+        self.size = size
+        self.offset = offset
+        self.data = data
+        self.kind = kind
+
+
+class SetChunkMsgResponse(BaseMsg):
+    TAG = 36
+    FIELDS = (('orig_uid', U32), ('success', BOOL), ('clock', I64))
+    __slots__ = ('orig_uid', 'success', 'clock')
+
+    def __init__(self, orig_uid, success, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.success = success
+        self.clock = 0
+
+
+class GetChunkMsg(BaseMsg):
+    """
+    Read the chunk of a large value from offset on, see GetMsgResponse
+    """
+    TAG = 37
+    FIELDS = (('txn_id', I64), ('key', STR), ('offset', U64),
+              ('readonly', BOOL))
+    __slots__ = ('txn_id', 'key', 'offset', 'readonly')
+
+    def __init__(self, txn_id, key, offset, readonly=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+        self.key = key
+        self.offset = offset
+        self.readonly = readonly
+
+
+class GetChunkMsgResponse(BaseMsg):
+    TAG = 38
+    FIELDS = (('orig_uid', U32), ('success', BOOL), ('value', VALUE),
+              ('clock', I64))
+    __slots__ = ('orig_uid', 'success', 'value', 'clock')
+
+    def __init__(self, orig_uid, success, value='', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.orig_uid = orig_uid
+        self.success = success
+        self.value = value
+        self.clock = 0
+
+
+class ReplicateChunkMsg(BaseMsg):
+    """
+    One chunk of a value committed by txn_id that is too large to go in a
+    ReplicateMsg. Chunks of a value are sent in order, and the backup
+    installs the value once the last one arrived
+    """
+    TAG = 39
+    # kind, size and offset as in SetChunkMsg, catch_up as in ReplicateMsg
+    FIELDS = (('txn_id', I64), ('key', STR), ('size', U64), ('offset', U64),
+              ('data', BYTES), ('kind', U8), ('catch_up', BOOL))
+    __slots__ = ('txn_id', 'key', 'size', 'offset', 'data', 'kind',
+                 'catch_up')
+
+    def __init__(self, txn_id, key, size, offset, data, kind, catch_up=False,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+        self.key = key
+        self.size = size
+        self.offset = offset
+        self.data = data
+        self.kind = kind
+        self.catch_up = catch_up
+
+
+class ReleaseMsg(BaseMsg):
+    """
+    The txn only read from the server and is over, committed or aborted:
+    it can forget the txn without waiting for its lease to run out
+    """
+    TAG = 40
+    FIELDS = (('txn_id', I64),)
+    __slots__ = ('txn_id',)
+
+    def __init__(self, txn_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.txn_id = txn_id
+
+
+class ReplicateRingMsg(BaseMsg):
+    """
+    The ring a primary is part of, shipped to its backups so they refuse
+    the keys it no longer owns like it does. With drop set the primary
+    also forgot those keys, see DropKeysMsg
+    """
+    TAG = 42
+    FIELDS = (('name', STR), ('names', List(STR)), ('vnodes', U32),
+              ('drop', BOOL))
+    __slots__ = ('name', 'names', 'vnodes', 'drop')
+
+    def __init__(self, name, names, vnodes, drop, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.names = names
+        self.vnodes = vnodes
+        self.drop = drop
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from ui import UI
+
+
+class Histogram:
+    """
+    Latency histogram with power of two buckets: bucket i counts samples
+    under 2**i microseconds. Recording a sample is a handful of integer
+    operations, percentiles are read as the upper bound of their bucket
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        index = int(seconds * 1e6).bit_length()
+        self.buckets[min(index, Histogram.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """
+        Upper bound in seconds of the bucket holding the q-th sample
+        """
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << index) / 1e6, self.max)
+        return 0.0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999),
+            'max': self.max,
+        }
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges of one node.
+
+    Counters and histograms are updated inline on the event loop and cost
+    a dict lookup each. Gauges are functions that are only called when a
+    snapshot is taken, for values that are cheaper to compute on demand.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # name -> int
+        self.counters = dict()
+        # name -> Histogram
+        self.histograms = dict()
+        # name -> function returning a number
+        self.gauges = dict()
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def time(self, name, seconds):
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+        histogram.record(seconds)
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'counters': dict(self.counters),
+            'gauges': {name: func() for name, func in self.gauges.items()},
+            'latency': {name: histogram.snapshot()
+                        for name, histogram in self.histograms.items()},
+        }
+
+    def dump(self, path):
+        """
+        Write a snapshot to path as json, replacing it in one step
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    async def dump_loop(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.dump(path)
+            except OSError as e:
+                UI.log(f'Could not dump stats to {path}: {e}',
+                       level=logging.WARNING)
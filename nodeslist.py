@@ -12,4 +12,9 @@ servers = [
     ('sp17-cs425-g15-08.cs.illinois.edu', 'E')
 ]
 
+# backups as (host, name, name of their primary), each gets every commit of
+# its primary and serves read-only txns, e.g.
+# ('sp17-cs425-g15-10.cs.illinois.edu', 'A1', 'A')
+replicas = []
+
 coordinator = 'sp17-cs425-g15-09.cs.illinois.edu'
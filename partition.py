@@ -0,0 +1,166 @@
+import asyncio
+import bisect
+import collections
+import hashlib
+import logging
+import sys
+
+from messages import DropKeysMsg, ExportKeysMsg, ImportKeysMsg, SetRingMsg
+from ui import UI
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto servers.
+
+    Every server is placed on a 64 bit ring at VNODES pseudo random points
+    and a key belongs to the server of the first point at or after the
+    hash of the key. Adding or removing a server only moves the keys
+    between its points and their predecessors, about 1/N of all keys, and
+    the many points per server keep the share of each server even.
+    """
+    VNODES = 64
+
+    def __init__(self, servers=(), vnodes=None):
+        self.vnodes = vnodes or HashRing.VNODES
+        self._servers = []
+        # sorted hashes of all points, and the server of each point
+        self._points = []
+        self._owners = []
+        for name in servers:
+            self.add(name)
+
+    @staticmethod
+    def hash(data):
+        digest = hashlib.blake2b(data.encode('utf-8'), digest_size=8)
+        return int.from_bytes(digest.digest(), 'big')
+
+    def servers(self):
+        return list(self._servers)
+
+    def add(self, name):
+        if name in self._servers:
+            return
+        self._servers.append(name)
+        for i in range(self.vnodes):
+            point = HashRing.hash(f'{name}#{i}')
+            index = bisect.bisect_left(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, name)
+
+    def remove(self, name):
+        if name not in self._servers:
+            return
+        self._servers.remove(name)
+        kept = [(point, owner) for point, owner
+                in zip(self._points, self._owners) if owner != name]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def owner(self, key):
+        """
+        Name of the server key belongs to, None if the ring is empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect_left(self._points, HashRing.hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+async def rebalance(network, nodes, vnodes=None, page_size=1000):
+    """
+    Move keys so that they are placed by a ring of nodes, a list of
+    (name, host, port), and make that ring the one clients use.
+
+    Each server of the old and the new ring is told the new ring in turn.
+    From then on it refuses all operations on keys it no longer owns, and
+    commits of txns that wrote them, so nothing changes a key while it is
+    in flight. The keys it gives up are copied over to their new owners
+    with their timestamps, the coordinator switches to the new ring and
+    finally the old copies are dropped. Operations on moving keys fail
+    until clients picked up the new ring, everything else keeps running.
+
+    network is a connected ClientNetwork. Returns the number of keys moved
+    """
+    vnodes = vnodes or HashRing.VNODES
+    old = await network.refresh_ring()
+    if old is None:
+        raise ConnectionError('Coordinator did not send the ring')
+    network.add_servers(nodes)
+
+    names = [name for name, _, _ in nodes]
+    involved = list(old.servers())
+    involved.extend(name for name in names if name not in involved)
+
+    ring = HashRing(names, vnodes)
+    moved = 0
+    for source in involved:
+        server = network.servers()[source]
+        start = ''
+        while True:
+            export = ExportKeysMsg(source, names, vnodes, start, page_size)
+            response = await network.request(server, export)
+            if response is None:
+                raise ConnectionError(f'{source} did not export its keys')
+
+            by_owner = collections.defaultdict(list)
+            for record in response.records:
+                by_owner[ring.owner(record[0])].append(record)
+            for owner, records in by_owner.items():
+                response_import = await network.request(
+                    network.servers()[owner], ImportKeysMsg(records))
+                if response_import is None or not response_import.success:
+                    raise ConnectionError(f'{owner} did not import keys')
+                moved += len(records)
+
+            if response.done:
+                break
+            start = response.next_key
+
+    response = await network.request(network.coordinator,
+                                     SetRingMsg(nodes, vnodes))
+    if response is None:
+        raise ConnectionError('Coordinator did not take the new ring')
+    network.set_ring(response)
+
+    for source in involved:
+        response = await network.request(network.servers()[source],
+                                         DropKeysMsg(source, names, vnodes))
+        if response is None:
+            UI.log(f'{source} did not drop its moved keys',
+                   level=logging.WARNING)
+
+    UI.log(f'Rebalanced onto {names}, moved {moved} keys')
+    return moved
+
+
+def main():
+    """
+    python3 partition.py NAME=HOST[:PORT] ...
+
+    Rebalance onto the given servers, e.g. to add F to the five in
+    nodeslist: A=host4 B=host5 C=host6 D=host7 E=host8 F=host10
+    """
+    # imported here, client imports this module for HashRing
+    from client import ClientNetwork
+
+    logging.basicConfig(level=logging.INFO)
+    nodes = []
+    for arg in sys.argv[1:]:
+        name, _, address = arg.partition('=')
+        host, _, port = address.partition(':')
+        nodes.append((name, host, int(port) if port else 0))
+    if not nodes:
+        print(main.__doc__)
+        return
+
+    evloop = asyncio.get_event_loop()
+    network = ClientNetwork()
+    evloop.run_until_complete(network.connect_to_peers())
+    moved = evloop.run_until_complete(rebalance(network, nodes))
+    network.close()
+    print(f'Moved {moved} keys')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+import asyncio
+import itertools
+import logging
+import socket
+import time
+
+from codec import VALUE, CodecError
+import framing
+from messages import (CODEC, ReplicateChunkMsg, ReplicateMsg,
+                      ReplicateRingMsg)
+from ui import UI
+
+
+class Replicator:
+    """
+    Ships the commits of a primary server to one backup.
+
+    Commits are queued by append() and sent in batches, BATCH_INTERVAL
+    seconds after the first one or as soon as BATCH_SIZE are waiting. Nobody
+    waits for the backup, so a commit costs the primary nothing but a list
+    append, and the backup lags behind by about BATCH_INTERVAL.
+
+    Installing a version is idempotent and versions are ordered by txn id,
+    not by arrival, so the backup needs no acks or sequence numbers: every
+    time the connection is (re)established the primary first streams the
+    newest version of all of its keys, and meanwhile drops whatever it
+    cannot send. Every batch says whether that catch up is done, and an
+    empty batch is sent every HEARTBEAT_INTERVAL, so the backup knows how
+    fresh it is.
+
+    Every batch also carries the closed timestamp of the primary: it
+    commits nothing at or below it anymore, so once the backup has the
+    batch it has all versions up to it, and can serve snapshots there.
+    Versions sent while catching up are marked as such: the backup may
+    have missed the ones before them, so it refuses reads below them.
+
+    The catch up starts with the ring of the primary, and every change of
+    it is sent in order with the commits, so the backup refuses the keys
+    the primary no longer owns and forgets them when the primary does.
+
+    A batch is split into ReplicateMsgs of at most BATCH_BYTES of keys and
+    values, and values larger than CHUNK_SIZE are sent ahead of the rest
+    of their txn in ReplicateChunkMsgs, so no message comes near the frame
+    size limit. Should sending still fail, the connection is dropped and
+    the backup caught up again from scratch.
+    """
+    BATCH_INTERVAL = 0.01
+    BATCH_SIZE = 512
+    # keys and values per ReplicateMsg, counted in characters for text, so
+    # at most 4 times as many bytes
+    BATCH_BYTES = 4 * 1024 * 1024
+    CHUNK_SIZE = 1024 * 1024
+    HEARTBEAT_INTERVAL = 0.1
+    # keys per batch while catching up
+    SYNC_CHUNK = 1000
+    # give up on a connection that has this many bytes waiting to be sent
+    MAX_BUFFER = 64 * 1024 * 1024
+    BACKOFF_MIN = 0.1
+    BACKOFF_MAX = 10.0
+
+    def __init__(self, host, port, storage, closed=None, stream=0,
+                 streams=1, ring=None):
+        """
+        closed returns the closed timestamp of the primary, stream is our
+        number among the streams of a primary of several workers. ring
+        returns (name, names, vnodes) of the ring of the primary, None
+        until it has one
+        """
+        self.evloop = asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.storage = storage
+        self.closed = closed or (lambda: -1)
+        self.ring = ring or (lambda: None)
+        self.stream = stream
+        self.streams = streams
+
+        self.transport = None
+        self.synced = False
+        # closed timestamp in the last batch we sent
+        self._closed = -1
+        self._seq = itertools.count(1)
+        # (txn_id, [(key, value)]) waiting for the next batch
+        self._pending = []
+        self._timer = None
+        self._last_sent = 0.0
+        self._task = None  # type: asyncio.Task
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def append(self, txn_id, writes):
+        if self.transport is None:
+            # the catch up after reconnecting will cover it
+            return
+        self._pending.append((txn_id, writes))
+        if len(self._pending) >= Replicator.BATCH_SIZE:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self.evloop.call_later(Replicator.BATCH_INTERVAL,
+                                                 self._flush)
+
+    def append_ring(self, drop):
+        """
+        Send the ring of the primary after the commits queued so far, drop
+        if the primary forgot the keys it no longer owns
+        """
+        if self.transport is None:
+            # the catch up after reconnecting starts with it
+            return
+        if self._pending:
+            self._flush()
+        self._send_ring(drop)
+
+    def _send_ring(self, drop):
+        ring = self.ring()
+        if ring is None or self.transport is None or \
+                self.transport.is_closing():
+            return
+        name, names, vnodes = ring
+        self._write(ReplicateRingMsg(name, names, vnodes, drop))
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        records, self._pending = self._pending, []
+        self._send(records)
+
+    def _send(self, records, catch_up=False):
+        """
+        Send records, (txn_id, [(key, value)]), an empty list is a
+        heartbeat. catch_up if they are newest versions sent by _sync
+        """
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() > Replicator.MAX_BUFFER:
+            UI.log(f'Backup {self.host}:{self.port} is too far behind',
+                   level=logging.WARNING)
+            self.transport.close()
+            return
+
+        try:
+            batch = []
+            size = 0
+            for txn_id, writes in records:
+                small = []
+                batch.append((txn_id, small))
+                for key, value in writes:
+                    if len(value) > Replicator.CHUNK_SIZE:
+                        self._send_chunks(txn_id, key, value, catch_up)
+                        continue
+                    if size > 0 and \
+                            size + len(key) + len(value) > \
+                            Replicator.BATCH_BYTES:
+                        self._write_batch(batch, catch_up)
+                        small = []
+                        batch, size = [(txn_id, small)], 0
+                    small.append((key, value))
+                    size += len(key) + len(value)
+            # only the last part of the batch completes what is closed
+            if self.synced:
+                self._closed = self.closed()
+            self._write_batch(batch, catch_up)
+        except (CodecError, framing.FrameError) as e:
+            # whatever we could not send is lost, start over
+            UI.log(f'Could not replicate to {self.host}:{self.port}: {e}',
+                   level=logging.ERROR)
+            self.transport.close()
+
+    def _send_chunks(self, txn_id, key, value, catch_up):
+        kind = VALUE.kind(value)
+        if kind == VALUE.KIND_STR:
+            data = value.encode('utf-8')
+        elif kind == VALUE.KIND_COMPRESSED:
+            data = value.data
+        else:
+            data = value
+
+        # chunks are views of data, encoded without copying them first
+        view = memoryview(data)
+        for offset in range(0, len(data), Replicator.CHUNK_SIZE):
+            self._write(ReplicateChunkMsg(
+                txn_id, key, len(data), offset,
+                view[offset:offset + Replicator.CHUNK_SIZE], kind,
+                catch_up))
+
+    def _write_batch(self, batch, catch_up):
+        self._write(ReplicateMsg([record for record in batch if record[1]],
+                                 self.synced, self._closed, self.stream,
+                                 self.streams, catch_up))
+
+    def _write(self, msg):
+        msg.uid = next(self._seq) & 0xFFFFFFFF
+        self.transport.write(framing.pack(CODEC.encode(msg)))
+        self._last_sent = time.monotonic()
+
+    async def _run(self):
+        backoff = 0.0
+        while True:
+            lost = self.evloop.create_future()
+            try:
+                nodeip = socket.gethostbyname(self.host)
+                self.transport, _ = await self.evloop.create_connection(
+                    lambda: Replicator.Protocol(lost),
+                    host=nodeip, port=self.port, family=socket.AF_INET)
+            except OSError as e:
+                backoff = min(max(2 * backoff, Replicator.BACKOFF_MIN),
+                              Replicator.BACKOFF_MAX)
+                UI.log(f'Could not reach backup {self.host}:{self.port}: '
+                       f'{e}', level=logging.WARNING)
+                await asyncio.sleep(backoff)
+                continue
+
+            backoff = 0.0
+            UI.log(f'Replicating to {self.host}:{self.port}')
+            try:
+                await self._sync()
+                while not lost.done():
+                    await asyncio.wait([lost], timeout=self._heartbeat_due())
+                    if time.monotonic() - self._last_sent >= \
+                            Replicator.HEARTBEAT_INTERVAL:
+                        # with what is pending, the closed timestamp
+                        # covers it
+                        self._flush()
+            finally:
+                self.synced = False
+                self._closed = -1
+                self._pending = []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                self.transport.close()
+                self.transport = None
+            UI.log(f'Lost backup {self.host}:{self.port}',
+                   level=logging.WARNING)
+
+    def _heartbeat_due(self):
+        return max(0.0, self._last_sent + Replicator.HEARTBEAT_INTERVAL -
+                   time.monotonic())
+
+    async def _sync(self):
+        """
+        Send the newest version of every key, a chunk per loop iteration.
+        Commits made meanwhile are queued by append() as usual.
+
+        Keys in memory are sent from there, all others straight from the
+        checkpoint, which does not pull them into memory like
+        Storage.get() would
+        """
+        self._send_ring(False)
+        actual = self.storage.actual()
+        keys = list(actual.keys())
+        for start in range(0, len(keys), Replicator.SYNC_CHUNK):
+            records = []
+            for key in keys[start:start + Replicator.SYNC_CHUNK]:
+                data_obj = actual.get(key, None)
+                if data_obj is not None and data_obj.commit_txn >= 0:
+                    records.append((data_obj.commit_txn,
+                                    [(key, data_obj.value)]))
+            if not await self._send_sync(records):
+                return
+
+        # a key pulled into memory since is still the same in the
+        # checkpoint, and one changed since was sent by append()
+        sent = set(keys)
+        checkpoint = self.storage.checkpoint()
+        index = 0
+        while checkpoint is not None and index < len(checkpoint):
+            records = []
+            for key, value, _, _, commit_txn in itertools.islice(
+                    checkpoint.records(index), Replicator.SYNC_CHUNK):
+                index += 1
+                if key in sent or key in self.storage.dropped() or \
+                        commit_txn < 0:
+                    continue
+                records.append((commit_txn, [(key, value)]))
+            if not await self._send_sync(records):
+                return
+
+            # a new checkpoint has everything the old one had, go on there
+            if self.storage.checkpoint() is not checkpoint:
+                checkpoint = self.storage.checkpoint()
+                index = checkpoint.find(key + '\0')
+
+        self.synced = True
+        self._flush()
+
+    async def _send_sync(self, records):
+        """
+        Send a chunk of the catch up, False if the connection was lost
+        """
+        self._send(records, catch_up=True)
+        if self.transport is None or self.transport.is_closing():
+            return False
+        await asyncio.sleep(0)
+        return True
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    class Protocol(asyncio.Protocol):
+        # backups never answer, we only need to know when they go away
+        def __init__(self, lost):
+            self.lost = lost
+
+        def connection_lost(self, exc):
+            if not self.lost.done():
+                self.lost.set_result(exc)
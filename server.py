@@ -1,267 +1,1677 @@
 import asyncio
+import bisect
+import collections
+import itertools
+import json
 import logging
-import pickle
+import os
 import socket
 import sys
+import time
 
+from checkpoint import Checkpoint
+import framing
+from hlc import HybridClock
+import logs
 from messages import *
+from metrics import Metrics
 import nodeslist
+from partition import HashRing
+from replication import Replicator
+from sortedkeys import SortedKeys
 from ui import UI
+from wal import WriteAheadLog
 
 
 class Storage:
+    # committed versions kept per key, on top of what GC already drops
+    MAX_VERSIONS = 8
+    # a txn not heard from in this many seconds is aborted, and no longer
+    # holds back GC
+    TXN_LEASE = 10.0
+
     def __init__(self):
         # key(str) -> DataObj
         self._actual = dict()
-
-        self._buffer = dict()
-        self._buffer_txn = dict()
-
-        for client in nodeslist.clients:
-            # key(str) -> DataObj
-            client_ip = socket.gethostbyname(client)
-            self._buffer[client_ip] = dict()
-            self._buffer_txn[client_ip] = -1
+        # every key of _actual
+        self._index = SortedKeys()
+
+        # txn_id -> Storage.Txn, for every txn we heard from recently
+        self._txns = dict()
+        # txn_id -> time.monotonic() it was aborted or its lease expired.
+        # Whatever it still sends is refused, instead of starting it anew
+        # without the writes it lost
+        self._ended = dict()
+        # key(str) -> ids of the txns with a tentative write to it
+        self._writers = dict()
+        # every key of _writers
+        self._writer_keys = SortedKeys()
+        # ranges read by txns
+        self._range_reads = Storage.RangeReads()
+
+        # keys not in _actual yet are looked up here and then cached
+        self._checkpoint = None  # type: Checkpoint
+
+        # keys moved to another server, never pulled from the checkpoint
+        self._dropped = set()
 
     def actual(self):
         return self._actual
 
-    def buffer(self, client_ip):
-        return self._buffer[client_ip]
-
-    def buffer_txn(self, client_ip):
-        return self._buffer_txn[client_ip]
-
-    def set_buffer_txn(self, client_ip, txn_id):
-        self._buffer_txn[client_ip] = txn_id
+    def get(self, key):
+        """
+        DataObj of key, pulled in from the checkpoint on first use, or None
+        if the key does not exist
+        """
+        data_obj = self._actual.get(key, None)
+        if data_obj is None and self._checkpoint is not None and \
+                key not in self._dropped:
+            record = self._checkpoint.get(key)
+            if record is not None:
+                _, value, last_rd_txn, last_wr_txn, commit_txn = record
+                data_obj = Storage.DataObj(last_rd_txn, last_wr_txn)
+                data_obj.add_version(commit_txn, value)
+                # older versions were not kept, reads below it are refused
+                data_obj.collected = True
+                self._add(key, data_obj)
+        return data_obj
+
+    def _add(self, key, data_obj):
+        self._actual[key] = data_obj
+        self._index.add(key)
+
+    def keys(self):
+        """
+        Every key we hold, in memory or only in the checkpoint
+        """
+        keys = set(self._actual.keys())
+        if self._checkpoint is not None:
+            keys.update(key for key in self._checkpoint.keys()
+                        if key not in self._dropped)
+        return keys
+
+    def range(self, start, end, limit):
+        """
+        First limit keys we hold from start on, and before end unless end
+        is '', in order. Keys only in the checkpoint are included
+        """
+        def before_end(key):
+            return end == '' or key < end
+
+        keys = list(itertools.islice(self._index.irange(start, end), limit))
+
+        if self._checkpoint is not None:
+            found = 0
+            for key in self._checkpoint.keys(self._checkpoint.find(start)):
+                if not before_end(key) or found == limit:
+                    break
+                if key not in self._dropped:
+                    keys.append(key)
+                    found += 1
+            keys = sorted(set(keys))
+        return keys[:limit]
+
+    def drop(self, key):
+        """
+        Forget key, after it moved to another server
+        """
+        if self._actual.pop(key, None) is not None:
+            self._index.discard(key)
+        self._dropped.add(key)
+
+    def dropped(self):
+        return self._dropped
+
+    def checkpoint(self):
+        return self._checkpoint
+
+    def set_checkpoint(self, checkpoint):
+        """
+        Serve keys from checkpoint from now on, returns the previous one
+        """
+        old, self._checkpoint = self._checkpoint, checkpoint
+        return old
+
+    def txn(self, txn_id):
+        return self._txns.get(txn_id, None)
+
+    def txns(self):
+        return self._txns
+
+    def touch(self, txn_id):
+        """
+        Txn of txn_id, created on first use, with its lease renewed. None
+        if txn_id was aborted
+        """
+        if txn_id in self._ended:
+            return None
+        txn = self._txns.get(txn_id, None)
+        if txn is None:
+            txn = Storage.Txn()
+            self._txns[txn_id] = txn
+        else:
+            txn.last_seen = time.monotonic()
+        return txn
+
+    def finish(self, txn_id):
+        """
+        Forget txn_id, returns its buffer
+        """
+        txn = self._txns.pop(txn_id, None)
+        if txn is None:
+            return dict()
+        for key in txn.buffer:
+            writers = self._writers[key]
+            writers.discard(txn_id)
+            if not writers:
+                del self._writers[key]
+                self._writer_keys.discard(key)
+        return txn.buffer
+
+    def abort(self, txn_id):
+        """
+        Forget txn_id and refuse it from now on, False if we did not know it
+        """
+        known = txn_id in self._txns
+        self.finish(txn_id)
+        self._ended[txn_id] = time.monotonic()
+        return known
+
+    def aborted(self, txn_id):
+        return txn_id in self._ended
+
+    def prepare(self, txn_id):
+        """
+        Remember that we voted yes on txn_id, which starts a new lease
+        """
+        txn = self._txns[txn_id]
+        txn.prepared = True
+        txn.last_seen = time.monotonic()
+
+    def expire(self):
+        """
+        Abort every txn whose lease ran out, returns them, txn_id -> txn.
+
+        That includes prepared txns not told the outcome within a lease of
+        their vote, whose coordinator is taken to be gone. Other servers
+        may have committed them: the caller has to report them loudly
+        """
+        deadline = time.monotonic() - Storage.TXN_LEASE
+        expired = {txn_id: txn for txn_id, txn in self._txns.items()
+                   if txn.last_seen < deadline}
+        for txn_id in expired:
+            self.abort(txn_id)
+        return expired
+
+    def collect_aborted(self):
+        """
+        Forget aborted txns that can no longer reach us: older than every
+        active txn, and aborted long enough ago that anything they sent
+        before would have arrived
+        """
+        oldest_active = self.oldest_active()
+        horizon = time.monotonic() - Storage.TXN_LEASE
+        self._ended = {
+            txn_id: ended for txn_id, ended in self._ended.items()
+            if ended > horizon or (oldest_active is not None and
+                                   txn_id > oldest_active)}
+
+    def oldest_active(self):
+        """
+        Smallest txn id that may still read from us, None if there is none
+        """
+        return min(self._txns.keys(), default=None)
+
+    def write(self, txn_id, key, value):
+        """
+        Buffer a tentative write of key by txn_id, until it commits
+        """
+        self.touch(txn_id).buffer[key] = value
+        writers = self._writers.get(key, None)
+        if writers is None:
+            writers = self._writers[key] = set()
+            self._writer_keys.add(key)
+        writers.add(txn_id)
+
+    def prepared_write_below(self, key, txn_id):
+        """
+        True if a txn older than txn_id that we voted yes on has written
+        key. It may commit any time, whatever a read finds now
+        """
+        return any(writer < txn_id and self._txns[writer].prepared
+                   for writer in self._writers.get(key, ()))
+
+    def prepared_write_in(self, start, end, txn_id):
+        """
+        True if a txn older than txn_id that we voted yes on has written a
+        key from start on and before end, or after start if end is ''
+        """
+        return any(self.prepared_write_below(key, txn_id)
+                   for key in self._writer_keys.irange(start, end))
+
+    def read_range(self, start, end, txn_id):
+        """
+        Remember that txn_id read every key from start on and before end,
+        or after start if end is '', including keys that do not exist yet
+        """
+        self._range_reads.add(start, end, txn_id, time.monotonic())
+
+    def range_read_above(self, key, txn_id):
+        """
+        True if a txn newer than txn_id read a range key is in
+        """
+        return self._range_reads.above(key, txn_id)
+
+    def collect_range_reads(self):
+        """
+        Forget ranges no txn can write to anymore without being seen: the
+        reader is not newer than any active txn, and read long enough ago
+        that an older txn which has not reached us yet would have expired
+        """
+        self._range_reads.collect(self.oldest_active(),
+                                  time.monotonic() - Storage.TXN_LEASE)
+
+    class RangeReads:
+        """
+        Newest txn that read each part of the key space by range. The
+        parts start at the bounds, each goes up to the next bound or has no
+        end, and is marked with (txn_id, time.monotonic() of its latest
+        read), or None if no txn read it. A range read marks the parts it
+        covers, splitting the ones it starts or ends in
+        """
+
+        def __init__(self):
+            self.bounds = SortedKeys([''])
+            # bound -> mark of the part starting there
+            self.marks = {'': None}
+
+        def _split(self, key):
+            if key not in self.marks:
+                self.marks[key] = self.marks[self.bounds.floor(key)]
+                self.bounds.add(key)
+
+        def add(self, start, end, txn_id, now):
+            """
+            Mark the parts from start on and before end, or after start if
+            end is '', as read by txn_id
+            """
+            self._split(start)
+            if end != '':
+                self._split(end)
+            for bound in self.bounds.irange(start, end):
+                mark = self.marks[bound]
+                if mark is None:
+                    self.marks[bound] = (txn_id, now)
+                else:
+                    self.marks[bound] = (max(mark[0], txn_id),
+                                         max(mark[1], now))
+
+        def above(self, key, txn_id):
+            mark = self.marks[self.bounds.floor(key)]
+            return mark is not None and mark[0] > txn_id
+
+        def collect(self, oldest_active, horizon):
+            """
+            Unmark the parts read before horizon by a txn not newer than
+            oldest_active, and merge neighbours with the same reader. Only
+            the newest reader of a part is kept, with the time of its latest
+            read, so a part may stay marked a little longer than needed
+            """
+            bounds = []
+            marks = dict()
+            last = None
+            for bound in self.bounds:
+                mark = self.marks[bound]
+                if mark is not None and mark[1] <= horizon and \
+                        (oldest_active is None or mark[0] <= oldest_active):
+                    mark = None
+                if bounds and (mark is None) == (last is None) and \
+                        (mark is None or mark[0] == last[0]):
+                    if mark is not None:
+                        last = marks[bounds[-1]] = \
+                            (mark[0], max(mark[1], last[1]))
+                    continue
+                bounds.append(bound)
+                marks[bound] = last = mark
+            self.bounds = SortedKeys(bounds)
+            self.marks = marks
+
+    class Txn:
+        def __init__(self):
+            # key(str) -> value, written here but not committed yet
+            self.buffer = dict()
+            self.last_seen = time.monotonic()
+            # voted yes to a TryCommit, waiting for DoCommit or Abort. The
+            # vote renews the lease, see Storage.expire
+            self.prepared = False
+            # key(str) -> Storage.Chunks of a value still arriving
+            self.chunks = dict()
+
+    class Chunks:
+        """
+        A large value arriving in chunks, each copied straight into its
+        place in a buffer of the full size. A chunk that arrives again is
+        only counted once
+        """
+
+        def __init__(self, size, kind):
+            self.size = size
+            self.buffer = bytearray(size)
+            self.kind = kind
+            # offset -> length of each chunk that arrived
+            self.offsets = dict()
+            self.received = 0
+
+        def write(self, offset, data):
+            with memoryview(self.buffer) as view:
+                view[offset:offset + len(data)] = data
+            self.received += len(data) - self.offsets.get(offset, 0)
+            self.offsets[offset] = len(data)
+
+        def complete(self):
+            """
+            True once the chunks cover the whole value
+            """
+            if self.received < self.size:
+                return False
+            end = 0
+            for offset in sorted(self.offsets):
+                if offset > end:
+                    return False
+                end = max(end, offset + self.offsets[offset])
+            return end >= self.size
+
+        def value(self):
+            # bytes are stored as the buffer itself, without a copy. Text
+            # has to become a str, it is decoded straight from the buffer
+            if self.kind == VALUE.KIND_STR:
+                return str(self.buffer, 'utf-8')
+            if self.kind == VALUE.KIND_COMPRESSED:
+                return Compressed(self.buffer)
+            return self.buffer
+
+    def install(self, key, txn_id, value, oldest_active=None):
+        """
+        Add the version of key committed by txn_id, returns its DataObj
+        """
+        data_obj = self.get(key)
+        if data_obj is None:
+            data_obj = Storage.DataObj()
+            self._add(key, data_obj)
+            self._dropped.discard(key)
+
+        data_obj.add_version(txn_id, value)
+        data_obj.last_wr_txn = max(data_obj.last_wr_txn, txn_id)
+        data_obj.collect(oldest_active)
+        return data_obj
 
     class DataObj:
-        def __init__(self, value, last_rd_txn=-1, last_wr_txn=-1):
-            self.value = value
+        """
+        Committed versions of a key, oldest first, each tagged with the txn
+        that committed it
+        """
+
+        def __init__(self, last_rd_txn=-1, last_wr_txn=-1):
+            # newest txn that read the key, and newest that committed a
+            # write to it. Writes still in a txn buffer are not counted,
+            # they may yet abort
             self.last_rd_txn = last_rd_txn
             self.last_wr_txn = last_wr_txn
 
+            # kept sorted, versions[i] was committed by commits[i] and
+            # installed at time.monotonic() installed[i]
+            self.commits = []
+            self.versions = []
+            self.installed = []
+            # set once GC dropped a version, reads older than every
+            # remaining version can no longer be answered
+            self.collected = False
+
+        @property
+        def value(self):
+            return self.versions[-1] if self.versions else ''
+
+        @property
+        def commit_txn(self):
+            return self.commits[-1] if self.commits else -1
+
+        def read(self, txn_id):
+            """
+            Newest value committed at or before txn_id as (success, value).
+            value is '' if the key did not exist yet at txn_id, success is
+            False if the version txn_id needs was garbage collected
+            """
+            index = bisect.bisect_right(self.commits, txn_id)
+            if index == 0:
+                return not self.collected, ''
+            return True, self.versions[index - 1]
+
+        def add_version(self, txn_id, value):
+            index = bisect.bisect_right(self.commits, txn_id)
+            if index > 0 and self.commits[index - 1] == txn_id:
+                self.versions[index - 1] = value
+            else:
+                self.commits.insert(index, txn_id)
+                self.versions.insert(index, value)
+                self.installed.insert(index, time.monotonic())
+
+        def forget_below(self, txn_id):
+            """
+            Drop the versions older than txn_id, for a version that may not
+            follow the ones we have: reads below it are refused instead
+            """
+            index = bisect.bisect_left(self.commits, txn_id)
+            del self.commits[:index]
+            del self.versions[:index]
+            del self.installed[:index]
+            self.collected = True
+
+        def collect(self, oldest_active):
+            """
+            Drop versions no txn can read anymore. A version is dead once
+            the version after it is at or below oldest_active, and was
+            installed long enough ago that an older txn which has not
+            reached us yet would have expired anyway. Never keep more than
+            MAX_VERSIONS
+            """
+            horizon = time.monotonic() - Storage.TXN_LEASE
+
+            keep_from = 0
+            while keep_from + 1 < len(self.commits):
+                newer = keep_from + 1
+                if oldest_active is not None and \
+                        self.commits[newer] > oldest_active:
+                    break
+                if self.installed[newer] > horizon:
+                    break
+                keep_from = newer
+            keep_from = max(keep_from,
+                            len(self.commits) - Storage.MAX_VERSIONS)
+
+            if keep_from > 0:
+                del self.commits[:keep_from]
+                del self.versions[:keep_from]
+                del self.installed[:keep_from]
+                self.collected = True
+
 
 class ServerNetwork:
     PORT = 13337
     SELF_ADDR = socket.gethostbyname(socket.gethostname())
-
-    def __init__(self):
+    WAL_PATH = 'server.wal'
+    # group commit: fsync at most this long after a commit, or as soon as
+    # this many commits are waiting
+    WAL_FLUSH_INTERVAL = WriteAheadLog.FLUSH_INTERVAL
+    WAL_BATCH_SIZE = WriteAheadLog.BATCH_SIZE
+    CHECKPOINT_PATH = 'server.ckpt'
+    # seconds between checkpoints, skipped if nothing was committed
+    CHECKPOINT_INTERVAL = 300
+    # keys copied per event loop iteration while taking a checkpoint
+    CHECKPOINT_CHUNK = 10000
+    # msg type -> only log one in every n of these sent or received
+    LOG_SAMPLING = {'GetMsg': 100, 'GetMsgResponse': 100,
+                    'SetMsg': 100, 'SetMsgResponse': 100,
+                    'BatchMsg': 100, 'BatchMsgResponse': 100,
+                    'SetChunkMsg': 100, 'SetChunkMsgResponse': 100,
+                    'GetChunkMsg': 100, 'GetChunkMsgResponse': 100,
+                    'ReplicateMsg': 100, 'ReplicateChunkMsg': 100}
+    STATS_PATH = 'server.stats.json'
+    # partition ring this server was last told about, see partition.py
+    RING_PATH = 'server.ring'
+    # a backup refuses reads once it has not heard from its primary for
+    # this many seconds
+    MAX_STALENESS = 1.0
+    # seconds the closed timestamp trails the newest txn id we saw. A txn
+    # older than it that only reaches us by then can no longer commit
+    CLOSED_LAG = 0.5
+    # seconds a primary holds a snapshot read back for the older txns here
+    # to end, see close_up_to
+    SNAPSHOT_WAIT = 1.0
+    # seconds between dumps of the metrics to STATS_PATH
+    STATS_INTERVAL = 10
+    # most keys a single ScanMsg returns
+    MAX_SCAN = 10000
+    # largest value we store, in bytes, or characters for text
+    MAX_VALUE_SIZE = 64 * 1024 * 1024
+    # bytes of values a txn may have arriving in chunks at once, each of
+    # them held in full until its last chunk arrives
+    MAX_CHUNKED_BYTES = 2 * MAX_VALUE_SIZE
+    # values larger than this are sent to clients a chunk at a time
+    CHUNK_SIZE = 256 * 1024
+    # replies holding many values send only their sizes past this, in
+    # characters for text, which keeps them well under MAX_FRAME_SIZE
+    MAX_REPLY = 8 * 1024 * 1024
+
+    def __init__(self, port=None, wal_path=None, checkpoint_path=None,
+                 stats_path=None, ring_path=None, backups=(),
+                 replica_of=None):
+        """
+        backups are the (host, port) we ship our commits to. A server with
+        replica_of set is a backup of that primary instead, it only applies
+        what the primary ships and serves read-only txns
+        """
         self.evloop = asyncio.get_event_loop()
         self.storage = Storage()
+        self.metrics = Metrics()
+        # only ever read or moved up, servers issue no timestamps
+        self.clock = HybridClock()
+        self.port = port or ServerNetwork.PORT
+        self.stats_path = stats_path or ServerNetwork.STATS_PATH
+
+        self.checkpoint_path = checkpoint_path or \
+            ServerNetwork.CHECKPOINT_PATH
+        self.wal = WriteAheadLog(wal_path or ServerNetwork.WAL_PATH,
+                                 ServerNetwork.WAL_FLUSH_INTERVAL,
+                                 ServerNetwork.WAL_BATCH_SIZE)
+        self.recover()
+        self.wal.open()
+
+        # our name and the ring we are part of, until we are told about a
+        # ring we own every key we are sent
+        self.ring_path = ring_path or ServerNetwork.RING_PATH
+        self.name = None
+        self.ring = None  # type: HashRing
+        self.load_ring()
+        # sorted keys we hold but no longer own, while they are exported
+        self.outgoing = None
+
+        self.replicators = [Replicator(host, port or ServerNetwork.PORT,
+                                       self.storage, self.close_timestamp,
+                                       ring=self.ring_of)
+                            for host, port in backups]
+        self.replica_of = replica_of
+        # when the primary last told us we are up to date
+        self.last_synced = None
+
+        # as a primary, the closed timestamp we sent our backups, and the
+        # newest txn id we saw with samples of it over the last CLOSED_LAG
+        self.closed = -1
+        self.newest_txn_id = -1
+        self._newest_samples = collections.deque()
+        # as a backup, the closed timestamp of each stream of the primary,
+        # and how many streams it has, see ReplicateMsg
+        self.replica_closed = dict()
+        self.replica_streams = 1
+        # (txn_id, key, Storage.Chunks) of the large value the primary is
+        # sending us, see Replicator
+        self.replica_chunks = None
+
+        # commits since the last checkpoint
+        self.dirty = 0
+        self.checkpointer = None  # type: asyncio.Task
+        self.leases = None  # type: asyncio.Task
+        self.stats = None  # type: asyncio.Task
+
+        self.metrics.gauge('keys', lambda: len(self.storage.actual()))
+        self.metrics.gauge('txns', lambda: len(self.storage.txns()))
+        self.metrics.gauge('buffered_writes', lambda: sum(
+            len(txn.buffer) for txn in self.storage.txns().values()))
+        self.metrics.gauge('wal_segment', lambda: self.wal.segment)
+        self.metrics.gauge('backups_synced', lambda: sum(
+            replicator.synced for replicator in self.replicators))
+        self.metrics.gauge('staleness', self.staleness)
+        self.metrics.gauge('compression_ratio',
+                           lambda: compression_ratio(self.metrics.counters))
+
+    def load_ring(self):
+        if os.path.exists(self.ring_path):
+            with open(self.ring_path) as f:
+                ring = json.load(f)
+            self._set_ring(ring['name'], ring['names'], ring['vnodes'])
+
+    def _set_ring(self, name, names, vnodes):
+        if self.ring is not None and self.name == name and \
+                self.ring.servers() == list(names) and \
+                self.ring.vnodes == vnodes:
+            return
+
+        self.name = name
+        self.ring = HashRing(names, vnodes)
+        self.outgoing = None
+
+        tmp_path = self.ring_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'name': name, 'names': list(names), 'vnodes': vnodes},
+                      f)
+        os.replace(tmp_path, self.ring_path)
+        UI.log(f'Now {name} in ring {list(names)}')
+
+    def ring_of(self):
+        """
+        (name, names, vnodes) of our ring, None until we are told about one
+        """
+        if self.ring is None:
+            return None
+        return self.name, self.ring.servers(), self.ring.vnodes
+
+    def owns(self, key):
+        return self.ring is None or self.ring.owner(key) == self.name
+
+    def close_timestamp(self):
+        """
+        Move the closed timestamp up to the newest txn id we saw
+        CLOSED_LAG ago, but below every active txn, and return it. We
+        commit nothing at or below it from then on
+        """
+        now = time.monotonic()
+        samples = self._newest_samples
+        samples.append((now, self.newest_txn_id))
+        closed = self.closed
+        while samples and samples[0][0] <= now - ServerNetwork.CLOSED_LAG:
+            closed = max(closed, samples.popleft()[1])
+        oldest_active = self.storage.oldest_active()
+        if oldest_active is not None:
+            closed = min(closed, oldest_active - 1)
+        self.closed = max(self.closed, closed)
+        return self.closed
+
+    def close_up_to(self, txn_id):
+        """
+        Move the closed timestamp up to txn_id for a snapshot read on a
+        primary, unless a txn at or below it is still active here. True
+        once it is closed. An older txn that has not reached us yet can no
+        longer commit then, as if it wrote a key the snapshot read
+        """
+        if txn_id > self.closed:
+            oldest_active = self.storage.oldest_active()
+            if oldest_active is None or oldest_active > txn_id:
+                self.closed = txn_id
+        return txn_id <= self.closed
+
+    def snapshot_closed(self):
+        """
+        Newest snapshot we can serve: on a primary its closed timestamp, on
+        a backup the closed timestamp of all streams of the primary, -1
+        until we heard it from all of them
+        """
+        if self.replica_of is None:
+            return self.closed
+        if len(self.replica_closed) < self.replica_streams:
+            return -1
+        return min(self.replica_closed.values())
+
+    def staleness(self):
+        """
+        Seconds since a backup was last known to be up to date, None if it
+        never was. 0 on a primary
+        """
+        if self.replica_of is None:
+            return 0.0
+        if self.last_synced is None:
+            return None
+        return time.monotonic() - self.last_synced
+
+    def recover(self):
+        """
+        Map the last checkpoint, then rebuild everything committed after it,
+        including last_wr_txn, from the log
+        """
+        from_segment = 0
+        if os.path.exists(self.checkpoint_path):
+            checkpoint = Checkpoint(self.checkpoint_path)
+            self.storage.set_checkpoint(checkpoint)
+            from_segment = checkpoint.wal_segment
+            UI.log(f'Mapped {len(checkpoint)} keys from '
+                   f'{self.checkpoint_path}')
+
+        count = 0
+        for txn_id, writes in self.wal.replay(from_segment):
+            for key, value in writes:
+                self.storage.install(key, txn_id, value)
+            count += 1
+        UI.log(f'Replayed {count} txns from {self.wal.path}')
 
     async def create_server(self):
         self.server = await self.evloop.create_server(
-            lambda: ServerProtocol(self.request_handler),
-            port=ServerNetwork.PORT, family=socket.AF_INET,
+            lambda: ServerProtocol(self.request_handler, self.metrics),
+            port=self.port, family=socket.AF_INET,
             reuse_address=True, reuse_port=True
         )
+        self.checkpointer = asyncio.ensure_future(self.checkpoint_loop())
+        self.leases = asyncio.ensure_future(self.lease_loop())
+        self.stats = asyncio.ensure_future(self.metrics.dump_loop(
+            self.stats_path, ServerNetwork.STATS_INTERVAL))
+        for replicator in self.replicators:
+            replicator.start()
         UI.log('Created server...')
 
+    async def checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(ServerNetwork.CHECKPOINT_INTERVAL)
+            if self.dirty == 0:
+                continue
+            try:
+                await self.checkpoint()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the log still has everything, try again next time
+                UI.log(f'Checkpoint failed: {e!r}', level=logging.ERROR)
+
+    async def checkpoint(self):
+        """
+        Write the newest version of every key to checkpoint_path and drop
+        the log segments it makes redundant.
+
+        The copy is fuzzy: it is taken a chunk at a time so the loop keeps
+        serving requests, and commits may land in between. That is safe
+        because the log is rotated first, so every commit the copy might
+        have missed is also in the new segment, and replaying a commit on
+        top of a checkpoint that already has it changes nothing.
+        """
+        segment = self.wal.rotate()
+        self.dirty = 0
+
+        actual = self.storage.actual()
+        keys = list(actual.keys())
+        records = []
+        for start in range(0, len(keys), ServerNetwork.CHECKPOINT_CHUNK):
+            for key in keys[start:start + ServerNetwork.CHECKPOINT_CHUNK]:
+                # dropped since, after it moved to another server
+                data_obj = actual.get(key, None)
+                if data_obj is None:
+                    continue
+                records.append((key, data_obj.value, data_obj.last_rd_txn,
+                                data_obj.last_wr_txn, data_obj.commit_txn))
+            await asyncio.sleep(0)
+
+        # sorting, merging and writing all happen off the loop
+        old = self.storage.checkpoint()
+        dropped = set(self.storage.dropped())
+        await self.evloop.run_in_executor(
+            None, ServerNetwork._write_checkpoint, self.checkpoint_path,
+            records, old, segment, dropped)
+
+        self.storage.set_checkpoint(Checkpoint(self.checkpoint_path))
+        if old is not None:
+            old.close()
+        self.wal.drop_before(segment)
+        UI.log(f'Checkpointed {len(records)} keys in memory, log now starts '
+               f'at segment {segment}')
+
+    @staticmethod
+    def _write_checkpoint(path, records, old, segment, dropped):
+        # keys copied before they were dropped are gone too
+        records = sorted((record for record in records
+                          if record[0] not in dropped),
+                         key=lambda record: record[0])
+
+        def merged():
+            # keys only in the old checkpoint were never touched since, so
+            # carry them over unless they moved away; keys we have in
+            # memory are newer
+            i = 0
+            for old_record in (old.records() if old is not None else ()):
+                if old_record[0] in dropped:
+                    continue
+                while i < len(records) and records[i][0] < old_record[0]:
+                    yield records[i]
+                    i += 1
+                if i < len(records) and records[i][0] == old_record[0]:
+                    continue
+                yield old_record
+            yield from records[i:]
+
+        Checkpoint.write(path, merged(), segment)
+
+    def handler(self, msg):
+        """
+        Method that handles msg, None if we do not handle its type
+        """
+        return getattr(self, f'handle_{msg.type()}', None)
+
     def request_handler(self, msg, transport):
         cls = msg.__class__.__name__
-        handler = getattr(self, f'handle_{cls}', None)
+        handler = self.handler(msg)
 
         if handler is None:
             UI.log(f'Dont recognize msg {cls}', level=logging.WARNING)
             return
 
-        UI.log(f'Got {str(msg)}')
+        UI.log('Got %s', msg, sample=msg.type())
+        start = time.perf_counter()
+
+        # keep our clock ahead of the txns we see, see hlc.py. A txn id too
+        # far ahead of it is refused like an aborted txn, it would hold
+        # back the closed timestamp and every txn after it
+        txn_id = getattr(msg, 'txn_id', None)
+        if txn_id is not None and not self.clock.update(txn_id):
+            self.metrics.incr('denied.clock')
+            self.storage.abort(txn_id)
+        elif txn_id is not None and txn_id > self.newest_txn_id:
+            self.newest_txn_id = txn_id
+
         response = handler(msg)
 
+        # handlers that must wait (e.g. for the log) return a coroutine
+        if asyncio.iscoroutine(response):
+            task = asyncio.ensure_future(response)
+            task.add_done_callback(
+                lambda done: self._send_response(done, msg, transport, start))
+            return
+        self.metrics.time(cls, time.perf_counter() - start)
+
+        if response is not None:
+            self._write_response(response, msg, transport)
+
+    def _send_response(self, task, msg, transport, start):
+        self.metrics.time(msg.type(), time.perf_counter() - start)
+        if task.cancelled() or task.exception() is not None:
+            UI.log(f'Failed to handle {str(msg)}', level=logging.ERROR)
+            return
+        if transport.is_closing():
+            return
+
+        response = task.result()
         if response is not None:
-            response.origin = ServerNetwork.SELF_ADDR
-            response.destination = msg.origin
+            self._write_response(response, msg, transport)
+
+    def _write_response(self, response, msg, transport):
+        response.origin = ServerNetwork.SELF_ADDR
+        response.destination = msg.origin
+        # clients move their clocks up to ours
+        if hasattr(response, 'clock'):
+            response.clock = self.clock.read()
 
-            UI.log(f'Sending {str(response)}')
-            pickled = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
-            transport.write(pickled)
+        UI.log('Sending %s', response, sample=response.type())
+        transport.write(framing.pack(CODEC.encode(response)))
 
     def handle_SetMsg(self, msg):
-        client_ip = msg.origin
-
-        if self.storage.buffer_txn(client_ip) > msg.txn_id:
-            curr_txn_id = self.storage.buffer_txn(client_ip)
-            UI.log(f'!!! TXN ORDERING VIOLATED !!!', level=logging.CRITICAL)
-            UI.log(f'RECVD {msg.txn_id} over {curr_txn_id}',
-                   level=logging.CRITICAL)
-
-        # update current txn ID for that client
-        self.storage.set_buffer_txn(client_ip, msg.txn_id)
-
-        # check key in actual storage
-        if msg.key in self.storage.actual():
-            last_rd_txn = self.storage.actual()[msg.key].last_rd_txn
-            last_wr_txn = self.storage.actual()[msg.key].last_wr_txn
-
-            # check if has permission to write
-            if msg.txn_id >= last_rd_txn and msg.txn_id >= last_wr_txn:
-                # update write permission
-                self.storage.actual()[msg.key].last_wr_txn = msg.txn_id
-
-                # write key to cache (never write to actual in SetMsg!)
-                if msg.key in self.storage.buffer(client_ip):
-                    self.storage.buffer(client_ip)[msg.key].value = msg.value
-                else:
-                    self.storage.buffer(client_ip)[msg.key] = \
-                        Storage.DataObj(msg.value)
-                success = True
-            else:
-                # NO PERMISSION!
-                success = False
-        else:
-            # key not in storage, add/update to buffer
-            if msg.key in self.storage.buffer(client_ip):
-                self.storage.buffer(client_ip)[msg.key].value = msg.value
-            else:
-                self.storage.buffer(client_ip)[msg.key] = \
-                    Storage.DataObj(msg.value)
-            success = True
+        success = self._set(msg.txn_id, msg.key, msg.value)
 
         response = SetMsgResponse(msg.uid, success)
         return response
 
     def handle_GetMsg(self, msg):
-        client_ip = msg.origin
+        if msg.readonly:
+            return self._snapshot(msg, self._get_response)
+        return self._get_response(msg)
 
-        if self.storage.buffer_txn(client_ip) > msg.txn_id:
-            curr_txn_id = self.storage.buffer_txn(client_ip)
-            UI.log(f'!!! TXN ORDERING VIOLATED !!!', level=logging.CRITICAL)
-            UI.log(f'RECVD {msg.txn_id} over {curr_txn_id}',
-                   level=logging.CRITICAL)
+    def _get_response(self, msg):
+        if msg.readonly:
+            success, value = self._snapshot_get(msg.txn_id, msg.key)
+        else:
+            success, value = self._get(msg.txn_id, msg.key)
 
-        # update current txn ID for that client
-        self.storage.set_buffer_txn(client_ip, msg.txn_id)
+        response = GetMsgResponse(msg.uid, success,
+                                  self._chunk(value, 0))
+        response.size = len(value)
+        return response
+
+    @staticmethod
+    def _chunk(value, offset):
+        """
+        The chunk of value from offset on, a view rather than a copy for
+        bytes, which is encoded before the value can change
+        """
+        end = offset + ServerNetwork.CHUNK_SIZE
+        if isinstance(value, str):
+            return value[offset:end]
+        if isinstance(value, Compressed):
+            return Compressed(memoryview(value.data)[offset:end])
+        return memoryview(value)[offset:end]
+
+    @staticmethod
+    def _handles(records):
+        """
+        Records of a reply ending in (value, size), with each value cut to
+        its first chunk, and to nothing once the reply holds MAX_REPLY. The
+        client reads the rest of a value with GetChunkMsg as after a GetMsg
+        """
+        budget = ServerNetwork.MAX_REPLY
+        handles = []
+        for *head, value, size in records:
+            part = ServerNetwork._chunk(value, 0 if budget > 0 else len(value))
+            budget -= len(part)
+            handles.append((*head, part, size))
+        return handles
+
+    def handle_SetChunkMsg(self, msg):
+        success = self._set_chunk(msg.txn_id, msg.key, msg.size, msg.offset,
+                                  msg.data, msg.kind)
+
+        response = SetChunkMsgResponse(msg.uid, success)
+        return response
 
-        value = ''
+    def _set_chunk(self, txn_id, key, size, offset, data, kind):
+        """
+        Put a chunk in place, and set the value once it is complete
+        """
+        txn = self.storage.touch(txn_id)
+        if txn is None:
+            self.metrics.incr('denied.aborted')
+            return False
+
+        chunks = txn.chunks.get(key, None)
+        if chunks is not None and (chunks.size, chunks.kind) != (size, kind):
+            self.metrics.incr('denied.set.chunks')
+            del txn.chunks[key]
+            return False
+        if offset + len(data) > size:
+            self.metrics.incr('denied.set.chunks')
+            txn.chunks.pop(key, None)
+            return False
+        if chunks is None:
+            # only take the memory once the write could go through
+            if not self._may_write(txn_id, key, size):
+                return False
+            pending = sum(other.size for other in txn.chunks.values())
+            if pending + size > ServerNetwork.MAX_CHUNKED_BYTES:
+                self.metrics.incr('denied.set.chunks_memory')
+                return False
+            chunks = Storage.Chunks(size, kind)
+            txn.chunks[key] = chunks
+        chunks.write(offset, data)
+        if not chunks.complete():
+            return True
+
+        del txn.chunks[key]
+        return self._set(txn_id, key, chunks.value())
+
+    def handle_GetChunkMsg(self, msg):
+        if msg.readonly:
+            return self._snapshot(msg, self._get_chunk_response)
+        return self._get_chunk_response(msg)
+
+    def _get_chunk_response(self, msg):
+        # read again, the txn already read this version so it is the same
+        if msg.readonly:
+            success, value = self._snapshot_get(msg.txn_id, msg.key)
+        else:
+            success, value = self._get(msg.txn_id, msg.key)
 
-        # check key in actual storage
-        if msg.key in self.storage.actual():
-            last_wr_txn = self.storage.actual()[msg.key].last_wr_txn
+        response = GetChunkMsgResponse(msg.uid, success,
+                                       self._chunk(value, msg.offset))
+        return response
 
-            # check if has permission to read
-            if msg.txn_id >= last_wr_txn:
-                # update read permission
-                self.storage.actual()[msg.key].last_rd_txn = msg.txn_id
+    def handle_BatchMsg(self, msg):
+        if msg.readonly:
+            return self._snapshot(msg, self._snapshot_batch)
 
-                # get key from cache or actual storage
-                if msg.key in self.storage.buffer(client_ip):
-                    value = self.storage.buffer(client_ip)[msg.key].value
-                else:
-                    value = self.storage.actual()[msg.key].value
-                success = True
+        results = []
+        for op, key, value in msg.ops:
+            if op == BatchMsg.OP_SET:
+                success = self._set(msg.txn_id, key, value)
+                results.append((success, '', 0))
             else:
-                # NO PERMISSION!
-                success = False
-        else:
-            # key not in actual storage, try to get from buffer
-            if msg.key in self.storage.buffer(client_ip):
-                value = self.storage.buffer(client_ip)[msg.key].value
-            # if key not in buffer either,
-            # then value will be = '' but success = True
-            success = True
-
-        response = GetMsgResponse(msg.uid, success, value)
+                success, value = self._get(msg.txn_id, key)
+                results.append((success, value, len(value)))
+
+            # the client aborts on any failure, no point running the rest
+            if not results[-1][0]:
+                break
+
+        # ops we never ran count as failed
+        results.extend((False, '', 0)
+                       for _ in range(len(msg.ops) - len(results)))
+
+        response = BatchMsgResponse(msg.uid, self._handles(results))
         return response
 
-    def handle_TryCommitMsg(self, msg):
-        client_ip = msg.origin
+    def _snapshot_batch(self, msg):
+        results = []
+        for op, key, value in msg.ops:
+            if op == BatchMsg.OP_SET:
+                self.metrics.incr('denied.set.readonly')
+                results.append((False, '', 0))
+            else:
+                success, value = self._snapshot_get(msg.txn_id, key)
+                results.append((success, value, len(value)))
 
-        if self.storage.buffer_txn(client_ip) > msg.txn_id:
-            curr_txn_id = self.storage.buffer_txn(client_ip)
-            UI.log(f'!!! TXN ORDERING VIOLATED !!!', level=logging.CRITICAL)
-            UI.log(f'RECVD {msg.txn_id} over {curr_txn_id}',
-                   level=logging.CRITICAL)
+        response = BatchMsgResponse(msg.uid, self._handles(results))
+        return response
 
-        # update current txn ID for that client
-        self.storage.set_buffer_txn(client_ip, msg.txn_id)
+    def _set(self, txn_id, key, value):
+        if not self._may_write(txn_id, key, len(value)):
+            return False
+
+        # a newer write, committed or not, is no reason to fail: ours just
+        # becomes the version below it (Thomas write rule)
+        data_obj = self.storage.get(key)
+        if data_obj is not None and txn_id < data_obj.last_wr_txn:
+            self.metrics.incr('set.obsolete')
+
+        # write key to cache (never write to actual in SetMsg!)
+        self.storage.write(txn_id, key, value)
+        if isinstance(value, Compressed):
+            self.metrics.incr('set.compressed')
+            self.metrics.incr('set.compressed.raw_bytes', value.size())
+            self.metrics.incr('set.compressed.bytes', len(value))
+        return True
+
+    def _may_write(self, txn_id, key, size):
+        """
+        False if txn_id may not write a value of size to key
+        """
+        if self.storage.touch(txn_id) is None:
+            self.metrics.incr('denied.aborted')
+            return False
+
+        if self.replica_of is not None:
+            self.metrics.incr('denied.replica')
+            return False
+        if not self.owns(key):
+            self.metrics.incr('denied.not_owner')
+            return False
+        if size > ServerNetwork.MAX_VALUE_SIZE:
+            self.metrics.incr('denied.set.too_large')
+            return False
+
+        # a newer txn already read the key, it should have seen our write
+        data_obj = self.storage.get(key)
+        if data_obj is not None and txn_id < data_obj.last_rd_txn:
+            self.metrics.incr('denied.set.newer_read')
+            return False
+        if self.storage.range_read_above(key, txn_id):
+            self.metrics.incr('denied.set.range_read')
+            return False
+        return True
+
+    def _get(self, txn_id, key):
+        txn = self.storage.touch(txn_id)
+        if txn is None:
+            self.metrics.incr('denied.aborted')
+            return False, ''
+        buffer = txn.buffer
+
+        if self.replica_of is not None:
+            self.metrics.incr('denied.replica')
+            return False, ''
+        if not self.owns(key):
+            self.metrics.incr('denied.not_owner')
+            return False, ''
+
+        # our own uncommitted writes come first
+        if key in buffer:
+            return True, buffer[key]
+
+        # an older txn we voted yes on may still commit below us, after
+        # we read the version before it
+        if self.storage.prepared_write_below(key, txn_id):
+            self.metrics.incr('denied.get.prepared_write')
+            return False, ''
+
+        # if key not in storage either,
+        # then value will be = '' but success = True
+        data_obj = self.storage.get(key)
+        if data_obj is None:
+            self._mark_read(key, None, txn_id)
+            return True, ''
+
+        # read the newest version at or before us, a newer committed or
+        # buffered write no longer makes us fail
+        success, value = data_obj.read(txn_id)
+
+        if success:
+            # update read permission
+            self._mark_read(key, data_obj, txn_id)
+        else:
+            self.metrics.incr('denied.get.collected')
+
+        return success, value
+
+    def _mark_read(self, key, data_obj, txn_id):
+        """
+        Remember that txn_id read key, so that an older txn can no longer
+        write it. A key that does not exist is remembered as a range of
+        just that key
+        """
+        if data_obj is None:
+            self.storage.read_range(key, key + '\0', txn_id)
+        else:
+            data_obj.last_rd_txn = max(data_obj.last_rd_txn, txn_id)
+
+    def _snapshot(self, msg, respond):
+        """
+        respond(msg) for a read-only txn. A primary first closes the
+        timestamp up to the snapshot, waiting up to SNAPSHOT_WAIT for the
+        older txns here to end, as a coroutine
+        """
+        # an aborted txn is refused, it must not close anything
+        if self.replica_of is not None or \
+                self.storage.aborted(msg.txn_id) or \
+                self.close_up_to(msg.txn_id):
+            return respond(msg)
+        return self._snapshot_later(msg, respond)
+
+    async def _snapshot_later(self, msg, respond):
+        deadline = time.monotonic() + ServerNetwork.SNAPSHOT_WAIT
+        while not self.close_up_to(msg.txn_id) and \
+                time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        # refused as not closed if we gave up
+        return respond(msg)
+
+    def _snapshot_get(self, txn_id, key):
+        """
+        Read key as of txn_id for a read-only txn, at or below the closed
+        timestamp: nothing can commit there anymore, so the snapshot needs
+        no read marks. We fail instead of guessing when GC already dropped
+        the version the snapshot needs. That can happen to a snapshot older
+        than every active txn: read-only txns keep no state here, so they
+        do not hold back GC
+        """
+        if self.storage.aborted(txn_id):
+            self.metrics.incr('denied.aborted')
+            return False, ''
+
+        if not self.owns(key):
+            self.metrics.incr('denied.not_owner')
+            return False, ''
+
+        if not self._snapshot_ready(txn_id):
+            return False, ''
+
+        data_obj = self.storage.get(key)
+        if data_obj is None:
+            return True, ''
+
+        success, value = data_obj.read(txn_id)
+        if not success:
+            self.metrics.incr('denied.snapshot.collected')
+        return success, value
+
+    def _snapshot_ready(self, txn_id):
+        """
+        False if we cannot serve the snapshot at txn_id: a backup that is
+        too far behind, or a server that may still get commits at or below
+        txn_id
+        """
+        staleness = self.staleness()
+        if staleness is None or staleness > ServerNetwork.MAX_STALENESS:
+            self.metrics.incr('denied.snapshot.stale')
+            return False
+        if txn_id > self.snapshot_closed():
+            self.metrics.incr('denied.snapshot.not_closed')
+            return False
+        return True
+
+    def handle_ScanMsg(self, msg):
+        if msg.readonly:
+            return self._snapshot(msg, self._scan_response)
+        return self._scan_response(msg)
+
+    def _scan_response(self, msg):
+        limit = max(1, min(msg.limit, ServerNetwork.MAX_SCAN))
+        if msg.readonly:
+            success, records, next_key = self._snapshot_scan(
+                msg.txn_id, msg.start, msg.end, limit)
+        else:
+            success, records, next_key = self._scan(
+                msg.txn_id, msg.start, msg.end, limit)
 
-        success = True
+        records = self._handles((key, value, len(value))
+                                for key, value in records)
+        response = ScanMsgResponse(msg.uid, success, records,
+                                   next_key or '', next_key is None)
+        return response
 
-        # try to see if its possible to store each key in the actual store
-        for key, data_obj in self.storage.buffer(client_ip).items():
-            if key in self.storage.actual():
-                last_rd_txn = self.storage.actual()[key].last_rd_txn
-                last_wr_txn = self.storage.actual()[key].last_wr_txn
-
-                # check if DOES NOT have permission to write
-                if msg.txn_id < last_rd_txn or msg.txn_id < last_wr_txn:
-                    success = False
-                    break
+    def _scan_keys(self, start, end, limit, buffer=None):
+        """
+        (keys of the page, first key of the next page or None if this is
+        the last), with the keys txn wrote itself included
+        """
+        keys = self.storage.range(start, end, limit + 1)
+        if buffer:
+            keys = sorted(set(keys).union(
+                key for key in buffer
+                if start <= key and (end == '' or key < end)))
+        if len(keys) > limit:
+            return keys[:limit], keys[limit]
+        return keys, None
+
+    def _scan(self, txn_id, start, end, limit):
+        """
+        Read the keys from start on and before end like _get, as
+        (success, [(key, value)] of the existing ones, next_key). The range
+        read is remembered, so an older txn writing a key into it is
+        refused like one writing a key read by a newer txn
+        """
+        txn = self.storage.touch(txn_id)
+        if txn is None:
+            self.metrics.incr('denied.aborted')
+            return False, [], None
+        buffer = txn.buffer
+
+        if self.replica_of is not None:
+            self.metrics.incr('denied.replica')
+            return False, [], None
+
+        keys, next_key = self._scan_keys(start, end, limit, buffer)
+        # see _get
+        if self.storage.prepared_write_in(
+                start, end if next_key is None else next_key, txn_id):
+            self.metrics.incr('denied.scan.prepared_write')
+            return False, [], None
+
+        records = []
+        data_objs = []
+        for key in keys:
+            if not self.owns(key):
+                continue
+            if key in buffer:
+                records.append((key, buffer[key]))
+                continue
+
+            data_obj = self.storage.get(key)
+            if data_obj is None:
+                continue
+            success, value = data_obj.read(txn_id)
+            if not success:
+                self.metrics.incr('denied.scan.collected')
+                return False, [], None
+            data_objs.append(data_obj)
+            if value != '':
+                records.append((key, value))
+
+        for data_obj in data_objs:
+            data_obj.last_rd_txn = max(data_obj.last_rd_txn, txn_id)
+        self.storage.read_range(start, end if next_key is None else next_key,
+                                txn_id)
+        return True, records, next_key
+
+    def _snapshot_scan(self, txn_id, start, end, limit):
+        """
+        Read the keys from start on and before end as of txn_id for a
+        read-only txn, see _snapshot_get
+        """
+        if self.storage.aborted(txn_id):
+            self.metrics.incr('denied.aborted')
+            return False, [], None
+
+        if not self._snapshot_ready(txn_id):
+            return False, [], None
+
+        keys, next_key = self._scan_keys(start, end, limit)
+        records = []
+        for key in keys:
+            if not self.owns(key):
+                continue
+            data_obj = self.storage.get(key)
+            if data_obj is None:
+                continue
+            success, value = data_obj.read(txn_id)
+            if not success:
+                self.metrics.incr('denied.snapshot.collected')
+                return False, [], None
+            if value != '':
+                records.append((key, value))
+        return True, records, next_key
+
+    def handle_TryCommitMsg(self, msg):
+        success = self._try_commit(msg.txn_id, msg.writes)
+        if success:
+            self.storage.prepare(msg.txn_id)
 
         response = TryCommitMsgResponse(msg.uid, success)
         return response
 
     def handle_DoCommitMsg(self, msg):
-        client_ip = msg.origin
+        if self.storage.txn(msg.txn_id) is None:
+            # no answer, the client cannot tell whether we committed
+            UI.log(f'DoCommit for unknown txn {msg.txn_id}',
+                   level=logging.ERROR)
+            return
+
+        durable = self._do_commit(msg.txn_id)
+        response = DoCommitMsgResponse(msg.uid)
+        if durable is None:
+            return response
+        return self._after(durable, response)
+
+    def handle_CommitOneMsg(self, msg):
+        # we are the only server in this txn, so nobody else can vote no:
+        # validate and apply right away, nothing runs in between
+        success = self._try_commit(msg.txn_id, msg.writes)
+        durable = None
+        if success:
+            durable = self._do_commit(msg.txn_id)
+        else:
+            self.storage.abort(msg.txn_id)
+            self.metrics.incr('aborts')
 
-        if self.storage.buffer_txn(client_ip) > msg.txn_id:
-            curr_txn_id = self.storage.buffer_txn(client_ip)
-            UI.log(f'!!! TXN ORDERING VIOLATED !!!', level=logging.CRITICAL)
-            UI.log(f'RECVD {msg.txn_id} over {curr_txn_id}',
-                   level=logging.CRITICAL)
+        response = CommitOneMsgResponse(msg.uid, success)
+        if durable is None:
+            return response
+        return self._after(durable, response)
 
-        # update current txn ID for that client
-        self.storage.set_buffer_txn(client_ip, -1)
+    async def _after(self, durable, response):
+        # only report the commit once it is in the log
+        await durable
+        return response
 
-        # copy data from buffer to actual data
-        for key, data_obj in self.storage.buffer(client_ip).items():
-            data = Storage.DataObj(data_obj.value, last_wr_txn=msg.txn_id)
-            self.storage.actual()[key] = data
+    def _try_commit(self, txn_id, writes=None):
+        """
+        Vote on txn_id. writes is how many keys the client wrote here, None
+        to not check it
+        """
+        # clients only commit where they wrote, so if we do not know the
+        # txn its lease expired and its writes are gone
+        txn = self.storage.txn(txn_id)
+        if txn is None:
+            self.metrics.incr('refused.commit.unknown_txn')
+            return False
+        # we lost writes the client made, committing the others would
+        # apply only part of the txn
+        if writes is not None and len(txn.buffer) != writes:
+            self.metrics.incr('refused.commit.lost_writes')
+            return False
+        if self.replica_of is not None:
+            self.metrics.incr('refused.commit.replica')
+            return False
+        # backups may already serve snapshots above it
+        if txn_id <= self.closed:
+            self.metrics.incr('refused.commit.closed')
+            return False
 
-        # clear the buffer
-        self.storage.buffer(client_ip).clear()
+        # try to see if its possible to store each key in the actual store
+        for key in txn.buffer.keys():
+            # the key moved away since we buffered the write
+            if not self.owns(key):
+                self.metrics.incr('refused.commit.not_owner')
+                return False
+
+            # a newer txn read the key since we wrote it, without seeing
+            # our write. Newer writes are fine, see _set
+            data_obj = self.storage.get(key)
+            if data_obj is not None and txn_id < data_obj.last_rd_txn:
+                self.metrics.incr('refused.commit.newer_read')
+                return False
+            if self.storage.range_read_above(key, txn_id):
+                self.metrics.incr('refused.commit.range_read')
+                return False
+
+        return True
+
+    def _do_commit(self, txn_id):
+        """
+        Apply the buffer of txn_id, returns a future that is done once the
+        commit is in the log, or None if the txn wrote nothing here
+        """
+        writes = list(self.storage.finish(txn_id).items())
+        oldest_active = self.storage.oldest_active()
+        if writes:
+            self.metrics.incr('commits')
+
+        # add a new version for every key in the buffer
+        for key, value in writes:
+            self.storage.install(key, txn_id, value, oldest_active)
+
+        if not writes:
+            return None
+        self.dirty += 1
+        for replicator in self.replicators:
+            replicator.append(txn_id, writes)
+        return self.wal.append(txn_id, writes)
 
     def handle_AbortMsg(self, msg):
-        client_ip = msg.origin
+        # drop the buffer, and refuse whatever of the txn still arrives
+        if self.storage.abort(msg.txn_id):
+            self.metrics.incr('aborts')
+
+    def handle_ReleaseMsg(self, msg):
+        # refuse whatever of the txn still arrives, as for an abort
+        if self.storage.abort(msg.txn_id):
+            self.metrics.incr('released')
+
+    def handle_StatsMsg(self, msg):
+        stats = json.dumps(self.metrics.snapshot(), sort_keys=True)
 
-        if self.storage.buffer_txn(client_ip) > msg.txn_id:
-            curr_txn_id = self.storage.buffer_txn(client_ip)
-            UI.log(f'!!! TXN ORDERING VIOLATED !!!', level=logging.CRITICAL)
-            UI.log(f'RECVD {msg.txn_id} over {curr_txn_id}',
-                   level=logging.CRITICAL)
+        response = StatsMsgResponse(msg.uid, stats)
+        return response
+
+    def handle_ExportKeysMsg(self, msg):
+        self._set_ring(msg.name, msg.names, msg.vnodes)
+        for replicator in self.replicators:
+            replicator.append_ring(drop=False)
+        return self._export(msg)
+
+    async def _export(self, msg):
+        # txns that already voted yes may still commit to a moving key,
+        # also one they create, so let them finish before listing the keys
+        # that leave. Other txns can no longer commit to them
+        while self._prepared_outgoing():
+            await asyncio.sleep(0.01)
+        if self.outgoing is None:
+            self.outgoing = sorted(key for key in self.storage.keys()
+                                   if not self.owns(key))
+
+        start = bisect.bisect_left(self.outgoing, msg.start)
+        end = start + msg.limit
+        records = []
+        for key in self.outgoing[start:end]:
+            data_obj = self.storage.get(key)
+            if data_obj is not None:
+                records.append((key, data_obj.value, data_obj.last_rd_txn,
+                                data_obj.last_wr_txn, data_obj.commit_txn))
+
+        done = end >= len(self.outgoing)
+        next_key = '' if done else self.outgoing[end]
+        response = ExportKeysMsgResponse(msg.uid, records, next_key, done)
+        return response
+
+    def _prepared_outgoing(self):
+        return any(txn.prepared and not all(self.owns(key)
+                                            for key in txn.buffer)
+                   for txn in self.storage.txns().values())
+
+    def handle_ImportKeysMsg(self, msg):
+        durable = None
+        for key, value, last_rd_txn, last_wr_txn, commit_txn in msg.records:
+            data_obj = self.storage.install(key, commit_txn, value)
+            # only the newest version moves, reads below it are refused
+            data_obj.collected = True
+            data_obj.last_rd_txn = max(data_obj.last_rd_txn, last_rd_txn)
+            data_obj.last_wr_txn = max(data_obj.last_wr_txn, last_wr_txn)
+            durable = self.wal.append(commit_txn, [(key, value)])
+            for replicator in self.replicators:
+                replicator.append(commit_txn, [(key, value)])
+        self.dirty += 1
+        self.metrics.incr('keys.imported', len(msg.records))
+
+        response = ImportKeysMsgResponse(msg.uid, True)
+        if durable is None:
+            return response
+        # batches are flushed in order, the last one covers them all
+        return self._after(durable, response)
+
+    def handle_DropKeysMsg(self, msg):
+        self._set_ring(msg.name, msg.names, msg.vnodes)
+        count = self._drop_moved()
+        for replicator in self.replicators:
+            replicator.append_ring(drop=True)
+
+        response = DropKeysMsgResponse(msg.uid, count)
+        return response
+
+    def _drop_moved(self):
+        dropped = [key for key in self.storage.keys() if not self.owns(key)]
+        for key in dropped:
+            self.storage.drop(key)
+        self.outgoing = None
+        self.metrics.incr('keys.dropped', len(dropped))
+        return len(dropped)
+
+    def handle_ReplicateMsg(self, msg):
+        if self.replica_of is None:
+            UI.log('Got commits to replicate, but we are a primary',
+                   level=logging.ERROR)
+            return
+
+        for txn_id, writes in msg.records:
+            for key, value in writes:
+                data_obj = self.storage.install(key, txn_id, value)
+                if msg.catch_up:
+                    # we may have missed the versions before it
+                    data_obj.forget_below(txn_id)
+            # not waited for, a backup that crashes catches up again
+            self.wal.append(txn_id, writes)
+        if msg.records:
+            self.dirty += 1
+        self.metrics.incr('replicated', len(msg.records))
+
+        if msg.synced:
+            self.last_synced = time.monotonic()
+        self.replica_closed[msg.stream] = msg.closed
+        self.replica_streams = msg.streams
+
+    def handle_ReplicateChunkMsg(self, msg):
+        if self.replica_of is None:
+            UI.log('Got commits to replicate, but we are a primary',
+                   level=logging.ERROR)
+            return
+
+        # chunks come in order, the first one starts a value over, also
+        # one the primary began before it reconnected
+        if msg.offset == 0:
+            self.replica_chunks = (msg.txn_id, msg.key,
+                                   Storage.Chunks(msg.size, msg.kind))
+        if self.replica_chunks is None or \
+                self.replica_chunks[:2] != (msg.txn_id, msg.key):
+            UI.log(f'Chunk of {msg.key} out of order', level=logging.ERROR)
+            return
 
-        # update current txn ID for that client
-        self.storage.set_buffer_txn(client_ip, -1)
+        chunks = self.replica_chunks[2]
+        chunks.write(msg.offset, msg.data)
+        if not chunks.complete():
+            return
+        self.replica_chunks = None
+
+        writes = [(msg.key, chunks.value())]
+        data_obj = self.storage.install(msg.key, msg.txn_id, writes[0][1])
+        if msg.catch_up:
+            data_obj.forget_below(msg.txn_id)
+        self.wal.append(msg.txn_id, writes)
+        self.dirty += 1
+        self.metrics.incr('replicated.chunked')
+
+    def handle_ReplicateRingMsg(self, msg):
+        if self.replica_of is None:
+            UI.log('Got a ring to replicate, but we are a primary',
+                   level=logging.ERROR)
+            return
 
-        # clear the buffer
-        self.storage.buffer(client_ip).clear()
+        # we answer for the primary, so we take its name in the ring
+        self._set_ring(msg.name, msg.names, msg.vnodes)
+        if msg.drop:
+            self._drop_moved()
+
+    async def lease_loop(self):
+        while True:
+            await asyncio.sleep(Storage.TXN_LEASE / 4)
+            for txn_id, txn in self.storage.expire().items():
+                if txn.prepared:
+                    self.metrics.incr('aborts.expired.prepared')
+                    UI.log(f'Txn {txn_id} voted yes but never got the '
+                           f'outcome, aborted it here although it may have '
+                           f'committed elsewhere', level=logging.ERROR)
+                    continue
+                if not txn.buffer and not txn.chunks:
+                    # it only read from us, there was nothing to abort
+                    self.metrics.incr('expired.readonly')
+                    continue
+                self.metrics.incr('aborts.expired')
+                UI.log(f'Lease of txn {txn_id} expired, aborted it',
+                       level=logging.WARNING)
+            self.storage.collect_range_reads()
+            self.storage.collect_aborted()
 
     def close(self):
         self.server.close()
+        if self.checkpointer is not None:
+            self.checkpointer.cancel()
+        if self.leases is not None:
+            self.leases.cancel()
+        if self.stats is not None:
+            self.stats.cancel()
+        for replicator in self.replicators:
+            replicator.close()
+        self.wal.close()
 
 
 class ServerProtocol(asyncio.Protocol):
-    def __init__(self, req_handler):
+    def __init__(self, req_handler, metrics=None, peer=None):
+        """
+        peer names the other end, by default its address
+        """
         self.evloop = asyncio.get_event_loop()
         self.req_handler = req_handler
+        self.metrics = metrics
+        self.peer = peer
+        self.decoder = framing.FrameDecoder()
         UI.log('Created protocol!')
 
     def connection_made(self, transport):
         self.transport = transport
-        self.peer = self.transport.get_extra_info('peername')[0]
+        if self.peer is None:
+            self.peer = self.transport.get_extra_info('peername')[0]
         UI.log(f'Got connection from {str(self.peer)}')
+        if self.metrics is not None:
+            self.metrics.incr('connections')
+            self.metrics.incr('connections.total')
 
     def connection_lost(self, exc):
         UI.log(f'Connection lost with {str(self.peer)}')
+        if self.metrics is not None:
+            self.metrics.incr('connections', -1)
         super().connection_lost(exc)
 
     def data_received(self, data):
-        UI.log(f'Got data from {self.peer}')
-        unpickled = pickle.loads(data)
-        self.req_handler(unpickled, self.transport)
+        UI.log('Got data from %s', self.peer, level=logging.DEBUG)
+        try:
+            frames = self.decoder.feed(data)
+        except framing.FrameError as e:
+            UI.log(f'Bad frame from {self.peer}: {e}', level=logging.ERROR)
+            self.transport.close()
+            return
+
+        for frame in frames:
+            try:
+                msg = CODEC.decode(frame)
+            except CodecError as e:
+                UI.log(f'Bad message from {self.peer}: {e}',
+                       level=logging.ERROR)
+                self.transport.close()
+                return
+
+            msg.origin = self.peer
+            self.req_handler(msg, self.transport)
 
     def eof_received(self):
         pass
 
 
+def roles(host):
+    """
+    (backups, replica_of) of host, from where it appears in nodeslist
+    """
+    backups = []
+    replica_of = None
+    for server_host, name in nodeslist.servers:
+        if server_host == host:
+            backups = [(backup_host, None) for backup_host, _, primary
+                       in nodeslist.replicas if primary == name]
+    for backup_host, _, primary in nodeslist.replicas:
+        if backup_host == host:
+            replica_of = primary
+    return backups, replica_of
+
+
+def compression_ratio(counters):
+    """
+    Size of the values clients compressed over their size as sent, 0 if
+    there were none
+    """
+    sent = counters.get('set.compressed.bytes', 0)
+    if not sent:
+        return 0
+    return counters.get('set.compressed.raw_bytes', 0) / sent
+
+
 def main():
     debug = len(sys.argv) > 1 and sys.argv[1] == 'debug'
 
-    if debug:
-        logging.basicConfig(filename='server.log', level=logging.DEBUG)
-    else:
-        logging.basicConfig(filename='server.log', level=logging.INFO)
+    logs.setup('server.log', debug, ServerNetwork.LOG_SAMPLING)
     UI.log('===========================================')
     UI.log('==== Distributed Transactions - Server ====')
     UI.log('===========================================')
@@ -270,7 +1680,11 @@ def main():
     if debug:
         evloop.set_debug(True)
 
-    server_network = ServerNetwork()
+    backups, replica_of = roles(socket.getfqdn())
+    if replica_of is not None:
+        UI.log(f'Backup of {replica_of}')
+
+    server_network = ServerNetwork(backups=backups, replica_of=replica_of)
     main_task = evloop.create_task(server_network.create_server())
     try:
         evloop.run_forever()
@@ -0,0 +1,94 @@
+import bisect
+import itertools
+
+
+class SortedKeys:
+    """
+    A sorted set of keys, kept as a list of short sorted lists. Adding or
+    removing a key moves the keys after it in its own list only, instead
+    of every key after it as in one long sorted list.
+    """
+    # keys per list when built, a list is split in two past twice this
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(set(keys))
+        load = SortedKeys.LOAD
+        self._lists = [keys[i:i + load] for i in range(0, len(keys), load)]
+        # last key of each list
+        self._maxes = [keys[-1] for keys in self._lists]
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._lists)
+
+    def add(self, key):
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            return
+
+        i = min(bisect.bisect_left(self._maxes, key), len(self._lists) - 1)
+        keys = self._lists[i]
+        j = bisect.bisect_left(keys, key)
+        if j < len(keys) and keys[j] == key:
+            return
+        keys.insert(j, key)
+        self._maxes[i] = keys[-1]
+        self._len += 1
+
+        if len(keys) > 2 * SortedKeys.LOAD:
+            half = keys[SortedKeys.LOAD:]
+            del keys[SortedKeys.LOAD:]
+            self._lists.insert(i + 1, half)
+            self._maxes.insert(i + 1, half[-1])
+            self._maxes[i] = keys[-1]
+
+    def discard(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._lists):
+            return
+        keys = self._lists[i]
+        j = bisect.bisect_left(keys, key)
+        if keys[j] != key:
+            return
+
+        del keys[j]
+        self._len -= 1
+        if keys:
+            self._maxes[i] = keys[-1]
+        else:
+            del self._lists[i]
+            del self._maxes[i]
+
+    def floor(self, key):
+        """
+        Largest key at or before key, None if there is none
+        """
+        i = bisect.bisect_left(self._maxes, key)
+        if i < len(self._lists):
+            keys = self._lists[i]
+            j = bisect.bisect_right(keys, key)
+            if j:
+                return keys[j - 1]
+        return self._maxes[i - 1] if i else None
+
+    def irange(self, start, end=''):
+        """
+        Keys from start on, and before end unless end is '', in order. The
+        keys must not change while this runs
+        """
+        i = bisect.bisect_left(self._maxes, start)
+        if i == len(self._lists):
+            return
+        j = bisect.bisect_left(self._lists[i], start)
+        for keys in itertools.islice(self._lists, i, None):
+            for key in itertools.islice(keys, j, None):
+                if end != '' and key >= end:
+                    return
+                yield key
+            j = 0
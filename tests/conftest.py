@@ -0,0 +1,32 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# the modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def evloop():
+    """
+    A fresh event loop, set as the current one for code that calls
+    asyncio.get_event_loop()
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def paths(tmp_path):
+    """
+    Files of a ServerNetwork, all in a fresh directory
+    """
+    return {'wal_path': str(tmp_path / 'server.wal'),
+            'checkpoint_path': str(tmp_path / 'server.ckpt'),
+            'stats_path': str(tmp_path / 'server.stats.json'),
+            'ring_path': str(tmp_path / 'server.ring')}
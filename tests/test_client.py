@@ -0,0 +1,379 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from client import (Client, ClientNetwork, Transaction, TransactionAborted,
+                    TransactionError, TxnIDLease, compress, decompress)
+from codec import Compressed
+import framing
+from messages import (CODEC, AbortMsg, BatchMsg, BatchMsgResponse,
+                      CommitOneMsgResponse, DoCommitMsg, DoCommitMsgResponse,
+                      GetMsgResponse, ReleaseMsg, SetMsg, SetMsgResponse,
+                      TryCommitMsgResponse)
+
+
+class Server:
+    def __init__(self, name):
+        self.name = name
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class Network:
+    """
+    Answers every request with the next of responses, None for a timeout
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.server = Server('A')
+        self.other = Server('B')
+
+    def servers(self):
+        return {'A': self.server, 'B': self.other}
+
+    async def next_txn_id(self):
+        return 10
+
+    async def request(self, peer, msg):
+        self.requests.append(msg)
+        return self.responses.pop(0)
+
+    def ring_stale(self):
+        pass
+
+
+def commit_one(commit_response):
+    network = Network([SetMsgResponse(0, True), commit_response])
+    txn = Transaction(network)
+
+    async def run():
+        await txn.begin()
+        await txn.set('key', 'value', 'A')
+        await txn.commit()
+    return network, txn, run()
+
+
+def test_commit_one_timeout_leaves_outcome_unknown(evloop):
+    network, txn, run = commit_one(None)
+    with pytest.raises(TransactionError) as raised:
+        evloop.run_until_complete(run)
+    assert not isinstance(raised.value, TransactionAborted)
+    # the server may have committed, no abort is sent
+    assert network.server.sent == []
+    assert not txn.active()
+
+
+def test_commit_one_refused(evloop):
+    network, txn, run = commit_one(CommitOneMsgResponse(0, False))
+    with pytest.raises(TransactionAborted):
+        evloop.run_until_complete(run)
+    assert network.requests[-1].writes == 1
+
+
+def test_commit_one(evloop):
+    network, txn, run = commit_one(CommitOneMsgResponse(0, True))
+    evloop.run_until_complete(run)
+    assert not txn.active()
+
+
+def read_and_write(set_response, commit_response=None):
+    network = Network([GetMsgResponse(0, True, 'old'), set_response,
+                       commit_response])
+    txn = Transaction(network)
+
+    async def run():
+        await txn.begin()
+        await txn.get('key', 'B')
+        await txn.set('key', 'new', 'A')
+        await txn.commit()
+    return network, run()
+
+
+def test_commit_releases_servers_only_read_from(evloop):
+    network, run = read_and_write(SetMsgResponse(0, True),
+                                  CommitOneMsgResponse(0, True))
+    evloop.run_until_complete(run)
+    assert network.server.sent == []
+    assert [type(msg) for msg in network.other.sent] == [ReleaseMsg]
+
+
+def test_abort_releases_servers_only_read_from(evloop):
+    network, run = read_and_write(SetMsgResponse(0, False))
+    with pytest.raises(TransactionAborted):
+        evloop.run_until_complete(run)
+    assert [type(msg) for msg in network.server.sent] == [AbortMsg]
+    assert [type(msg) for msg in network.other.sent] == [ReleaseMsg]
+
+
+def commit_two_phase(do_commit_response):
+    network = Network([SetMsgResponse(0, True), SetMsgResponse(0, True),
+                       TryCommitMsgResponse(0, True),
+                       TryCommitMsgResponse(0, True),
+                       DoCommitMsgResponse(0), do_commit_response])
+    txn = Transaction(network)
+
+    async def run():
+        await txn.begin()
+        await txn.set('key', 'value', 'A')
+        await txn.set('key', 'value', 'B')
+        await txn.commit()
+    return network, run()
+
+
+def test_commit_waits_for_every_server(evloop):
+    network, run = commit_two_phase(DoCommitMsgResponse(0))
+    evloop.run_until_complete(run)
+    assert [type(msg) for msg in network.requests[-2:]] == [DoCommitMsg] * 2
+
+
+def test_unconfirmed_commit_leaves_outcome_unknown(evloop):
+    network, run = commit_two_phase(None)
+    with pytest.raises(TransactionError) as raised:
+        evloop.run_until_complete(run)
+    assert not isinstance(raised.value, TransactionAborted)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    time.monotonic() that only moves when the test moves it
+    """
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_lease_hands_out_its_block_in_order(clock):
+    lease = TxnIDLease()
+    assert lease.take() is None
+    lease.extend(100, 3)
+    assert [lease.take() for _ in range(4)] == [100, 101, 102, None]
+
+
+def test_lease_expires(clock):
+    lease = TxnIDLease()
+    lease.extend(100, 10)
+    assert lease.take() == 100
+    clock[0] += TxnIDLease.MAX_AGE + 0.1
+    assert lease.take() is None
+
+
+def test_lease_size_follows_the_begin_rate(clock):
+    lease = TxnIDLease()
+    assert lease.next_size() == TxnIDLease.MIN_SIZE
+    for _ in range(50):
+        lease.record_begin()
+        clock[0] += 0.01
+    # a begin every 10 ms, a round trip every TARGET_PERIOD
+    assert lease.next_size() == pytest.approx(
+        TxnIDLease.TARGET_PERIOD / 0.01, abs=1)
+
+    for _ in range(50):
+        lease.record_begin()
+        clock[0] += 1.0
+    assert lease.next_size() == TxnIDLease.MIN_SIZE
+
+
+def test_lease_size_is_capped(clock):
+    lease = TxnIDLease()
+    for _ in range(10):
+        lease.record_begin()
+        clock[0] += 1e-6
+    assert lease.next_size() == TxnIDLease.MAX_SIZE
+
+
+class Listener(asyncio.Protocol):
+    """
+    Server side of a connection of a pool, counts the frames it gets
+    """
+
+    def __init__(self, conns):
+        self.conns = conns
+        self.decoder = framing.FrameDecoder()
+        self.frames = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conns.append(self)
+
+    def data_received(self, data):
+        self.frames += len(self.decoder.feed(data))
+
+
+@pytest.fixture
+def listener(evloop):
+    conns = []
+    server = evloop.run_until_complete(evloop.create_server(
+        lambda: Listener(conns), host='127.0.0.1', port=0))
+    yield server.sockets[0].getsockname()[1], conns
+    server.close()
+    evloop.run_until_complete(server.wait_closed())
+
+
+def test_pool_spreads_messages_over_its_connections(evloop, listener):
+    port, conns = listener
+    peer = ClientNetwork.Peer('127.0.0.1', 'A', None, port)
+    assert evloop.run_until_complete(peer.ready())
+    assert len(peer._conns) == ClientNetwork.POOL_SIZE
+
+    for txn_id in range(2 * ClientNetwork.POOL_SIZE):
+        assert peer.send(ReleaseMsg(txn_id))
+    evloop.run_until_complete(asyncio.sleep(0.05))
+    assert [conn.frames for conn in conns] == [2] * ClientNetwork.POOL_SIZE
+    peer.close()
+
+
+def test_pool_refills_lost_connections(evloop, listener):
+    port, conns = listener
+    peer = ClientNetwork.Peer('127.0.0.1', 'A', None, port)
+    assert evloop.run_until_complete(peer.ready())
+    conns[0].transport.close()
+    evloop.run_until_complete(asyncio.sleep(0.05))
+    assert len(peer._conns) == ClientNetwork.POOL_SIZE - 1
+
+    # still usable meanwhile, the lost one comes back in the background
+    assert evloop.run_until_complete(peer.ready())
+    evloop.run_until_complete(asyncio.sleep(0.05))
+    assert len(peer._conns) == ClientNetwork.POOL_SIZE
+    peer.close()
+
+
+def test_failed_connects_back_off(evloop, listener, monkeypatch):
+    port, _ = listener
+    peer = ClientNetwork.Peer('127.0.0.1', 'A', None, port)
+    attempts = []
+
+    async def refuse(*args, **kwargs):
+        attempts.append(time.monotonic())
+        raise ConnectionRefusedError()
+    monkeypatch.setattr(evloop, 'create_connection', refuse)
+
+    assert not evloop.run_until_complete(peer.ready())
+    assert peer._backoff == ClientNetwork.BACKOFF_MIN
+    # backing off, no new attempt
+    assert not evloop.run_until_complete(peer.ready())
+    assert not peer.send(ReleaseMsg(1))
+    assert len(attempts) == 1
+
+    for _ in range(10):
+        peer._retry_at = 0.0
+        assert not evloop.run_until_complete(peer.ready())
+    assert peer._backoff == ClientNetwork.BACKOFF_MAX
+
+    # the node is back, the next attempt succeeds and resets the backoff
+    monkeypatch.undo()
+    peer._retry_at = 0.0
+    assert evloop.run_until_complete(peer.ready())
+    assert peer._backoff == 0.0
+    peer.close()
+
+
+def test_get_many_reads_every_server_once(evloop):
+    network = Network([
+        BatchMsgResponse(0, [(True, 'one', 3), (True, '', 0)]),
+        BatchMsgResponse(0, [(True, 'two', 3)])])
+    txn = Transaction(network)
+    evloop.run_until_complete(txn.begin())
+
+    values = evloop.run_until_complete(
+        txn.get_many(['x', 'y', 'z'], ['A', 'B', 'A']))
+    assert values == ['one', 'two', None]
+    assert [[key for _, key, _ in msg.ops] for msg in network.requests] == \
+        [['x', 'z'], ['y']]
+    assert all(op == BatchMsg.OP_GET
+               for msg in network.requests for op, _, _ in msg.ops)
+    assert txn.read_from == {'A', 'B'}
+
+
+def test_get_many_refused_aborts(evloop):
+    network = Network([
+        BatchMsgResponse(0, [(True, 'one', 3)]),
+        BatchMsgResponse(0, [(False, '', 0)])])
+    txn = Transaction(network)
+    evloop.run_until_complete(txn.begin())
+
+    with pytest.raises(TransactionAborted):
+        evloop.run_until_complete(txn.get_many(['x', 'y'], ['A', 'B']))
+    assert not txn.active()
+    # both were only read from, both are released
+    assert [msg.type() for msg in network.server.sent] == ['ReleaseMsg']
+    assert [msg.type() for msg in network.other.sent] == ['ReleaseMsg']
+
+
+class Output:
+    def __init__(self):
+        self.lines = []
+
+    def output(self, line):
+        self.lines.append(line)
+
+
+def mget(evloop, responses, *names):
+    """
+    Lines MGET names prints in a txn, and the txn
+    """
+    network = Network(responses)
+    network.ring = None
+    client = Client.__new__(Client)
+    client.ui = Output()
+    client.network = network
+    client.txn = Transaction(network)
+    evloop.run_until_complete(client.txn.begin())
+    evloop.run_until_complete(client.cmd_mget(list(names)))
+    return client.ui.lines, client.txn
+
+
+def test_mget_prints_every_value(evloop):
+    lines, txn = mget(evloop, [BatchMsgResponse(0, [(True, '1', 1),
+                                                    (True, '2', 1)])],
+                      'A.x', 'A.y')
+    assert lines == ['A.x = 1', 'A.y = 2']
+    assert txn.active()
+
+
+def test_mget_of_a_missing_key_aborts(evloop):
+    lines, txn = mget(evloop, [BatchMsgResponse(0, [(True, '1', 1),
+                                                    (True, '', 0)])],
+                      'A.x', 'A.nope')
+    assert lines == ['NOT FOUND']
+    assert not txn.active()
+
+
+def test_mget_usage(evloop):
+    lines, _ = mget(evloop, [])
+    assert lines == ['Invalid! Usage: MGET [<server>.]<key> ...']
+    lines, _ = mget(evloop, [], 'x')
+    assert lines == ['Invalid! No partition ring, use <server>.<key>']
+
+
+@pytest.mark.parametrize('value', ['text ' * 2000, b'\x00\x01' * 5000])
+def test_compressed_value_round_trip(value):
+    compressed = compress(value)
+    assert isinstance(compressed, Compressed)
+    assert len(compressed) < len(value)
+
+    # over the wire and back, as a server stores and returns it
+    msg = CODEC.decode(CODEC.encode(SetMsg(10, 'key', compressed)))
+    assert isinstance(msg.value, Compressed)
+    restored = decompress(msg.value)
+    assert restored == value and type(restored) == type(value)
+
+
+def test_values_not_worth_compressing_stay_as_they_are(monkeypatch):
+    small = 'x' * ClientNetwork.COMPRESS_THRESHOLD
+    assert compress(small) is small
+    noise = os.urandom(2 * ClientNetwork.COMPRESS_THRESHOLD)
+    assert compress(noise) is noise
+    assert decompress(noise) is noise
+
+    compressed = compress('y' * 10000)
+    assert compress(compressed) is compressed
+    monkeypatch.setattr(ClientNetwork, 'COMPRESS_THRESHOLD', None)
+    large = 'z' * 10000
+    assert compress(large) is large
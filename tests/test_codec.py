@@ -0,0 +1,86 @@
+import pytest
+
+from codec import (BYTES, STR, VALUE, CodecError, Compressed, Fixed, List,
+                   Tuple)
+import messages
+from messages import CODEC, GetMsg, SetMsg
+
+SAMPLES = {'B': 7, 'I': 123456, 'Q': 2 ** 40, 'q': -(2 ** 40), 'd': 1.5,
+           '?': True}
+
+
+def sample(field, variant=0):
+    """
+    A value of field type, variant picks between the kinds of a VALUE
+    """
+    if isinstance(field, Fixed):
+        return SAMPLES[field.struct.format.lstrip('!')]
+    if field is STR:
+        return 'strüng'
+    if field is BYTES:
+        return b'\x00bytes'
+    if field is VALUE:
+        return ['text', b'\x00raw', Compressed.compress('z' * 100)][variant]
+    if isinstance(field, List):
+        return [sample(field.item, variant), sample(field.item, variant)]
+    if isinstance(field, Tuple):
+        return tuple(sample(item, variant) for item in field.items)
+    raise AssertionError(f'No sample for {field}')
+
+
+def plain(value):
+    if isinstance(value, Compressed):
+        return ('compressed', bytes(value.data))
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    return value
+
+
+def message_classes():
+    return sorted(CODEC._classes.values(), key=lambda cls: cls.TAG)
+
+
+@pytest.mark.parametrize('cls', message_classes(),
+                         ids=lambda cls: cls.__name__)
+@pytest.mark.parametrize('variant', [0, 1, 2])
+def test_every_message_round_trips(cls, variant):
+    msg = cls.__new__(cls)
+    messages.BaseMsg.__init__(msg)
+    msg.uid = 42
+    for name, field in cls.FIELDS:
+        setattr(msg, name, sample(field, variant))
+
+    decoded = CODEC.decode(CODEC.encode(msg))
+
+    assert type(decoded) is cls
+    assert decoded.uid == 42
+    for name, _ in cls.FIELDS:
+        assert plain(getattr(decoded, name)) == plain(getattr(msg, name))
+
+
+def test_tags_are_unique():
+    tags = [cls.TAG for cls in message_classes()]
+    assert len(tags) == len(set(tags))
+
+
+def test_unknown_tag():
+    payload = bytearray(CODEC.encode(GetMsg(1, 'key')))
+    payload[0] = 255
+    with pytest.raises(CodecError):
+        CODEC.decode(bytes(payload))
+
+
+def test_truncated_and_trailing_bytes():
+    payload = CODEC.encode(SetMsg(1, 'key', 'value'))
+    with pytest.raises(CodecError):
+        CODEC.decode(payload[:-1])
+    with pytest.raises(CodecError):
+        CODEC.decode(payload + b'\x00')
+
+
+def test_compressed_values():
+    for value in ['text ' * 1000, b'\x01\x02' * 1000]:
+        compressed = Compressed.compress(value)
+        assert len(compressed) < len(value)
+        assert compressed.size() > len(value)
+        assert compressed.decompress() == value
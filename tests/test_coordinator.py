@@ -0,0 +1,42 @@
+import pytest
+
+from coordinator import CoordinatorNetwork
+from messages import RequestTxnID, RequestTxnIDBlock, RingMsg, SetRingMsg
+
+
+@pytest.fixture
+def paths(tmp_path):
+    """
+    Files of a CoordinatorNetwork, all in a fresh directory
+    """
+    return {'stats_path': str(tmp_path / 'coordinator.json'),
+            'txn_id_path': str(tmp_path / 'coordinator.txn_id'),
+            'ring_path': str(tmp_path / 'coordinator.ring')}
+
+
+def test_txn_ids_go_on_above_a_restart(evloop, paths, monkeypatch):
+    monkeypatch.setattr(CoordinatorNetwork, 'TXN_ID_RESERVE', 10)
+
+    coordinator = CoordinatorNetwork(servers=[], **paths)
+    issued = [coordinator.handle_RequestTxnID(RequestTxnID()).txn_id
+              for _ in range(25)]
+    block = coordinator.handle_RequestTxnIDBlock(RequestTxnIDBlock(8))
+    assert issued == list(range(1, 26)) and block.first_txn_id == 26
+
+    restarted = CoordinatorNetwork(servers=[], **paths)
+    txn_id = restarted.handle_RequestTxnID(RequestTxnID()).txn_id
+    assert txn_id > block.first_txn_id + 7
+
+
+def test_ring_survives_a_restart(evloop, paths):
+    servers = [('host1', 'A', 1001), ('host2', 'B', 1002)]
+    coordinator = CoordinatorNetwork(servers=servers, **paths)
+    ring = coordinator.handle_RingMsg(RingMsg())
+    assert ring.version == 0 and len(ring.nodes) == 2
+
+    nodes = [('A', 'host1', 1001), ('B', 'host2', 1002), ('C', 'host3', 1003)]
+    coordinator.handle_SetRingMsg(SetRingMsg(nodes, 32))
+
+    restarted = CoordinatorNetwork(servers=servers, **paths)
+    ring = restarted.handle_RingMsg(RingMsg())
+    assert (ring.version, ring.nodes, ring.vnodes) == (1, nodes, 32)
@@ -0,0 +1,37 @@
+import pytest
+
+import framing
+
+
+def test_round_trip():
+    payloads = [b'', b'a', b'hello' * 100, bytes(range(256))]
+    stream = b''.join(framing.pack(payload) for payload in payloads)
+
+    assert framing.FrameDecoder().feed(stream) == payloads
+
+
+def test_partial_frames_are_buffered():
+    stream = framing.pack(b'first') + framing.pack(b'second')
+    decoder = framing.FrameDecoder()
+
+    frames = []
+    for i in range(len(stream)):
+        frames.extend(decoder.feed(stream[i:i + 1]))
+
+    assert frames == [b'first', b'second']
+    assert decoder.pending() == 0
+
+
+def test_pack_refuses_oversized_payload(monkeypatch):
+    monkeypatch.setattr(framing, 'MAX_FRAME_SIZE', 16)
+
+    framing.pack(b'x' * 16)
+    with pytest.raises(framing.FrameError):
+        framing.pack(b'x' * 17)
+
+
+def test_decoder_refuses_oversized_header():
+    decoder = framing.FrameDecoder(max_frame_size=16)
+
+    with pytest.raises(framing.FrameError):
+        decoder.feed(framing.HEADER.pack(17) + b'x')
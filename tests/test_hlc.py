@@ -0,0 +1,61 @@
+import pytest
+
+from hlc import HybridClock
+
+
+def test_now_is_strictly_increasing():
+    clock = HybridClock(3)
+    timestamps = [clock.now() for _ in range(10000)]
+    assert timestamps == sorted(set(timestamps))
+
+
+def test_node_id_is_in_the_low_bits():
+    timestamp = HybridClock(5).now()
+    assert timestamp & HybridClock.MAX_NODE == 5
+    assert HybridClock.unpack(timestamp)[2] == 5
+
+
+def test_nodes_never_issue_the_same_timestamp():
+    a, b = HybridClock(1), HybridClock(2)
+    issued = [a.now() for _ in range(1000)] + [b.now() for _ in range(1000)]
+    assert len(set(issued)) == len(issued)
+
+
+def test_logical_counter_overflows_into_the_next_ms(monkeypatch):
+    monkeypatch.setattr(HybridClock, 'wall', staticmethod(lambda: 1000))
+    clock = HybridClock()
+    timestamps = [clock.now() for _ in range(HybridClock.MAX_LOGICAL + 2)]
+    assert timestamps == sorted(set(timestamps))
+    assert HybridClock.unpack(timestamps[-1])[:2] == (1001, 0)
+
+
+def test_update_moves_past_a_newer_clock():
+    ahead = HybridClock(1)
+    ahead._physical = HybridClock.wall() + 5000
+    remote = ahead.now()
+
+    clock = HybridClock(2)
+    assert clock.update(remote)
+    assert clock.now() > remote
+
+
+def test_update_never_moves_back():
+    clock = HybridClock()
+    latest = clock.now()
+    assert clock.update(HybridClock(1).now() - (1000 << 22))
+    assert clock.now() > latest
+
+
+def test_update_ignores_clocks_too_far_ahead():
+    broken = HybridClock(1)
+    broken._physical = HybridClock.wall() + 2 * HybridClock.MAX_DRIFT
+    clock = HybridClock(2)
+    before = clock.read()
+    assert not clock.update(broken.now())
+    assert clock.now() < broken.now()
+    assert clock.read() >= before
+
+
+def test_node_id_is_range_checked():
+    with pytest.raises(ValueError):
+        HybridClock(HybridClock.MAX_NODE + 1)
@@ -0,0 +1,69 @@
+import atexit
+import logging
+import queue
+
+import pytest
+
+import logs
+from ui import UI
+
+
+def record(msg, *args, sample=None):
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, msg, args,
+                               None)
+    if sample is not None:
+        record.sample = sample
+    return record
+
+
+def test_sampler_keeps_one_in_n_per_type():
+    sampler = logs.MessageSampler({'GetMsg': 3, 'SetMsg': 2})
+    kept = [sampler.filter(record('get', sample='GetMsg'))
+            for _ in range(7)]
+    assert kept == [True, False, False, True, False, False, True]
+    # every type counts on its own
+    assert [sampler.filter(record('set', sample='SetMsg'))
+            for _ in range(3)] == [True, False, True]
+
+
+def test_sampler_passes_untagged_and_unlisted_records():
+    sampler = logs.MessageSampler({'GetMsg': 100})
+    assert all(sampler.filter(record('plain')) for _ in range(5))
+    assert all(sampler.filter(record('stats', sample='StatsMsg'))
+               for _ in range(5))
+
+
+def test_queue_handler_leaves_formatting_to_the_listener():
+    records = queue.Queue()
+    handler = logs.QueueHandler(records)
+    handler.handle(record('Got %s', {'key': 'value'}))
+
+    queued = records.get_nowait()
+    assert queued.msg == 'Got %s'
+    assert queued.args == {'key': 'value'}
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    root.handlers = handlers
+    root.setLevel(level)
+
+
+def test_setup_writes_sampled_records_to_the_file(tmp_path, root_logger):
+    path = tmp_path / 'server.log'
+    listener = logs.setup(str(path), sample_rates={'GetMsg': 2})
+    for i in range(4):
+        UI.log('Got %s', i, sample='GetMsg')
+    UI.log('Not sampled')
+    UI.log('Hidden', level=logging.DEBUG)
+    listener.stop()
+    atexit.unregister(listener.stop)
+    for handler in listener.handlers:
+        handler.close()
+
+    lines = path.read_text().splitlines()
+    assert lines == ['INFO:root:Got 0', 'INFO:root:Got 2',
+                     'INFO:root:Not sampled']
@@ -0,0 +1,48 @@
+import pytest
+
+from metrics import Histogram
+
+
+def test_samples_go_to_power_of_two_buckets():
+    histogram = Histogram()
+    histogram.record(3e-6)
+    histogram.record(4e-6)
+    histogram.record(0)
+    assert histogram.buckets[2] == 1
+    assert histogram.buckets[3] == 1
+    assert histogram.buckets[0] == 1
+
+
+def test_percentiles_are_bucket_upper_bounds():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.record(10e-6)
+    for _ in range(10):
+        histogram.record(1000e-6)
+
+    assert histogram.percentile(0.5) == pytest.approx(16e-6)
+    assert histogram.percentile(0.9) == pytest.approx(16e-6)
+    # capped by the largest sample rather than its bucket bound of 1024us
+    assert histogram.percentile(0.99) == pytest.approx(1000e-6)
+    assert histogram.percentile(1.0) == pytest.approx(1000e-6)
+
+
+def test_huge_samples_land_in_the_last_bucket():
+    histogram = Histogram()
+    histogram.record(10 ** 6)
+    assert histogram.buckets[-1] == 1
+    assert histogram.percentile(0.5) == (1 << (Histogram.BUCKETS - 1)) / 1e6
+
+
+def test_snapshot():
+    histogram = Histogram()
+    assert histogram.snapshot() == {'count': 0, 'mean': 0.0, 'p50': 0.0,
+                                    'p99': 0.0, 'p999': 0.0, 'max': 0.0}
+    histogram.record(0.001)
+    histogram.record(0.003)
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 2
+    assert snapshot['mean'] == pytest.approx(0.002)
+    assert snapshot['max'] == 0.003
+    assert snapshot['p50'] == pytest.approx(1024e-6)
+    assert snapshot['p999'] == 0.003
@@ -0,0 +1,55 @@
+from partition import HashRing
+
+KEYS = [f'key{i}' for i in range(20000)]
+
+
+def owners(ring):
+    return {key: ring.owner(key) for key in KEYS}
+
+
+def test_empty_ring_owns_nothing():
+    assert HashRing().owner('key') is None
+
+
+def test_placement_is_deterministic():
+    assert owners(HashRing('ABCDE')) == owners(HashRing('EDCBA'))
+
+
+def test_keys_spread_evenly():
+    counts = {}
+    for owner in owners(HashRing('ABCDE')).values():
+        counts[owner] = counts.get(owner, 0) + 1
+    assert set(counts) == set('ABCDE')
+    for count in counts.values():
+        assert abs(count - len(KEYS) / 5) < len(KEYS) / 5 * 0.5
+
+
+def test_adding_a_server_only_moves_keys_to_it():
+    before = owners(HashRing('ABCDE'))
+    ring = HashRing('ABCDE')
+    ring.add('F')
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == 'F' for key in moved)
+    # about 1/6 of the keys
+    assert abs(len(moved) / len(KEYS) - 1 / 6) < 0.08
+
+
+def test_removing_a_server_only_moves_its_keys():
+    before = owners(HashRing('ABCDE'))
+    ring = HashRing('ABCDE')
+    ring.remove('C')
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(before[key] == 'C' for key in moved)
+    assert all(after[key] != 'C' for key in KEYS)
+    assert len(moved) == sum(owner == 'C' for owner in before.values())
+
+
+def test_add_then_remove_restores_placement():
+    ring = HashRing('ABCDE')
+    ring.add('F')
+    ring.remove('F')
+    assert owners(ring) == owners(HashRing('ABCDE'))
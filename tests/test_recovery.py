@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from messages import CommitOneMsg, DropKeysMsg, GetMsg, SetMsg
+from partition import HashRing
+from server import ServerNetwork
+
+
+def commit(evloop, server, txn_id, writes):
+    for key, value in writes.items():
+        assert server.handle_SetMsg(SetMsg(txn_id, key, value)).success
+    response = server.handle_CommitOneMsg(CommitOneMsg(txn_id, len(writes)))
+    if not hasattr(response, 'success'):
+        response = evloop.run_until_complete(response)
+    assert response.success
+
+
+def get(server, txn_id, key):
+    response = server.handle_GetMsg(GetMsg(txn_id, key))
+    assert response.success
+    return response.value
+
+
+def test_recover_from_log_only(evloop, paths):
+    server = ServerNetwork(**paths)
+    commit(evloop, server, 10, {'a': 'one', 'b': b'two'})
+    commit(evloop, server, 20, {'a': 'uno'})
+    server.wal.close()
+
+    server = ServerNetwork(**paths)
+    assert get(server, 30, 'a') == 'uno'
+    assert get(server, 30, 'b') == b'two'
+    assert server.storage.get('a').last_wr_txn == 20
+    server.wal.close()
+
+
+def test_recover_from_checkpoint_and_log(evloop, paths):
+    server = ServerNetwork(**paths)
+    commit(evloop, server, 10, {'a': 'one', 'b': 'two', 'c': 'three'})
+    evloop.run_until_complete(server.checkpoint())
+    # after the checkpoint, only in the new log segment
+    commit(evloop, server, 20, {'a': 'uno', 'd': 'four'})
+    server.wal.close()
+    assert server.wal.segments() == [server.storage.checkpoint().wal_segment]
+
+    server = ServerNetwork(**paths)
+    assert len(server.storage.checkpoint()) == 3
+    assert get(server, 30, 'a') == 'uno'
+    assert get(server, 30, 'b') == 'two'
+    assert get(server, 30, 'c') == 'three'
+    assert get(server, 30, 'd') == 'four'
+    server.wal.close()
+
+
+def test_read_below_a_checkpointed_version_is_refused(evloop, paths):
+    server = ServerNetwork(**paths)
+    commit(evloop, server, 10, {'a': 'one'})
+    commit(evloop, server, 20, {'a': 'uno'})
+    evloop.run_until_complete(server.checkpoint())
+    server.wal.close()
+
+    # only version 20 is in the checkpoint, 15 needs the one at 10
+    server = ServerNetwork(**paths)
+    assert not server.handle_GetMsg(GetMsg(15, 'a')).success
+    assert get(server, 30, 'a') == 'uno'
+    server.wal.close()
+
+
+def test_second_checkpoint_merges_the_first(evloop, paths):
+    server = ServerNetwork(**paths)
+    commit(evloop, server, 10, {'a': 'one', 'b': 'two'})
+    evloop.run_until_complete(server.checkpoint())
+    server.wal.close()
+
+    # b is only in the checkpoint now, it must survive the next one
+    server = ServerNetwork(**paths)
+    commit(evloop, server, 20, {'a': 'uno'})
+    evloop.run_until_complete(server.checkpoint())
+    server.wal.close()
+
+    server = ServerNetwork(**paths)
+    assert get(server, 30, 'a') == 'uno'
+    assert get(server, 30, 'b') == 'two'
+    server.wal.close()
+
+
+def test_keys_dropped_during_a_checkpoint(evloop, paths, monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'CHECKPOINT_CHUNK', 2)
+    server = ServerNetwork(**paths)
+    keys = [f'key{i}' for i in range(20)]
+    commit(evloop, server, 10, {key: key.upper() for key in keys})
+
+    # the copy is part way through when the keys move away
+    checkpoint = asyncio.ensure_future(server.checkpoint())
+    evloop.run_until_complete(asyncio.sleep(0))
+    assert not checkpoint.done()
+    dropped = server.handle_DropKeysMsg(DropKeysMsg('A', ['A', 'B'], 16))
+    assert 0 < dropped.count < len(keys)
+    evloop.run_until_complete(checkpoint)
+    server.wal.close()
+
+    server = ServerNetwork(**paths)
+    ring = HashRing(['A', 'B'], 16)
+    assert server.storage.keys() == {key for key in keys
+                                     if ring.owner(key) == 'A'}
+    for key in server.storage.keys():
+        assert get(server, 30, key) == key.upper()
+    server.wal.close()
+
+
+def test_checkpoint_loop_survives_a_failure(evloop, paths, monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'CHECKPOINT_INTERVAL', 0)
+    server = ServerNetwork(**paths)
+    server.dirty = 1
+    calls = []
+
+    async def checkpoint():
+        calls.append(None)
+        if len(calls) == 1:
+            raise KeyError('gone')
+        loop.cancel()
+    monkeypatch.setattr(server, 'checkpoint', checkpoint)
+
+    loop = asyncio.ensure_future(server.checkpoint_loop())
+    with pytest.raises(asyncio.CancelledError):
+        evloop.run_until_complete(loop)
+    assert len(calls) == 2
+    server.wal.close()
@@ -0,0 +1,247 @@
+import pytest
+
+from checkpoint import Checkpoint
+from codec import Compressed
+import framing
+from messages import (CODEC, AbortMsg, CommitOneMsg, DropKeysMsg, GetMsg,
+                      ReplicateMsg, SetMsg)
+from partition import HashRing
+from replication import Replicator
+from server import ServerNetwork, Storage
+
+
+class Transport:
+    def __init__(self):
+        self.decoder = framing.FrameDecoder()
+        self.msgs = []
+        self.closed = False
+
+    def write(self, data):
+        self.msgs.extend(CODEC.decode(frame)
+                         for frame in self.decoder.feed(data))
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+@pytest.fixture
+def replicator(evloop, monkeypatch):
+    monkeypatch.setattr(Replicator, 'BATCH_BYTES', 100)
+    monkeypatch.setattr(Replicator, 'CHUNK_SIZE', 64)
+    replicator = Replicator('localhost', 0, Storage())
+    replicator.transport = Transport()
+    return replicator
+
+
+@pytest.fixture
+def backup(evloop, paths):
+    backup = ServerNetwork(replica_of='A', **paths)
+    yield backup
+    backup.wal.close()
+
+
+def apply(backup, msgs):
+    for msg in msgs:
+        backup.handler(msg)(msg)
+
+
+def test_batches_are_split_by_size(replicator, backup):
+    records = [(txn_id, [(f'k{txn_id}', 'x' * 30)])
+               for txn_id in range(1, 11)]
+    records.append((11, [(f'm{i}', 'y' * 30) for i in range(10)]))
+    replicator._send(records)
+
+    msgs = replicator.transport.msgs
+    assert len(msgs) > 2
+    assert all(msg.type() == 'ReplicateMsg' for msg in msgs)
+    assert all(len(CODEC.encode(msg)) < 200 for msg in msgs)
+
+    apply(backup, msgs)
+    assert backup.storage.get('k7').value == 'x' * 30
+    assert backup.storage.get('m9').value == 'y' * 30
+    assert backup.storage.get('m9').commit_txn == 11
+
+
+@pytest.mark.parametrize('value', ['t' * 1000, b'\x00' * 1000,
+                                   Compressed(b'z' * 1000)])
+def test_large_values_are_chunked(replicator, backup, value):
+    replicator._send([(5, [('small', 'one'), ('large', value)])])
+
+    msgs = replicator.transport.msgs
+    types = [msg.type() for msg in msgs]
+    assert types.count('ReplicateChunkMsg') == 16
+    assert types[-1] == 'ReplicateMsg'
+
+    apply(backup, msgs)
+    assert backup.storage.get('small').value == 'one'
+    data_obj = backup.storage.get('large')
+    assert data_obj.commit_txn == 5
+    if isinstance(value, Compressed):
+        assert bytes(data_obj.value.data) == value.data
+    else:
+        assert data_obj.value == value
+
+
+def test_value_sent_again_starts_over(replicator, backup):
+    replicator._send([(5, [('large', 'a' * 1000)])])
+    first = replicator.transport.msgs
+    replicator.transport.msgs = []
+    # the connection dropped half way, then everything is sent again
+    apply(backup, first[:5])
+    replicator._send([(5, [('large', 'a' * 1000)])])
+    apply(backup, replicator.transport.msgs)
+    assert backup.storage.get('large').value == 'a' * 1000
+
+
+def test_send_failure_drops_the_connection(replicator, monkeypatch):
+    monkeypatch.setattr(framing, 'MAX_FRAME_SIZE', 50)
+    replicator._send([(1, [('k', 'v' * 80)])])
+    assert replicator.transport.closed
+
+
+def test_sync_streams_the_checkpoint(evloop, replicator, tmp_path,
+                                     monkeypatch):
+    monkeypatch.setattr(Replicator, 'SYNC_CHUNK', 7)
+    storage = replicator.storage
+    path = str(tmp_path / 'server.ckpt')
+    Checkpoint.write(path, [(f'k{i:02}', f'old{i}', -1, 1, 1)
+                            for i in range(30)], 0)
+    storage.set_checkpoint(Checkpoint(path))
+    # newer in memory, and moved away
+    storage.install('k03', 2, 'new3')
+    storage.install('k40', 2, 'new40')
+    storage.drop('k05')
+
+    evloop.run_until_complete(replicator._sync())
+    assert replicator.synced
+    sent = {key: (txn_id, value)
+            for msg in replicator.transport.msgs
+            for txn_id, writes in msg.records for key, value in writes}
+    assert sent['k03'] == (2, 'new3')
+    assert sent['k40'] == (2, 'new40')
+    assert sent['k29'] == (1, 'old29')
+    assert 'k05' not in sent
+    assert len(sent) == 30
+    # nothing was pulled into memory
+    assert set(storage.actual()) == {'k03', 'k40'}
+    storage.checkpoint().close()
+
+
+def test_sync_goes_on_in_a_new_checkpoint(evloop, replicator, tmp_path,
+                                          monkeypatch):
+    monkeypatch.setattr(Replicator, 'SYNC_CHUNK', 7)
+    storage = replicator.storage
+    records = [(f'k{i:02}', f'old{i}', -1, 1, 1) for i in range(30)]
+    Checkpoint.write(str(tmp_path / 'one.ckpt'), records, 0)
+    Checkpoint.write(str(tmp_path / 'two.ckpt'), records, 1)
+    storage.set_checkpoint(Checkpoint(str(tmp_path / 'one.ckpt')))
+
+    send_sync = replicator._send_sync
+
+    async def checkpoint_meanwhile(records):
+        if storage.checkpoint().wal_segment == 0:
+            storage.set_checkpoint(
+                Checkpoint(str(tmp_path / 'two.ckpt'))).close()
+        return await send_sync(records)
+    monkeypatch.setattr(replicator, '_send_sync', checkpoint_meanwhile)
+
+    evloop.run_until_complete(replicator._sync())
+    keys = [key for msg in replicator.transport.msgs
+            for _, writes in msg.records for key, _ in writes]
+    assert keys == [f'k{i:02}' for i in range(30)]
+    storage.checkpoint().close()
+
+
+def test_backup_refuses_reads_below_a_caught_up_version(evloop, replicator,
+                                                       backup):
+    replicator._send([(3, [('a', 'old'), ('b', 'x' * 100)])])
+    apply(backup, replicator.transport.msgs)
+    replicator.transport.msgs = []
+
+    # the backup missed the commits in between, version 5 among them
+    replicator.storage.install('a', 10, 'new')
+    replicator.storage.install('b', 10, 'y' * 100)
+    evloop.run_until_complete(replicator._sync())
+    apply(backup, replicator.transport.msgs)
+    for key in ('a', 'b'):
+        data_obj = backup.storage.get(key)
+        assert data_obj.read(7) == (False, '')
+        assert data_obj.read(10)[0]
+
+
+def test_backup_follows_the_ring_of_the_primary(evloop, backup, tmp_path,
+                                                monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'MAX_STALENESS', 60)
+    (tmp_path / 'primary').mkdir()
+    primary = ServerNetwork(
+        backups=[('localhost', 0)],
+        **{name: str(tmp_path / 'primary' / name) for name in
+           ('wal_path', 'checkpoint_path', 'stats_path', 'ring_path')})
+    replicator = primary.replicators[0]
+    replicator.transport = Transport()
+    replicator.synced = True
+    replicator.closed = lambda: 20
+
+    vnodes = HashRing.VNODES
+    ring = HashRing(['A', 'B'], vnodes)
+    moved = next(key for key in (f'k{i}' for i in range(1000))
+                 if ring.owner(key) == 'B')
+    kept = next(key for key in (f'k{i}' for i in range(1000))
+                if ring.owner(key) == 'A')
+    replicator._send([(10, [(moved, 'one'), (kept, 'two')])])
+    primary.handle_DropKeysMsg(DropKeysMsg('A', ['A', 'B'], vnodes))
+    apply(backup, replicator.transport.msgs)
+
+    # a client with the old ring can no longer read the moved key here
+    assert not backup.handle_GetMsg(GetMsg(15, moved, readonly=True)).success
+    assert backup.storage.get(moved) is None
+    assert backup.handle_GetMsg(GetMsg(15, kept, readonly=True)).value == \
+        'two'
+    primary.wal.close()
+
+
+def test_backup_serves_snapshots_up_to_the_closed_timestamp(
+        evloop, replicator, backup, monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'MAX_STALENESS', 60)
+    replicator.synced = True
+    replicator.closed = lambda: 20
+    replicator._send([(10, [('a', 'one')])])
+    apply(backup, replicator.transport.msgs)
+
+    assert backup.handle_GetMsg(GetMsg(20, 'a', readonly=True)).value == \
+        'one'
+    assert not backup.handle_GetMsg(GetMsg(21, 'a', readonly=True)).success
+    assert backup.metrics.counters['denied.snapshot.not_closed'] == 1
+
+
+def test_backup_waits_for_every_stream(evloop, backup, monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'MAX_STALENESS', 60)
+    backup.handle_ReplicateMsg(ReplicateMsg([], True, 20, 0, 2))
+    assert backup.snapshot_closed() == -1
+    backup.handle_ReplicateMsg(ReplicateMsg([], True, 15, 1, 2))
+    assert backup.snapshot_closed() == 15
+
+
+def test_primary_commits_nothing_below_closed(evloop, paths, monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'CLOSED_LAG', 0)
+    primary = ServerNetwork(**paths)
+    assert primary.handle_SetMsg(SetMsg(30, 'a', 'one')).success
+    primary.request_handler(SetMsg(50, 'b', 'two'), Transport())
+
+    # txn 30 is still active, so it stays open
+    assert primary.close_timestamp() == 29
+    primary.handle_AbortMsg(AbortMsg(30))
+    assert primary.close_timestamp() == 49
+    primary.handle_AbortMsg(AbortMsg(50))
+    assert primary.close_timestamp() == 50
+
+    assert primary.handle_SetMsg(SetMsg(40, 'c', 'late')).success
+    assert not primary.handle_CommitOneMsg(CommitOneMsg(40, 1)).success
+    assert primary.metrics.counters['refused.commit.closed'] == 1
+    primary.wal.close()
@@ -0,0 +1,428 @@
+import asyncio
+import random
+import time
+
+import pytest
+
+from codec import VALUE
+import framing
+from hlc import HybridClock
+from messages import (CODEC, AbortMsg, BatchMsg, CommitOneMsg, DoCommitMsg,
+                      ExportKeysMsg, GetChunkMsg, GetMsg, ImportKeysMsg,
+                      ReleaseMsg, ScanMsg, SetChunkMsg, SetMsg, TryCommitMsg)
+from partition import HashRing
+from server import ServerNetwork, Storage
+
+
+@pytest.fixture
+def server(evloop, paths):
+    server = ServerNetwork(**paths)
+    yield server
+    server.wal.close()
+
+
+def run(evloop, response):
+    # handlers that wait for the log return a coroutine
+    if asyncio.iscoroutine(response):
+        return evloop.run_until_complete(response)
+    return response
+
+
+class Transport:
+    def __init__(self):
+        self.decoder = framing.FrameDecoder()
+        self.msgs = []
+
+    def write(self, data):
+        self.msgs.extend(CODEC.decode(frame)
+                         for frame in self.decoder.feed(data))
+
+    def is_closing(self):
+        return False
+
+
+def lease_runs_out(server, txn_id):
+    server.storage.txn(txn_id).last_seen -= Storage.TXN_LEASE + 1
+    assert txn_id in server.storage.expire()
+
+
+def test_expired_txn_is_not_started_again(evloop, server):
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'one')).success
+    lease_runs_out(server, 10)
+
+    # the write to a is gone, the txn must not commit with b alone
+    assert not server.handle_SetMsg(SetMsg(10, 'b', 'two')).success
+    assert not server.handle_GetMsg(GetMsg(10, 'a')).success
+    assert not run(evloop, server.handle_CommitOneMsg(
+        CommitOneMsg(10, 2))).success
+    assert server.storage.get('b') is None
+
+
+def test_aborted_txn_is_not_started_again(evloop, server):
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'one')).success
+    server.handle_AbortMsg(AbortMsg(10))
+
+    # a write that was still on its way
+    assert not server.handle_SetMsg(SetMsg(10, 'b', 'two')).success
+    assert not server.handle_TryCommitMsg(TryCommitMsg(10, 2)).success
+
+
+def test_commit_with_lost_writes_is_refused(evloop, server):
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'one')).success
+    lease_runs_out(server, 10)
+    # long after, the abort is forgotten
+    server.storage._ended[10] -= Storage.TXN_LEASE + 1
+    server.storage.collect_aborted()
+    assert not server.storage.aborted(10)
+
+    assert server.handle_SetMsg(SetMsg(10, 'b', 'two')).success
+    assert not run(evloop, server.handle_CommitOneMsg(
+        CommitOneMsg(10, 2))).success
+    assert server.storage.get('b') is None
+    assert server.metrics.counters['refused.commit.lost_writes'] == 1
+
+
+def test_recent_aborts_are_kept(evloop, server):
+    server.handle_AbortMsg(AbortMsg(10))
+    server.storage.collect_aborted()
+    assert server.storage.aborted(10)
+
+
+def test_commit_with_all_writes(evloop, server):
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'one')).success
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'uno')).success
+    assert server.handle_SetMsg(SetMsg(10, 'b', 'two')).success
+    assert run(evloop, server.handle_CommitOneMsg(
+        CommitOneMsg(10, 2))).success
+    assert server.handle_GetMsg(GetMsg(20, 'a')).value == 'uno'
+
+
+def commit(evloop, server, txn_id, writes):
+    for key, value in writes.items():
+        if not server.handle_SetMsg(SetMsg(txn_id, key, value)).success:
+            return False
+    return run(evloop, server.handle_CommitOneMsg(
+        CommitOneMsg(txn_id, len(writes)))).success
+
+
+def versions(commits, installed=0.0):
+    data_obj = Storage.DataObj()
+    for txn_id in commits:
+        data_obj.add_version(txn_id, f'v{txn_id}')
+    data_obj.installed = [installed] * len(commits)
+    return data_obj
+
+
+def test_read_finds_the_newest_version_at_or_before_it():
+    data_obj = versions([10, 20])
+    assert data_obj.read(5) == (True, '')
+    assert data_obj.read(10) == (True, 'v10')
+    assert data_obj.read(15) == (True, 'v10')
+    assert data_obj.read(25) == (True, 'v20')
+
+
+def test_collect_drops_versions_no_txn_can_read():
+    data_obj = versions([10, 20, 30])
+    data_obj.collect(25)
+    assert data_obj.commits == [20, 30]
+    # the version 15 needs is gone
+    assert data_obj.read(15) == (False, '')
+    assert data_obj.read(20) == (True, 'v20')
+
+
+def test_collect_keeps_recent_versions():
+    data_obj = versions([10, 20, 30], installed=time.monotonic())
+    # an older txn may still be on its way
+    data_obj.collect(None)
+    assert data_obj.commits == [10, 20, 30]
+    assert not data_obj.collected
+
+
+def test_collect_keeps_at_most_max_versions(monkeypatch):
+    monkeypatch.setattr(Storage, 'MAX_VERSIONS', 3)
+    data_obj = versions(range(10, 60, 10), installed=time.monotonic())
+    data_obj.collect(5)
+    assert data_obj.commits == [30, 40, 50]
+    assert data_obj.collected
+
+
+def test_older_write_becomes_the_version_below(evloop, server):
+    # Thomas write rule: the older commit is not refused
+    assert commit(evloop, server, 20, {'a': 'new'})
+    assert commit(evloop, server, 10, {'a': 'old'})
+    assert server.metrics.counters['set.obsolete'] == 1
+    data_obj = server.storage.get('a')
+    assert data_obj.value == 'new'
+    assert data_obj.read(15) == (True, 'old')
+    assert data_obj.last_wr_txn == 20
+
+
+def test_snapshot_is_not_torn_by_an_older_writer(evloop, server):
+    assert commit(evloop, server, 10, {'a': 'one'})
+
+    snapshot = server.handle_GetMsg(GetMsg(100, 'a', readonly=True))
+    assert snapshot.success and snapshot.value == 'one'
+    missing = server.handle_GetMsg(GetMsg(100, 'b', readonly=True))
+    assert missing.success and missing.value == ''
+
+    # the reads closed the timestamp instead of leaving read marks, so an
+    # older txn writing below the snapshot after them is refused
+    assert server.storage.get('a').last_rd_txn == -1
+    assert not server.storage.range_read_above('b', 50)
+    assert not commit(evloop, server, 50, {'a': 'two'})
+    assert not commit(evloop, server, 60, {'b': 'new'})
+    assert server.metrics.counters['refused.commit.closed'] == 2
+    assert server.handle_GetMsg(GetMsg(100, 'a', readonly=True)).value == \
+        'one'
+    assert server.handle_GetMsg(GetMsg(100, 'b', readonly=True)).value == ''
+
+    # newer ones are fine
+    assert commit(evloop, server, 110, {'a': 'three', 'b': 'new'})
+
+
+def test_snapshot_scan_is_not_torn_by_an_older_writer(evloop, server):
+    assert commit(evloop, server, 10, {'k1': 'one', 'k3': 'three'})
+
+    scan = server.handle_ScanMsg(ScanMsg(100, 'k', 'l', 10, readonly=True))
+    assert scan.success
+    assert scan.records == [('k1', 'one', 3), ('k3', 'three', 5)]
+
+    assert not commit(evloop, server, 50, {'k2': 'two'})
+    assert not commit(evloop, server, 60, {'k3': 'drei'})
+    scan = server.handle_ScanMsg(ScanMsg(100, 'k', 'l', 10, readonly=True))
+    assert scan.records == [('k1', 'one', 3), ('k3', 'three', 5)]
+
+
+def test_snapshot_waits_for_older_txns(evloop, server):
+    assert server.handle_SetMsg(SetMsg(50, 'a', 'one')).success
+    snapshot = asyncio.ensure_future(
+        server.handle_GetMsg(GetMsg(100, 'a', readonly=True)), loop=evloop)
+    evloop.run_until_complete(asyncio.sleep(0.05))
+    assert not snapshot.done()
+
+    run(evloop, server.handle_CommitOneMsg(CommitOneMsg(50, 1)))
+    assert evloop.run_until_complete(snapshot).value == 'one'
+    assert server.closed == 100
+
+
+def test_snapshot_gives_up_on_older_txns(evloop, server, monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'SNAPSHOT_WAIT', 0.05)
+    assert server.handle_SetMsg(SetMsg(50, 'a', 'one')).success
+    assert not run(evloop, server.handle_GetMsg(
+        GetMsg(100, 'a', readonly=True))).success
+    assert server.metrics.counters['denied.snapshot.not_closed'] == 1
+    # the older txn may still commit
+    assert run(evloop, server.handle_CommitOneMsg(CommitOneMsg(50, 1))).success
+
+
+def test_read_refused_below_a_prepared_writer(evloop, server):
+    assert commit(evloop, server, 5, {'a': 'five', 'k1': 'five'})
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'ten')).success
+    assert server.handle_SetMsg(SetMsg(10, 'k2', 'ten')).success
+    assert server.handle_TryCommitMsg(TryCommitMsg(10, 2)).success
+
+    # reading v5 now would not be repeatable once 10 commits
+    assert not server.handle_GetMsg(GetMsg(20, 'a')).success
+    assert not server.handle_ScanMsg(ScanMsg(20, 'k', 'l', 10)).success
+    assert server.metrics.counters['denied.get.prepared_write'] == 1
+    assert server.metrics.counters['denied.scan.prepared_write'] == 1
+    run(evloop, server.handle_DoCommitMsg(DoCommitMsg(10)))
+    assert server.handle_GetMsg(GetMsg(30, 'a')).value == 'ten'
+
+
+def test_read_above_an_unprepared_writer_refuses_it(evloop, server):
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'ten')).success
+    assert server.handle_GetMsg(GetMsg(20, 'a')).success
+    assert not server.handle_TryCommitMsg(TryCommitMsg(10, 1)).success
+
+
+def test_large_values_in_a_batch_come_as_handles(evloop, server,
+                                                 monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'CHUNK_SIZE', 4)
+    monkeypatch.setattr(ServerNetwork, 'MAX_REPLY', 6)
+    assert commit(evloop, server, 10,
+                  {'a': '0123456789', 'b': 'xyz', 'c': 'hello'})
+
+    batch = server.handle_BatchMsg(BatchMsg(20, [
+        (BatchMsg.OP_GET, 'a', ''), (BatchMsg.OP_GET, 'b', ''),
+        (BatchMsg.OP_GET, 'c', '')]))
+    assert batch.results == [(True, '0123', 10), (True, 'xyz', 3),
+                             (True, '', 5)]
+    assert server.handle_GetChunkMsg(GetChunkMsg(20, 'c', 0)).value == 'hell'
+
+    scan = server.handle_ScanMsg(ScanMsg(20, 'a', 'd', 10))
+    assert scan.records == [('a', '0123', 10), ('b', 'xyz', 3),
+                            ('c', '', 5)]
+
+
+def test_chunk_sent_again_counts_once(evloop, server):
+    for offset, data in ((0, b'ab'), (0, b'ab'), (4, b'ef')):
+        assert server.handle_SetChunkMsg(SetChunkMsg(
+            10, 'a', 6, offset, data, VALUE.KIND_BYTES)).success
+        assert server.storage.txn(10).buffer == {}
+
+    assert server.handle_SetChunkMsg(SetChunkMsg(
+        10, 'a', 6, 2, b'cd', VALUE.KIND_BYTES)).success
+    assert server.storage.txn(10).buffer == {'a': b'abcdef'}
+
+
+def test_refused_chunks_take_no_memory(evloop, server):
+    assert commit(evloop, server, 5, {'a': 'one'})
+    assert server.handle_GetMsg(GetMsg(20, 'a')).success
+
+    assert not server.handle_SetChunkMsg(SetChunkMsg(
+        10, 'a', ServerNetwork.MAX_VALUE_SIZE, 0, b'ab',
+        VALUE.KIND_BYTES)).success
+    assert server.storage.txn(10).chunks == {}
+    assert server.metrics.counters['denied.set.newer_read'] == 1
+
+
+def test_chunks_in_flight_are_capped_per_txn(evloop, server, monkeypatch):
+    monkeypatch.setattr(ServerNetwork, 'MAX_CHUNKED_BYTES', 1000)
+
+    def set_chunk(txn_id, key, offset, data):
+        return server.handle_SetChunkMsg(SetChunkMsg(
+            txn_id, key, 600, offset, data, VALUE.KIND_BYTES)).success
+
+    assert set_chunk(10, 'a', 0, b'a' * 300)
+    assert not set_chunk(10, 'b', 0, b'b' * 300)
+    assert list(server.storage.txn(10).chunks) == ['a']
+    assert server.metrics.counters['denied.set.chunks_memory'] == 1
+    # other txns have their own budget
+    assert set_chunk(20, 'c', 0, b'c' * 300)
+
+    # once a value is complete its chunks no longer count
+    assert set_chunk(10, 'a', 300, b'a' * 300)
+    assert set_chunk(10, 'b', 0, b'b' * 300)
+
+
+def test_snapshot_reads_keep_no_txn(evloop, server):
+    assert commit(evloop, server, 10, {'a': 'one'})
+    assert server.handle_GetMsg(GetMsg(100, 'a', readonly=True)).success
+    assert server.handle_ScanMsg(ScanMsg(100, '', '', 10,
+                                         readonly=True)).success
+    assert server.storage.txn(100) is None
+    assert server.storage.oldest_active() is None
+
+
+def test_released_reader_is_not_an_abort(evloop, server):
+    assert server.handle_GetMsg(GetMsg(10, 'a')).success
+    server.handle_ReleaseMsg(ReleaseMsg(10))
+    assert server.storage.txn(10) is None
+    assert 'aborts' not in server.metrics.counters
+    assert server.metrics.counters['released'] == 1
+
+
+def test_expired_reader_is_not_an_abort(evloop, server, monkeypatch):
+    monkeypatch.setattr(Storage, 'TXN_LEASE', 0.2)
+    assert server.handle_GetMsg(GetMsg(10, 'a')).success
+    assert server.handle_SetMsg(SetMsg(20, 'b', 'two')).success
+    server.storage.txn(10).last_seen -= Storage.TXN_LEASE + 1
+    server.storage.txn(20).last_seen -= Storage.TXN_LEASE + 1
+
+    lease_loop = asyncio.ensure_future(server.lease_loop(), loop=evloop)
+    evloop.run_until_complete(asyncio.sleep(Storage.TXN_LEASE / 4 + 0.1))
+    lease_loop.cancel()
+    assert server.metrics.counters['expired.readonly'] == 1
+    assert server.metrics.counters['aborts.expired'] == 1
+
+
+def test_range_reads_match_every_read():
+    rng = random.Random(2)
+    range_reads = Storage.RangeReads()
+    reads = []
+    every_read = []
+
+    def above(reads, key, txn_id):
+        return any(reader > txn_id and start <= key and (end == '' or
+                                                         key < end)
+                   for start, end, reader, _ in reads)
+
+    for now in range(300):
+        start = f'k{rng.randrange(50):02}'
+        end = rng.choice(['', f'k{rng.randrange(50):02}'])
+        txn_id = rng.randrange(1000)
+        range_reads.add(start, end, txn_id, now)
+        reads.append((start, end, txn_id, now))
+        every_read.append((start, end, txn_id, now))
+        if now % 50 == 49:
+            oldest_active, horizon = rng.randrange(1000), now - 20
+            range_reads.collect(oldest_active, horizon)
+            reads = [read for read in reads
+                     if read[3] > horizon or read[2] > oldest_active]
+
+        # collecting may keep a part longer than its reads, never shorter
+        for key in ('', 'k', 'k07', 'k25', 'k49', 'z'):
+            txn_id = rng.randrange(1000)
+            if now < 49:
+                assert range_reads.above(key, txn_id) == \
+                    above(reads, key, txn_id)
+            assert above(reads, key, txn_id) <= \
+                range_reads.above(key, txn_id) <= \
+                above(every_read, key, txn_id)
+
+
+def test_vote_renews_the_lease(evloop, server):
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'one')).success
+    server.storage.txn(10).last_seen -= Storage.TXN_LEASE + 1
+    assert server.handle_TryCommitMsg(TryCommitMsg(10, 1)).success
+    assert server.storage.expire() == {}
+
+
+def test_prepared_txn_expires_loudly(evloop, server, monkeypatch):
+    monkeypatch.setattr(Storage, 'TXN_LEASE', 0.2)
+    assert server.handle_SetMsg(SetMsg(10, 'a', 'one')).success
+    assert server.handle_TryCommitMsg(TryCommitMsg(10, 1)).success
+    server.storage.txn(10).last_seen -= Storage.TXN_LEASE + 1
+
+    lease_loop = asyncio.ensure_future(server.lease_loop(), loop=evloop)
+    evloop.run_until_complete(asyncio.sleep(Storage.TXN_LEASE / 4 + 0.1))
+    lease_loop.cancel()
+    assert server.metrics.counters['aborts.expired.prepared'] == 1
+    assert 'aborts.expired' not in server.metrics.counters
+
+
+def test_commit_without_writes_is_not_counted(evloop, server):
+    assert server.handle_GetMsg(GetMsg(10, 'a')).success
+    assert server.handle_TryCommitMsg(TryCommitMsg(10, 0)).success
+    server.handle_DoCommitMsg(DoCommitMsg(10))
+    assert 'commits' not in server.metrics.counters
+
+
+def test_export_waits_for_prepared_txns_creating_keys(evloop, server):
+    vnodes = HashRing.VNODES
+    server._set_ring('A', ['A'], vnodes)
+    key = next(key for key in (f'k{i}' for i in range(1000))
+               if HashRing(['A', 'B'], vnodes).owner(key) == 'B')
+    assert server.handle_SetMsg(SetMsg(10, key, 'new')).success
+    assert server.handle_TryCommitMsg(TryCommitMsg(10, 1)).success
+
+    export = asyncio.ensure_future(server.handle_ExportKeysMsg(
+        ExportKeysMsg('A', ['A', 'B'], vnodes, '', 100)), loop=evloop)
+    evloop.run_until_complete(asyncio.sleep(0.05))
+    run(evloop, server.handle_DoCommitMsg(DoCommitMsg(10)))
+    response = evloop.run_until_complete(export)
+    assert [record[0] for record in response.records] == [key]
+    assert response.records[0][1] == 'new'
+
+
+def test_read_below_an_imported_version_is_refused(evloop, server):
+    run(evloop, server.handle_ImportKeysMsg(
+        ImportKeysMsg([('a', 'moved', 5, 20, 20)])))
+    assert not server.handle_GetMsg(GetMsg(15, 'a')).success
+    assert server.handle_GetMsg(GetMsg(30, 'a')).value == 'moved'
+
+
+def test_txn_id_too_far_ahead_is_refused(evloop, server):
+    broken = HybridClock(1)
+    broken._physical = HybridClock.wall() + 2 * HybridClock.MAX_DRIFT
+    txn_id = broken.now()
+
+    transport = Transport()
+    server.request_handler(SetMsg(txn_id, 'a', 'x'), transport)
+    server.request_handler(GetMsg(txn_id, 'a', readonly=True), transport)
+    assert [msg.success for msg in transport.msgs] == [False, False]
+    assert server.newest_txn_id == -1
+    assert server.closed == -1
+    assert server.metrics.counters['denied.clock'] == 2
+    assert server.storage.oldest_active() is None
@@ -0,0 +1,50 @@
+import bisect
+import random
+
+import pytest
+
+from sortedkeys import SortedKeys
+
+
+@pytest.fixture
+def small_lists(monkeypatch):
+    # split lists early, so that a few hundred keys span many of them
+    monkeypatch.setattr(SortedKeys, 'LOAD', 4)
+
+
+def test_stays_sorted(small_lists):
+    rng = random.Random(1)
+    keys = SortedKeys(['k050', 'k010'])
+    expected = {'k050', 'k010'}
+    for _ in range(2000):
+        key = f'k{rng.randrange(100):03}'
+        if rng.random() < 0.6:
+            keys.add(key)
+            expected.add(key)
+        else:
+            keys.discard(key)
+            expected.discard(key)
+        assert len(keys) == len(expected)
+    assert list(keys) == sorted(expected)
+
+
+def test_irange_and_floor(small_lists):
+    expected = sorted(f'k{i:03}' for i in range(0, 100, 3))
+    keys = SortedKeys(reversed(expected))
+    for start, end in (('', ''), ('k010', 'k020'), ('k011', ''),
+                       ('k5', 'k6'), ('z', ''), ('', 'a')):
+        assert list(keys.irange(start, end)) == [
+            key for key in expected
+            if start <= key and (end == '' or key < end)]
+    for key in ('', 'k', 'k000', 'k001', 'k050', 'k099', 'z'):
+        index = bisect.bisect_right(expected, key)
+        assert keys.floor(key) == (expected[index - 1] if index else None)
+
+
+def test_empty():
+    keys = SortedKeys()
+    keys.discard('a')
+    assert list(keys.irange('')) == [] and keys.floor('a') is None
+    keys.add('a')
+    keys.discard('a')
+    assert len(keys) == 0 and list(keys) == []
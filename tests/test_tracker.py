@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from tracker import RequestTracker
+
+
+def test_response_resolves_its_request(evloop):
+    tracker = RequestTracker()
+    first = tracker.track(('A', 1), 10)
+    second = tracker.track(('A', 2), 10)
+    assert len(tracker) == 2
+
+    assert tracker.resolve(('A', 2), 'two')
+    assert second.result() == 'two'
+    assert not first.done()
+    evloop.run_until_complete(asyncio.sleep(0))
+    assert len(tracker) == 1
+
+
+def test_each_request_has_its_own_deadline(evloop):
+    tracker = RequestTracker()
+    short = tracker.track(('A', 1), 0.01)
+    long = tracker.track(('B', 1), 10)
+
+    with pytest.raises(asyncio.TimeoutError):
+        evloop.run_until_complete(short)
+    assert not long.done()
+    # the timed out request is gone, the other one still waits
+    assert len(tracker) == 1
+    assert tracker.resolve(('B', 1), 'late but in time')
+    assert evloop.run_until_complete(long) == 'late but in time'
+    assert len(tracker) == 0
+
+
+def test_late_response_is_dropped(evloop):
+    tracker = RequestTracker()
+    future = tracker.track(('A', 1), 0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        evloop.run_until_complete(future)
+
+    assert not tracker.resolve(('A', 1), 'too late')
+    assert not tracker.resolve(('A', 99), 'never asked')
+    assert tracker.late == 2
+    assert len(tracker) == 0
+
+
+def test_cancelled_request_is_removed(evloop):
+    tracker = RequestTracker()
+    future = tracker.track(('A', 1), 10)
+    future.cancel()
+    evloop.run_until_complete(asyncio.sleep(0))
+    assert len(tracker) == 0
+    assert not tracker.resolve(('A', 1), 'after cancel')
+
+
+def test_reused_uid_keeps_the_newer_request(evloop):
+    tracker = RequestTracker()
+    old = tracker.track(('A', 1), 10)
+    new = tracker.track(('A', 1), 10)
+    # the old one finishing must not remove the new one
+    old.cancel()
+    evloop.run_until_complete(asyncio.sleep(0))
+    assert len(tracker) == 1
+    assert tracker.resolve(('A', 1), 'new')
+    assert new.result() == 'new'
@@ -0,0 +1,77 @@
+import os
+
+from wal import WriteAheadLog
+
+
+def open_log(path):
+    wal = WriteAheadLog(str(path), flush_interval=0.001)
+    list(wal.replay())
+    wal.open()
+    return wal
+
+
+def test_replay_returns_what_was_appended(evloop, tmp_path):
+    wal = open_log(tmp_path / 'server.wal')
+    records = [(1, [('a', 'one')]), (2, [('b', b'two'), ('c', '')])]
+    for txn_id, writes in records:
+        durable = wal.append(txn_id, writes)
+    evloop.run_until_complete(durable)
+    wal.close()
+
+    replayed = list(WriteAheadLog(str(tmp_path / 'server.wal')).replay())
+    assert replayed == records
+
+
+def test_torn_tail_is_cut_off(evloop, tmp_path):
+    path = tmp_path / 'server.wal'
+    wal = open_log(path)
+    wal.append(1, [('a', 'one')])
+    evloop.run_until_complete(wal.append(2, [('b', 'two')]))
+    wal.close()
+
+    # a crash in the middle of writing the last record
+    size = os.path.getsize(path)
+    os.truncate(path, size - 3)
+
+    wal = WriteAheadLog(str(path))
+    assert list(wal.replay()) == [(1, [('a', 'one')])]
+    good = os.path.getsize(path)
+    assert good < size - 3
+
+    # appending goes on after the last good record
+    wal.open()
+    evloop.run_until_complete(wal.append(3, [('c', 'three')]))
+    wal.close()
+    assert [txn_id for txn_id, _ in WriteAheadLog(str(path)).replay()] == \
+        [1, 3]
+
+
+def test_corrupt_record_ends_replay(evloop, tmp_path):
+    path = tmp_path / 'server.wal'
+    wal = open_log(path)
+    wal.append(1, [('a', 'one')])
+    evloop.run_until_complete(wal.append(2, [('b', 'two')]))
+    wal.close()
+
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+
+    assert list(WriteAheadLog(str(path)).replay()) == [(1, [('a', 'one')])]
+
+
+def test_rotate_and_drop_segments(evloop, tmp_path):
+    path = tmp_path / 'server.wal'
+    wal = open_log(path)
+    evloop.run_until_complete(wal.append(1, [('a', 'one')]))
+    segment = wal.rotate()
+    evloop.run_until_complete(wal.append(2, [('b', 'two')]))
+
+    assert wal.segments() == [0, segment]
+    assert [txn_id for txn_id, _ in wal.replay(segment)] == [2]
+
+    wal.drop_before(segment)
+    assert wal.segments() == [segment]
+    wal.close()
@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from messages import (BatchMsg, CommitOneMsg, DoCommitMsg, GetMsg, ScanMsg,
+                      SetMsg, TryCommitMsg)
+from workers import WorkerNetwork, worker_path
+
+
+@pytest.fixture
+def workers(evloop, tmp_path):
+    """
+    Two workers of a server, talking over their unix sockets
+    """
+    count = 2
+    workers = [WorkerNetwork(
+        index, count, socket_path=str(tmp_path / 'server.sock'), port=0,
+        **{name: worker_path(str(tmp_path / f'server.{name}'), index)
+           for name in ('wal_path', 'checkpoint_path', 'stats_path',
+                        'ring_path')})
+        for index in range(count)]
+    for worker in workers:
+        evloop.run_until_complete(worker.create_server())
+    yield workers
+    for worker in workers:
+        worker.close()
+    evloop.run_until_complete(asyncio.sleep(0))
+
+
+def send(evloop, worker, msg):
+    """
+    Response of worker to msg as if it came from a client
+    """
+    response = worker.handler(msg)(msg)
+    if asyncio.iscoroutine(response):
+        response = evloop.run_until_complete(response)
+    return response
+
+
+def keys_of(worker, count, prefix='k'):
+    keys = (f'{prefix}{i}' for i in range(1000))
+    return [key for key in keys if worker.shard(key) == worker.index][:count]
+
+
+def commit(evloop, worker, txn_id, writes):
+    for key, value in writes.items():
+        assert send(evloop, worker, SetMsg(txn_id, key, value)).success
+    return send(evloop, worker,
+                CommitOneMsg(txn_id, len(writes))).success
+
+
+def test_get_and_set_are_forwarded_to_the_owner(evloop, workers):
+    first, second = workers
+    key = keys_of(second, 1)[0]
+    assert send(evloop, first, SetMsg(10, key, 'v')).success
+    assert second.storage.txn(10).buffer == {key: 'v'}
+    assert first.storage.txn(10) is None
+
+    response = send(evloop, first, GetMsg(10, key))
+    assert response.success and response.value == 'v'
+    assert response.orig_uid == 0
+
+
+def test_batch_is_split_over_the_workers(evloop, workers):
+    first, second = workers
+    ours, theirs = keys_of(first, 2), keys_of(second, 2)
+    assert commit(evloop, first, 10, {ours[0]: 'a', theirs[0]: 'b'})
+
+    response = send(evloop, first, BatchMsg(20, [
+        (BatchMsg.OP_GET, theirs[0], ''),
+        (BatchMsg.OP_SET, ours[1], 'c'),
+        (BatchMsg.OP_GET, ours[0], ''),
+        (BatchMsg.OP_SET, theirs[1], 'd')]))
+    assert [result[:2] for result in response.results] == \
+        [(True, 'b'), (True, ''), (True, 'a'), (True, '')]
+    assert first.storage.txn(20).buffer == {ours[1]: 'c'}
+    assert second.storage.txn(20).buffer == {theirs[1]: 'd'}
+
+
+def test_scan_is_merged_from_the_workers(evloop, workers):
+    first, second = workers
+    keys = sorted(keys_of(first, 3) + keys_of(second, 3))
+    assert commit(evloop, first, 10, {key: key.upper() for key in keys})
+
+    response = send(evloop, second, ScanMsg(20, 'k', 'l', 4))
+    assert [record[0] for record in response.records] == keys[:4]
+    assert not response.done and response.next_key == keys[4]
+    response = send(evloop, second, ScanMsg(20, response.next_key, 'l', 4))
+    assert [record[:2] for record in response.records] == \
+        [(key, key.upper()) for key in keys[4:]]
+    assert response.done
+
+
+def test_two_phase_commit_over_the_workers(evloop, workers):
+    first, second = workers
+    ours, theirs = keys_of(first, 1)[0], keys_of(second, 1)[0]
+    assert send(evloop, first, SetMsg(10, ours, 'a')).success
+    assert send(evloop, second, SetMsg(10, theirs, 'b')).success
+
+    assert send(evloop, second, TryCommitMsg(10, 2)).success
+    assert first.storage.txn(10).prepared
+    assert second.storage.txn(10).prepared
+    send(evloop, first, DoCommitMsg(10))
+    assert first.storage.get(ours).value == 'a'
+    assert second.storage.get(theirs).value == 'b'
+
+
+def test_worker_voting_no_aborts_everywhere(evloop, workers):
+    first, second = workers
+    ours, theirs = keys_of(first, 1)[0], keys_of(second, 1)[0]
+    assert send(evloop, first, SetMsg(10, ours, 'a')).success
+    assert send(evloop, first, SetMsg(10, theirs, 'b')).success
+    # a newer txn finds the key of the second worker missing first
+    assert send(evloop, first, GetMsg(20, theirs)).success
+
+    assert not send(evloop, first, CommitOneMsg(10, 2)).success
+    evloop.run_until_complete(asyncio.sleep(0.05))
+    assert first.storage.get(ours) is None
+    assert second.storage.get(theirs) is None
+    assert first.storage.aborted(10) and second.storage.aborted(10)
+    assert second.metrics.counters['refused.commit.range_read'] == 1
+    assert 'refused.commit.range_read' not in first.metrics.counters
+
+
+def test_commit_with_a_lost_write_is_refused(evloop, workers):
+    first, second = workers
+    ours, theirs = keys_of(first, 1)[0], keys_of(second, 1)[0]
+    assert send(evloop, first, SetMsg(10, ours, 'a')).success
+    assert send(evloop, first, SetMsg(10, theirs, 'b')).success
+    # the second worker lost its part, say its lease ran out
+    second.storage.abort(10)
+
+    assert not send(evloop, first, CommitOneMsg(10, 2)).success
+    assert first.metrics.counters['refused.commit.lost_writes'] == 1
+    assert first.storage.get(ours) is None
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+from ui import UI
+
+
+class RequestTracker:
+    """
+    Requests waiting for their response, keyed on (peer name, uid).
+
+    Every request gets a future that is resolved by its response or fails
+    with asyncio.TimeoutError at its deadline. Entries are removed as soon
+    as the future is done for any reason, so the table only ever holds the
+    requests that are actually in flight, and a response arriving after
+    its deadline finds nothing to resolve and is dropped.
+    """
+
+    def __init__(self):
+        self.evloop = asyncio.get_event_loop()
+
+        # (peer name, uid) -> asyncio.Future
+        self._pending = dict()
+        # responses that arrived after their request was given up on
+        self.late = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def track(self, request_key, timeout):
+        """
+        Future for the response to request_key, failing after timeout
+        """
+        future = self.evloop.create_future()
+        timer = self.evloop.call_later(timeout, self._expire, future)
+        future.add_done_callback(
+            lambda _: self._done(request_key, future, timer))
+        self._pending[request_key] = future
+        return future
+
+    def resolve(self, request_key, response):
+        """
+        Hand response to whoever waits for it, False if nobody does
+        """
+        future = self._pending.get(request_key, None)
+        if future is None or future.done():
+            self.late += 1
+            UI.log(f'Dropping late response {request_key}',
+                   level=logging.DEBUG)
+            return False
+        future.set_result(response)
+        return True
+
+    def _done(self, request_key, future, timer):
+        timer.cancel()
+        # a wrapped uid may already be reused by a newer request
+        if self._pending.get(request_key, None) is future:
+            del self._pending[request_key]
+
+    @staticmethod
+    def _expire(future):
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
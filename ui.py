@@ -28,8 +28,15 @@ class UI:
             print(str(msg))
 
     @staticmethod
-    def log(msg, level=logging.INFO):
-        logging.log(level, msg)
+    def log(msg, *args, level=logging.INFO, sample=None):
+        """
+        Log msg % args, formatted only if the record is actually written.
+        sample is the message type the record is about, see logs.setup()
+        """
+        if sample is None:
+            logging.log(level, msg, *args)
+        else:
+            logging.log(level, msg, *args, extra={'sample': sample})
 
     def set_output_to_return(self, should_return, outfile=None):
         self.should_return = should_return
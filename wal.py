@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import struct
+import zlib
+
+from codec import I64, STR, VALUE, CodecError, List, Tuple
+from ui import UI
+
+
+class WriteAheadLog:
+    """
+    Append-only log of committed transactions with group commit.
+
+    append() only queues a record and returns a future. Records are
+    written and fsynced together, either FLUSH_INTERVAL seconds after the
+    first record of a batch was queued or as soon as BATCH_SIZE records are
+    waiting, whichever comes first. While one batch is being fsynced on a
+    worker thread the next one keeps filling up, so under load one fsync
+    covers many commits and the event loop never blocks on the disk.
+
+    The log is split into numbered segments: segment 0 is the file at path
+    and segment n is path.n. rotate() starts a new segment so that a
+    checkpoint can later drop everything before it.
+    """
+    FLUSH_INTERVAL = 0.002
+    BATCH_SIZE = 256
+
+    # length and crc32 of the payload, then the payload
+    HEADER = struct.Struct('!II')
+    # (txn_id, [(key, value)])
+    RECORD = Tuple(I64, List(Tuple(STR, VALUE)))
+
+    def __init__(self, path, flush_interval=None, batch_size=None):
+        self.evloop = asyncio.get_event_loop()
+        self.path = path
+        self.flush_interval = flush_interval or WriteAheadLog.FLUSH_INTERVAL
+        self.batch_size = batch_size or WriteAheadLog.BATCH_SIZE
+
+        self.segment = 0
+        self._fd = None
+        # fds of old segments, closed once no flush is using them
+        self._retired = []
+        self._pending = bytearray()
+        self._waiters = []
+        self._timer = None
+        self._flushing = None  # type: asyncio.Future
+
+    def segment_path(self, segment):
+        if segment == 0:
+            return self.path
+        return f'{self.path}.{segment}'
+
+    def segments(self):
+        """
+        Numbers of all segments on disk, in order
+        """
+        directory = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.'
+
+        found = []
+        if os.path.exists(self.path):
+            found.append(0)
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                found.append(int(name[len(prefix):]))
+        return sorted(found)
+
+    def replay(self, from_segment=0):
+        """
+        Yield (txn_id, [(key, value)]) for every complete record in the
+        segments from from_segment on, then cut off whatever a crash left
+        half written at the end
+        """
+        for segment in self.segments():
+            if segment >= from_segment:
+                yield from self._replay_segment(segment)
+
+    def _replay_segment(self, segment):
+        path = self.segment_path(segment)
+
+        good_until = 0
+        with open(path, 'rb') as log:
+            while True:
+                header = log.read(WriteAheadLog.HEADER.size)
+                if len(header) < WriteAheadLog.HEADER.size:
+                    break
+                size, crc = WriteAheadLog.HEADER.unpack(header)
+                payload = log.read(size)
+                if len(payload) < size or zlib.crc32(payload) != crc:
+                    break
+                try:
+                    (txn_id, writes), _ = \
+                        WriteAheadLog.RECORD.decode(payload, 0)
+                except (CodecError, struct.error, UnicodeDecodeError):
+                    break
+
+                good_until = log.tell()
+                yield txn_id, writes
+
+        if good_until != os.path.getsize(path):
+            UI.log(f'Truncating torn tail of {path} at {good_until}',
+                   level=logging.WARNING)
+            os.truncate(path, good_until)
+
+    def open(self):
+        """
+        Start appending to the newest segment on disk
+        """
+        self.segment = max(self.segments(), default=0)
+        self._fd = self._open_segment(self.segment)
+
+    def _open_segment(self, segment):
+        return os.open(self.segment_path(segment),
+                       os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def rotate(self):
+        """
+        Send every record appended from now on to a new segment and return
+        its number. Records still queued go to the new segment too, which
+        is fine since replaying a record twice has no effect
+        """
+        self._retired.append(self._fd)
+        self.segment += 1
+        self._fd = self._open_segment(self.segment)
+        if self._flushing is None:
+            self._close_retired()
+        return self.segment
+
+    def drop_before(self, segment):
+        """
+        Delete all segments older than segment
+        """
+        for old in self.segments():
+            if old < segment:
+                os.remove(self.segment_path(old))
+
+    def _close_retired(self):
+        for fd in self._retired:
+            os.close(fd)
+        self._retired = []
+
+    def append(self, txn_id, writes):
+        """
+        Queue the writes of txn_id, the returned future is done once they
+        are on disk
+        """
+        payload = bytearray()
+        WriteAheadLog.RECORD.encode((txn_id, writes), payload)
+        self._pending += WriteAheadLog.HEADER.pack(len(payload),
+                                                   zlib.crc32(payload))
+        self._pending += payload
+
+        waiter = self.evloop.create_future()
+        self._waiters.append(waiter)
+
+        if len(self._waiters) >= self.batch_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = self.evloop.call_later(self.flush_interval,
+                                                 self._schedule_flush)
+        return waiter
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # only one batch on the disk at a time, the next one starts from
+        # the done callback of the current one
+        if self._flushing is None and self._waiters:
+            self._flushing = asyncio.ensure_future(self._flush())
+            self._flushing.add_done_callback(self._flush_done)
+
+    def _flush_done(self, _):
+        self._flushing = None
+        self._close_retired()
+        if len(self._waiters) >= self.batch_size:
+            self._schedule_flush()
+        elif self._waiters and self._timer is None:
+            self._timer = self.evloop.call_later(self.flush_interval,
+                                                 self._schedule_flush)
+
+    async def _flush(self):
+        data, self._pending = self._pending, bytearray()
+        waiters, self._waiters = self._waiters, []
+
+        try:
+            await self.evloop.run_in_executor(None, self._write, self._fd,
+                                              data)
+        except OSError as e:
+            UI.log(f'!!! WAL WRITE FAILED: {e} !!!', level=logging.CRITICAL)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @staticmethod
+    def _write(fd, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        os.fsync(fd)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._fd is None:
+            return
+        # best effort, the loop is going away so write what is left here
+        if self._pending:
+            self._write(self._fd, self._pending)
+            self._pending = bytearray()
+        os.close(self._fd)
+        self._fd = None
+        self._close_retired()
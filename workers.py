@@ -0,0 +1,634 @@
+"""
+Run one server as several processes, each owning a shard of its keys.
+
+    python3 workers.py [debug] [<workers>]
+
+Starts <workers> worker processes, one per core by default. They all
+listen on the server port with SO_REUSEPORT, so the kernel spreads client
+connections over them, and a key belongs to the worker whose index is the
+hash of the key modulo the number of workers. A worker handles requests on
+its own keys itself and forwards the rest to their owner over a unix
+socket, so clients see a single server.
+
+Every worker keeps its own log, checkpoint, ring and stats files, named
+after the usual ones with its index added (server.3.wal). The number of
+workers is recorded in server.workers and must stay the same for as long
+as those files are kept.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+
+import framing
+import logs
+from messages import *
+from partition import HashRing
+from server import ServerNetwork, ServerProtocol, compression_ratio, roles
+from tracker import RequestTracker
+from ui import UI
+
+
+def worker_path(path, index):
+    """
+    path of worker index, server.wal becomes server.3.wal
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}.{index}{ext}'
+
+
+class WorkerLink:
+    """
+    Connection to another worker of the same server, over its unix socket.
+    Connects on first use and again after the connection was lost
+    """
+
+    def __init__(self, path, tracker):
+        self.evloop = asyncio.get_event_loop()
+        self.path = path
+        self.tracker = tracker
+
+        self.transport = None
+        self._connecting = None  # type: asyncio.Task
+        self._seq = itertools.count(1)
+
+    async def _connect(self):
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(
+                self.evloop.create_unix_connection(
+                    lambda: WorkerLink.Protocol(self), self.path))
+        connecting = self._connecting
+        try:
+            self.transport, _ = await connecting
+        except OSError:
+            if self._connecting is connecting:
+                self._connecting = None
+            raise
+
+    def _lost(self, transport):
+        if self.transport is transport:
+            self.transport = None
+            self._connecting = None
+
+    def _write(self, msg):
+        msg.uid = next(self._seq) & 0xFFFFFFFF
+        self.transport.write(framing.pack(CODEC.encode(msg)))
+
+    async def request(self, msg, timeout):
+        """
+        Response to msg, None if the worker could not be reached or did not
+        answer within timeout
+        """
+        try:
+            await self._connect()
+        except OSError as e:
+            UI.log(f'Could not reach worker at {self.path}: {e}',
+                   level=logging.WARNING)
+            return None
+
+        self._write(msg)
+        try:
+            return await self.tracker.track((self.path, msg.uid), timeout)
+        except asyncio.TimeoutError:
+            UI.log(f'Worker at {self.path} did not answer {msg.type()}',
+                   level=logging.WARNING)
+            return None
+
+    async def send(self, msg):
+        """
+        Send msg, which has no response
+        """
+        try:
+            await self._connect()
+        except OSError as e:
+            UI.log(f'Could not reach worker at {self.path}: {e}',
+                   level=logging.WARNING)
+            return
+        self._write(msg)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    class Protocol(asyncio.Protocol):
+        def __init__(self, link):
+            self.link = link
+            self.decoder = framing.FrameDecoder()
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def connection_lost(self, exc):
+            self.link._lost(self.transport)
+
+        def data_received(self, data):
+            try:
+                frames = self.decoder.feed(data)
+            except framing.FrameError as e:
+                UI.log(f'Bad frame from {self.link.path}: {e}',
+                       level=logging.ERROR)
+                self.transport.close()
+                return
+
+            for frame in frames:
+                try:
+                    msg = CODEC.decode(frame)
+                except CodecError as e:
+                    UI.log(f'Bad message from {self.link.path}: {e}',
+                           level=logging.ERROR)
+                    self.transport.close()
+                    return
+                self.link.tracker.resolve((self.link.path, msg.orig_uid), msg)
+
+
+class WorkerNetwork(ServerNetwork):
+    """
+    One worker process of a server, see the top of this file.
+
+    Requests from clients go through the route_ method of their type, if
+    it has one, which runs them here or sends them on to the workers they
+    concern. Requests from other workers were routed already and always go
+    straight to their handle_ method.
+
+    A txn may have buffered writes in several workers, so committing it is
+    a small two phase commit of its own: every worker votes on the txn, and
+    if none says no and at least one knows it, the ones that voted yes
+    apply their writes. Unlike in a single process server, a CommitOne
+    validates and applies in two steps.
+    """
+    SOCKET_PATH = 'server.sock'
+    # the number of workers the files in this directory were written by
+    WORKERS_PATH = 'server.workers'
+    # seconds to wait for another worker, less than clients wait for us
+    FORWARD_TIMEOUT = 2.0
+    # peer name of connections from other workers
+    WORKER = 'worker'
+    # gauges that add up over the workers in the stats of the server
+    SUMMED_GAUGES = ('keys', 'txns', 'buffered_writes')
+
+    def __init__(self, index, count, socket_path=None, **kwargs):
+        super().__init__(**kwargs)
+        self.index = index
+        self.count = count
+        # we replicate our keys as one stream of count
+        for replicator in self.replicators:
+            replicator.stream = index
+            replicator.streams = count
+
+        socket_path = socket_path or WorkerNetwork.SOCKET_PATH
+        self.socket_path = worker_path(socket_path, index)
+        self.tracker = RequestTracker()
+        self.links = {other: WorkerLink(worker_path(socket_path, other),
+                                        self.tracker)
+                      for other in range(count) if other != index}
+        self.internal = None  # type: asyncio.AbstractServer
+
+    async def create_server(self):
+        self.internal = await self.evloop.create_unix_server(
+            lambda: ServerProtocol(self.request_handler,
+                                   peer=WorkerNetwork.WORKER),
+            path=self.socket_path)
+        await super().create_server()
+        UI.log(f'Worker {self.index} of {self.count}')
+
+    def close(self):
+        if self.internal is not None:
+            self.internal.close()
+        for link in self.links.values():
+            link.close()
+        super().close()
+
+    def shard(self, key):
+        """
+        Index of the worker key belongs to
+        """
+        return HashRing.hash(key) % self.count
+
+    def handler(self, msg):
+        if msg.origin != WorkerNetwork.WORKER:
+            router = getattr(self, f'route_{msg.type()}', None)
+            if router is not None:
+                return router
+        return super().handler(msg)
+
+    async def _ask(self, worker, msg):
+        """
+        Response of worker to msg, None if it did not answer
+        """
+        if worker != self.index:
+            return await self.links[worker].request(
+                msg, WorkerNetwork.FORWARD_TIMEOUT)
+
+        response = super().handler(msg)(msg)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def _tell(self, worker, msg):
+        """
+        Hand msg, which has no response, to worker
+        """
+        if worker != self.index:
+            await self.links[worker].send(msg)
+        else:
+            super().handler(msg)(msg)
+
+    async def _ask_all(self, make_msg, workers=None):
+        """
+        Responses of workers, all by default, to make_msg(worker)
+        """
+        if workers is None:
+            workers = range(self.count)
+        return await asyncio.gather(*[self._ask(worker, make_msg(worker))
+                                      for worker in workers])
+
+    async def _tell_all(self, make_msg, workers=None):
+        if workers is None:
+            workers = range(self.count)
+        await asyncio.gather(*[self._tell(worker, make_msg(worker))
+                               for worker in workers])
+
+    async def _relay(self, msg, worker, request):
+        response = await self._ask(worker, request)
+        if response is not None:
+            response.orig_uid = msg.uid
+        return response
+
+    def route_SetMsg(self, msg):
+        worker = self.shard(msg.key)
+        if worker == self.index:
+            return self.handle_SetMsg(msg)
+        return self._relay(msg, worker,
+                           SetMsg(msg.txn_id, msg.key, msg.value))
+
+    def route_GetMsg(self, msg):
+        worker = self.shard(msg.key)
+        if worker == self.index:
+            return self.handle_GetMsg(msg)
+        return self._relay(msg, worker,
+                           GetMsg(msg.txn_id, msg.key, msg.readonly))
+
+    def route_SetChunkMsg(self, msg):
+        worker = self.shard(msg.key)
+        if worker == self.index:
+            return self.handle_SetChunkMsg(msg)
+        return self._relay(msg, worker, SetChunkMsg(
+            msg.txn_id, msg.key, msg.size, msg.offset, msg.data, msg.kind))
+
+    def route_GetChunkMsg(self, msg):
+        worker = self.shard(msg.key)
+        if worker == self.index:
+            return self.handle_GetChunkMsg(msg)
+        return self._relay(msg, worker, GetChunkMsg(
+            msg.txn_id, msg.key, msg.offset, msg.readonly))
+
+    def route_BatchMsg(self, msg):
+        # worker -> indexes of its ops
+        parts = collections.defaultdict(list)
+        for index, (_, key, _) in enumerate(msg.ops):
+            parts[self.shard(key)].append(index)
+        if set(parts) <= {self.index}:
+            return self.handle_BatchMsg(msg)
+        return self._batch(msg, parts)
+
+    async def _batch(self, msg, parts):
+        workers = list(parts)
+        responses = await self._ask_all(
+            lambda worker: BatchMsg(msg.txn_id,
+                                    [msg.ops[i] for i in parts[worker]],
+                                    msg.readonly),
+            workers)
+        if None in responses:
+            return None
+
+        results = [None] * len(msg.ops)
+        for worker, response in zip(workers, responses):
+            for index, result in zip(parts[worker], response.results):
+                results[index] = result
+
+        # each worker kept its own reply small, together they may not be
+        response = BatchMsgResponse(msg.uid, self._handles(results))
+        return response
+
+    def route_ScanMsg(self, msg):
+        return self._scan_all(msg)
+
+    async def _scan_all(self, msg):
+        responses = await self._ask_all(
+            lambda _: ScanMsg(msg.txn_id, msg.start, msg.end, msg.limit,
+                              msg.readonly))
+        if None in responses:
+            return None
+        if not all(response.success for response in responses):
+            response = ScanMsgResponse(msg.uid, False, [], '', True)
+            return response
+
+        # every worker read all of its keys up to its next_key, so all of
+        # them together up to the smallest one
+        rest = [response.next_key for response in responses
+                if not response.done]
+        records = sorted(itertools.chain.from_iterable(
+            response.records for response in responses),
+            key=lambda record: record[0])
+        if rest:
+            next_key = min(rest)
+            records = [record for record in records if record[0] < next_key]
+        if len(records) > msg.limit:
+            rest.append(records[msg.limit][0])
+            records = records[:msg.limit]
+
+        done = len(rest) == 0
+        next_key = '' if done else min(rest)
+        response = ScanMsgResponse(msg.uid, True, self._handles(records),
+                                   next_key, done)
+        return response
+
+    def handle_WorkerVoteMsg(self, msg):
+        txn = self.storage.txn(msg.txn_id)
+        if txn is None:
+            vote = WorkerVoteMsgResponse.VOTE_UNKNOWN
+        elif self._try_commit(msg.txn_id):
+            # the commit may take a while to come, see Storage.expire
+            self.storage.prepare(msg.txn_id)
+            vote = WorkerVoteMsgResponse.VOTE_YES
+        else:
+            vote = WorkerVoteMsgResponse.VOTE_NO
+
+        writes = 0 if txn is None else len(txn.buffer)
+        response = WorkerVoteMsgResponse(msg.uid, vote, writes)
+        return response
+
+    def handle_WorkerCommitMsg(self, msg):
+        durable = None
+        if self.storage.txn(msg.txn_id) is not None:
+            durable = self._do_commit(msg.txn_id)
+        elif self.storage.aborted(msg.txn_id):
+            # only the workers that do not know the txn are asked in vain
+            UI.log(f'Commit for txn {msg.txn_id} we aborted',
+                   level=logging.ERROR)
+
+        response = WorkerCommitMsgResponse(msg.uid)
+        if durable is None:
+            return response
+        return self._after(durable, response)
+
+    async def _vote(self, txn_id, writes):
+        """
+        (success, workers that voted yes). writes is how many keys the
+        client wrote to all of us together
+        """
+        responses = await self._ask_all(lambda _: WorkerVoteMsg(txn_id))
+        votes = [None if response is None else response.vote
+                 for response in responses]
+
+        yes = [worker for worker, vote in enumerate(votes)
+               if vote == WorkerVoteMsgResponse.VOTE_YES]
+        known = [worker for worker, vote in enumerate(votes)
+                 if vote != WorkerVoteMsgResponse.VOTE_UNKNOWN]
+        # like a single process server, refuse a txn nobody knows, its
+        # lease expired
+        if not known:
+            self.metrics.incr('refused.commit.unknown_txn')
+            return False, yes
+        # a worker lost its part of the txn, see _try_commit
+        if None not in responses and \
+                sum(response.writes for response in responses) != writes:
+            self.metrics.incr('refused.commit.lost_writes')
+            return False, yes
+        return len(yes) == len(known), yes
+
+    def route_TryCommitMsg(self, msg):
+        return self._try_commit_all(msg)
+
+    async def _try_commit_all(self, msg):
+        success, _ = await self._vote(msg.txn_id, msg.writes)
+
+        response = TryCommitMsgResponse(msg.uid, success)
+        return response
+
+    def route_DoCommitMsg(self, msg):
+        return self._do_commit_all(msg)
+
+    async def _do_commit_all(self, msg):
+        # the TryCommit may have gone through another worker, so we do not
+        # know who voted yes, those that did not ignore it
+        responses = await self._ask_all(
+            lambda _: WorkerCommitMsg(msg.txn_id))
+        if None in responses:
+            return None
+
+        response = DoCommitMsgResponse(msg.uid)
+        return response
+
+    def route_CommitOneMsg(self, msg):
+        return self._commit_one_all(msg)
+
+    async def _commit_one_all(self, msg):
+        success, yes = await self._vote(msg.txn_id, msg.writes)
+        if not success:
+            # all of us, so that none takes ops of the txn that are late
+            await self._tell_all(lambda _: AbortMsg(msg.txn_id))
+            response = CommitOneMsgResponse(msg.uid, False)
+            return response
+
+        responses = await self._ask_all(
+            lambda _: WorkerCommitMsg(msg.txn_id), yes)
+        # a worker that did not confirm may or may not have committed,
+        # leave the client not knowing either
+        if None in responses:
+            return None
+
+        response = CommitOneMsgResponse(msg.uid, True)
+        return response
+
+    def route_AbortMsg(self, msg):
+        return self._tell_all(lambda _: AbortMsg(msg.txn_id))
+
+    def route_ReleaseMsg(self, msg):
+        return self._tell_all(lambda _: ReleaseMsg(msg.txn_id))
+
+    def route_StatsMsg(self, msg):
+        return self._stats_all(msg)
+
+    async def _stats_all(self, msg):
+        responses = await self._ask_all(lambda _: StatsMsg())
+        workers = [None if response is None else json.loads(response.stats)
+                   for response in responses]
+
+        counters = dict()
+        gauges = {name: 0 for name in WorkerNetwork.SUMMED_GAUGES}
+        for stats in workers:
+            if stats is None:
+                continue
+            for name, count in stats['counters'].items():
+                counters[name] = counters.get(name, 0) + count
+            for name in WorkerNetwork.SUMMED_GAUGES:
+                gauges[name] += stats['gauges'].get(name, 0)
+        gauges['compression_ratio'] = compression_ratio(counters)
+        stats = {'counters': counters, 'gauges': gauges, 'workers': workers}
+
+        response = StatsMsgResponse(msg.uid, json.dumps(stats, sort_keys=True))
+        return response
+
+    def route_ExportKeysMsg(self, msg):
+        return self._export_all(msg)
+
+    async def _export_all(self, msg):
+        responses = await self._ask_all(
+            lambda _: ExportKeysMsg(msg.name, msg.names, msg.vnodes,
+                                    msg.start, msg.limit))
+        if None in responses:
+            return None
+
+        # each worker sent its first limit keys from start on, so the
+        # first limit of all of them are the page, and the next page starts
+        # at the first key we do not send
+        records = sorted(itertools.chain.from_iterable(
+            response.records for response in responses),
+            key=lambda record: record[0])
+        rest = [response.next_key for response in responses
+                if not response.done]
+        if len(records) > msg.limit:
+            rest.append(records[msg.limit][0])
+
+        done = len(rest) == 0
+        next_key = '' if done else min(rest)
+        response = ExportKeysMsgResponse(msg.uid, records[:msg.limit],
+                                         next_key, done)
+        return response
+
+    def route_ImportKeysMsg(self, msg):
+        parts = collections.defaultdict(list)
+        for record in msg.records:
+            parts[self.shard(record[0])].append(record)
+        return self._import_all(msg, parts)
+
+    async def _import_all(self, msg, parts):
+        responses = await self._ask_all(
+            lambda worker: ImportKeysMsg(parts[worker]), list(parts))
+        success = all(response is not None and response.success
+                      for response in responses)
+
+        response = ImportKeysMsgResponse(msg.uid, success)
+        return response
+
+    def route_DropKeysMsg(self, msg):
+        return self._drop_all(msg)
+
+    async def _drop_all(self, msg):
+        responses = await self._ask_all(
+            lambda _: DropKeysMsg(msg.name, msg.names, msg.vnodes))
+        if None in responses:
+            return None
+
+        response = DropKeysMsgResponse(
+            msg.uid, sum(response.count for response in responses))
+        return response
+
+    def route_ReplicateMsg(self, msg):
+        # every worker gets its share, even if empty, to hear that the
+        # primary considers us up to date
+        parts = {worker: [] for worker in range(self.count)}
+        for txn_id, writes in msg.records:
+            by_worker = collections.defaultdict(list)
+            for key, value in writes:
+                by_worker[self.shard(key)].append((key, value))
+            for worker, worker_writes in by_worker.items():
+                parts[worker].append((txn_id, worker_writes))
+
+        return self._tell_all(
+            lambda worker: ReplicateMsg(parts[worker], msg.synced,
+                                        msg.closed, msg.stream, msg.streams,
+                                        msg.catch_up))
+
+    def route_ReplicateChunkMsg(self, msg):
+        worker = self.shard(msg.key)
+        if worker == self.index:
+            return self.handle_ReplicateChunkMsg(msg)
+        return self._tell(worker, ReplicateChunkMsg(
+            msg.txn_id, msg.key, msg.size, msg.offset, msg.data, msg.kind,
+            msg.catch_up))
+
+    def route_ReplicateRingMsg(self, msg):
+        # every worker refuses and drops the keys it holds
+        return self._tell_all(
+            lambda _: ReplicateRingMsg(msg.name, msg.names, msg.vnodes,
+                                       msg.drop))
+
+
+def run_worker(index, count, debug):
+    logs.setup(worker_path('server.log', index), debug,
+               ServerNetwork.LOG_SAMPLING)
+
+    evloop = asyncio.get_event_loop()
+    if debug:
+        evloop.set_debug(True)
+
+    backups, replica_of = roles(socket.getfqdn())
+    server_network = WorkerNetwork(
+        index, count,
+        wal_path=worker_path(ServerNetwork.WAL_PATH, index),
+        checkpoint_path=worker_path(ServerNetwork.CHECKPOINT_PATH, index),
+        stats_path=worker_path(ServerNetwork.STATS_PATH, index),
+        ring_path=worker_path(ServerNetwork.RING_PATH, index),
+        backups=backups, replica_of=replica_of)
+    evloop.run_until_complete(server_network.create_server())
+
+    # the launcher passes termination on with SIGTERM
+    evloop.add_signal_handler(signal.SIGTERM, evloop.stop)
+    try:
+        evloop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    server_network.close()
+    UI.log('BYE!')
+
+
+def main():
+    args = sys.argv[1:]
+    debug = len(args) > 0 and args[0] == 'debug'
+    if debug:
+        args = args[1:]
+    count = int(args[0]) if args else os.cpu_count() or 1
+
+    # keys are sharded by the number of workers, files written by another
+    # number of them hold keys of the wrong workers
+    if os.path.exists(WorkerNetwork.WORKERS_PATH):
+        with open(WorkerNetwork.WORKERS_PATH) as f:
+            previous = int(f.read())
+        if previous != count:
+            print(f'Data here was written by {previous} workers, not '
+                  f'{count}')
+            sys.exit(1)
+    else:
+        with open(WorkerNetwork.WORKERS_PATH, 'w') as f:
+            f.write(f'{count}\n')
+
+    workers = [multiprocessing.Process(target=run_worker,
+                                       args=(index, count, debug))
+               for index in range(count)]
+    for worker in workers:
+        worker.start()
+
+    def terminate(*_):
+        for worker in workers:
+            worker.terminate()
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # the workers got the interrupt too
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()